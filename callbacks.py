@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 
 from .populate.optutils.base import Turbo
+from .populate import localquery
 
 def filter2query(tags):
     """
@@ -27,3 +28,17 @@ def tags2turbo(lon, lat, dist, bdim=155, timeout=60, pretty_print=False, maxsize
         timeout=timeout, maxsize=maxsize
     )
     return dict(query=query)
+
+
+def tags2local(lon, lat, dist, bdim=155, tags=[], newer_than=None, sync=True):
+    """ Same conditions as tags2turbo answered from the local db, stale
+    tiles are synced from Overpass first (see: populate.localquery).
+    """
+    qconditions = [{
+        "query": filter2query(tags),
+        "distance": dist,
+        "gtypes": ('node', 'way', 'relation',)
+    }]
+    return dict(elements=localquery.elements(lon, lat, qconditions,
+        bdim=bdim, newer_than=newer_than, sync=sync
+    ))
@@ -15,6 +15,7 @@ class Info(Field):
         super(Info, self).__init__(fieldname, type, *args, **kwargs)
 
 
+# NOTE: json columns are migrated to jsonb by setup.postgresql.setup_indexes
 db.define_table("info",
     Field("source_name", required=True, notnull=True),
     Field("source_id", required=True, notnull=True),
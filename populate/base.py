@@ -5,12 +5,24 @@ jsondumps = serializers.json
 
 from pydal import geoPoint
 from datetime import datetime
+from .pgcopy import copyers as copyers_by_format, copy_text
+from itertools import groupby, islice
+import io
 
 import logging
 logger = logging.getLogger(__name__)
 
 _get_coordinates = lambda lon, lat, height=None: (lon, lat,) if height is None else (lon, lat, height,)
 
+def chunks(iterable, size):
+    """ Yields lists of at most size elements from iterable """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            break
+        yield chunk
+
 class PanicError(Exception):
     """ """
     def __init__(self, message="/o\ It should never happen, why does it happen? /o\ "):
@@ -37,6 +49,11 @@ class __Base__(object):
 class BaseParser(__Base__):
     """docstring for BaseParser."""
 
+    def __init__(self, *args, **kwargs):
+        super(BaseParser, self).__init__(*args, **kwargs)
+        # Info ids already saved by _save_infos by (gtype, source id)
+        self._info_ids = {}
+
     # def save_addon(self, key, properties):
     #     """ """
     #     ref_value = properties[key]
@@ -92,6 +109,11 @@ class BaseParser(__Base__):
         if not hasattr(rec_or_sid, "update_record"):
             # rec_or_sid is just an id
             sid = str(rec_or_sid)
+            try:
+                # Already saved in batch by _save_infos
+                return self._info_ids.pop((gtype, sid,))
+            except KeyError:
+                pass
             flt = dict(
                 source_name = self.source_name,
                 gtype = gtype,
@@ -113,6 +135,110 @@ class BaseParser(__Base__):
             if not attributes or rec.attributes.get('changeset')!=attributes.get('changeset'):
                 return insert_or_update(tags, properties, attributes, rec=rec)
 
+    def _save_infos(self, entities, merge=False):
+        """ Batch version of _save_info.
+        Entities are copied into a temporary staging table and then saved with
+        one single INSERT ... ON CONFLICT (suid) DO UPDATE for each merge mode,
+        with the same semantics of _save_info: tags, properties and attributes
+        are merged with the stored ones if required and records with unchanged
+        changeset are left untouched.
+        Returned ids are also kept aside so that following calls to _save_info
+        for the same entities don't hit the db.
+
+        entities @iterable : dicts with keys "sid", "gtype" and optionally
+                             "tags", "properties", "attributes" and "merge";
+        merge        @bool : Default merge mode.
+
+        returns:
+            ids @dict : {(<gtype>, <source id>): <info id>}
+        """
+
+        by_suid = {}
+        for entity in entities:
+            _suid = dict(
+                source_name = self.source_name,
+                gtype = entity['gtype'],
+                source_id = str(entity['sid'])
+            )
+            suid = self.db.info.suid.compute(_suid)
+            new = dict(_suid,
+                suid = suid,
+                merge = entity.get('merge', merge),
+                tags = entity.get('tags'),
+                properties = entity.get('properties'),
+                attributes = entity.get('attributes')
+            )
+            # Last one wins as it would with sequential calls
+            old = by_suid.get(suid)
+            if not old is None and new['merge']:
+                for key in ('tags', 'properties', 'attributes',):
+                    if not (old[key] is None and new[key] is None):
+                        new[key] = dict(old[key] or {}, **(new[key] or {}))
+            by_suid[suid] = new
+
+        if not by_suid:
+            return {}
+
+        self.db.executesql("""CREATE TEMP TABLE IF NOT EXISTS info_staging (
+            source_name text, source_id text, gtype text, suid text,
+            tags text, properties text, attrs text
+        )""")
+
+        now = datetime.utcnow()
+        represent = self.db._adapter.represent
+        columns = ('source_name', 'source_id', 'gtype', 'suid', 'tags', 'properties', 'attrs',)
+
+        def _json(value):
+            return None if value is None else jsondumps(value)
+
+        def _merged(col):
+            return "CASE WHEN info.{0} IS NULL AND EXCLUDED.{0} IS NULL THEN NULL " \
+                "ELSE COALESCE(info.{0}::jsonb, '{{}}') || COALESCE(EXCLUDED.{0}::jsonb, '{{}}') END".format(col)
+
+        sql = """INSERT INTO info (source_name, source_id, gtype, suid, tags, properties, attrs, created_on, modified_on, is_active)
+            SELECT source_name, source_id, gtype, suid, tags::jsonb, properties::jsonb, attrs::jsonb, {now}, {now}, {true}
+            FROM info_staging
+            ON CONFLICT (suid) DO UPDATE SET
+                tags = {tags},
+                properties = {properties},
+                attrs = {attrs},
+                modified_on = EXCLUDED.modified_on,
+                is_active = EXCLUDED.is_active
+            WHERE EXCLUDED.attrs IS NULL OR EXCLUDED.attrs::text = '{{}}' OR
+                (info.attrs->>'changeset') IS DISTINCT FROM (EXCLUDED.attrs->>'changeset')"""
+
+        ids = {}
+        _merge = lambda entity: entity['merge']
+        for merge_, _entities in groupby(sorted(by_suid.values(), key=_merge), key=_merge):
+            self.db.executesql("TRUNCATE info_staging")
+            buffer = io.StringIO()
+            for entity in _entities:
+                buffer.write('\t'.join(map(copy_text, (
+                    entity['source_name'],
+                    entity['source_id'],
+                    entity['gtype'],
+                    entity['suid'],
+                    _json(entity['tags']),
+                    _json(entity['properties']),
+                    _json(entity['attributes']),
+                ))) + '\n')
+            buffer.seek(0)
+            self.db._adapter.cursor.copy_from(buffer, 'info_staging', columns=columns)
+
+            self.db.executesql(sql.format(
+                now = represent(now, 'datetime'),
+                true = represent(True, 'boolean'),
+                **{col: _merged(col) if merge_ else "EXCLUDED.{}".format(col) for col in ('tags', 'properties', 'attrs',)}
+            ))
+            ids.update(((gtype, sid,), id,) for gtype, sid, id in self.db.executesql("""SELECT
+                info_staging.gtype, info_staging.source_id, info.id
+                FROM info_staging JOIN info ON info.suid = info_staging.suid"""))
+
+        self.db.executesql("TRUNCATE info_staging")
+        logger.debug(f"Saved {len(ids)} info records in batch")
+        self._info_ids.update(ids)
+        return ids
+
     def _save_node(self, info_id, *coordinates):
         """
         info_id @integer :
@@ -153,6 +279,24 @@ def normalize_tags_for_db(kwargs):
 class BaseCopier(__Base__):
     """docstring for BaseCopier."""
 
+    # Options passed to every BulkCopyer (i.e. {"block_size": 10000}).
+    # The "format" key selects the COPY format: "text" (default) or "binary".
+    copy_options = {}
+
+    def _copyers(self, *tables):
+        """ Returns one BulkCopyer for each given table configured with copy_options.
+        Tables must be given in foreign key order (i.e. info, node, way_node,
+        relation): every copyer flushes all the previous ones before streaming
+        its own rows.
+        tables @DAL.Table :
+        """
+        copyers = []
+        options = dict(self.copy_options)
+        copyer_class = copyers_by_format[options.pop('format', 'text')]
+        for table in tables:
+            copyers.append(copyer_class(table, upstream=copyers[:], **options))
+        return copyers
+
     def _save_info(self, sid, gtype, tags=None, properties=None, attributes=None, **__):
         """
         sid @string : The entity identifier restricted to the data source environment.
@@ -191,10 +335,9 @@ class BaseCopier(__Base__):
         """
         info_id @integer :
         """
-        point = geoPoint(*_get_coordinates(*coordinates))
         return self._insnodes.writerow(dict(
             info_id = info_id,
-            geom = "SRID=4326;{}".format(point)
+            geom = self._insnodes.point(*_get_coordinates(*coordinates))
         ))
 
     def _save_way_node(self, info_id, node_id, sorting):
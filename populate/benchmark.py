@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+
+# Text vs binary COPY benchmark on synthetic info and node rows.
+#
+# Client side only (no db needed):
+#     python -m <app>.planetstore.populate.benchmark -n 200000
+#
+# Client side plus COPY into temporary copies of the info and node tables
+# (nothing is committed):
+#     python -m <app>.planetstore.populate.benchmark -n 200000 --db
+
+import csv, io
+from time import perf_counter
+from random import uniform, randint
+from datetime import datetime
+
+from .pgcopy import BulkCopyer, BinaryRowEncoder
+
+try:
+    from ujson import dumps as jsdumps
+except ImportError:
+    from json import dumps as jsdumps
+
+info_columns = (
+    ('id', 'integer'),
+    ('source_name', 'character varying'),
+    ('source_id', 'character varying'),
+    ('properties', 'json'),
+    ('created_on', 'timestamp without time zone'),
+    ('modified_on', 'timestamp without time zone'),
+    ('tags', 'json'),
+    ('attributes', 'json'),
+    ('gtype', 'character varying'),
+    ('suid', 'character varying'),
+    ('is_active', 'character'),
+)
+
+node_columns = (
+    ('id', 'integer'),
+    ('info_id', 'integer'),
+    ('geom', 'geometry'),
+)
+
+def synthetic_rows(n):
+    """ Yields couples of info and node rows as built by BaseCopier """
+    timestamp = datetime.now()
+    for i in range(1, n+1):
+        sid = str(randint(1, 10**10))
+        info = dict(
+            id = i,
+            source_name = 'osm',
+            source_id = sid,
+            properties = 'NULL',
+            created_on = timestamp,
+            modified_on = timestamp,
+            tags = jsdumps({'amenity': 'bench', 'name': 'Node {:d}'.format(i)}),
+            attributes = jsdumps({'changeset': randint(1, 10**8), 'version': 1}),
+            gtype = 'node',
+            suid = 'osm-node-{}'.format(sid),
+            is_active = 'T'
+        )
+        node = dict(id=i, info_id=i, coordinates=(uniform(-180, 180), uniform(-85, 85),))
+        yield info, node
+
+def text_encode(rows):
+    """ Returns the text COPY buffers of info and node tables """
+    info_buffer, node_buffer = io.StringIO(), io.StringIO()
+    info_writer = csv.DictWriter(info_buffer, fieldnames=[c for c, _ in info_columns], dialect='custom')
+    node_writer = csv.DictWriter(node_buffer, fieldnames=[c for c, _ in node_columns], dialect='custom')
+    for info, node in rows:
+        info_writer.writerow(info)
+        node_writer.writerow(dict(id=node['id'], info_id=node['info_id'],
+            geom = BulkCopyer.point(*node['coordinates'])
+        ))
+    return info_buffer, node_buffer
+
+def binary_encode(rows):
+    """ Returns the binary COPY buffers of info and node tables """
+    from .pgcopy import BinaryBulkCopyer, PGCOPY_HEADER, PGCOPY_TRAILER
+    info_encoder, node_encoder = BinaryRowEncoder(info_columns), BinaryRowEncoder(node_columns)
+    info_buffer, node_buffer = io.BytesIO(PGCOPY_HEADER), io.BytesIO(PGCOPY_HEADER)
+    info_buffer.seek(0, io.SEEK_END)
+    node_buffer.seek(0, io.SEEK_END)
+    for info, node in rows:
+        info_buffer.write(info_encoder(info))
+        node_buffer.write(node_encoder(dict(id=node['id'], info_id=node['info_id'],
+            geom = BinaryBulkCopyer.point(*node['coordinates'])
+        )))
+    info_buffer.write(PGCOPY_TRAILER)
+    node_buffer.write(PGCOPY_TRAILER)
+    return info_buffer, node_buffer
+
+def timeit(func, *args):
+    t0 = perf_counter()
+    res = func(*args)
+    return res, perf_counter()-t0
+
+def report(label, n, seconds, *buffers):
+    size = sum(len(buffer.getvalue()) for buffer in buffers)
+    print("{:<24} {:>8.3f} s {:>12,.0f} rows/s {:>12,d} bytes".format(label, seconds, n/seconds, size))
+
+def copy_to_db(db, n, text_buffers, binary_buffers):
+    """ Copies both buffers into temporary tables shaped like info and node """
+    cursor = db._adapter.cursor
+    for table in ('info', 'node',):
+        db.executesql("CREATE TEMP TABLE bench_{0} (LIKE {0}) ON COMMIT DROP".format(table))
+    try:
+        for label, buffers, copy in (
+            ('text COPY', text_buffers, lambda buffer, table, columns: cursor.copy_from(buffer, table, null='NULL')),
+            ('binary COPY', binary_buffers, lambda buffer, table, columns: cursor.copy_expert(
+                "COPY {} ({}) FROM STDIN WITH (FORMAT binary)".format(table, ', '.join(columns)), buffer
+            )),
+        ):
+            db.executesql("TRUNCATE bench_info, bench_node")
+            t0 = perf_counter()
+            for buffer, table, columns in zip(buffers, ('bench_info', 'bench_node',), (info_columns, node_columns,)):
+                buffer.seek(0)
+                copy(buffer, table, ['attrs' if c=='attributes' else c for c, _ in columns])
+            report(label, n, perf_counter()-t0, *buffers)
+    finally:
+        db.rollback()
+
+if __name__ == '__main__':
+
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Text vs binary COPY benchmark")
+    parser.add_argument("-n", "--rows", type=int, default=100000, help="Number of nodes")
+    parser.add_argument("--db", action="store_true", default=False,
+        help="Also time the COPY into temporary tables (nothing is committed)"
+    )
+    args = parser.parse_args()
+
+    rows = list(synthetic_rows(args.rows))
+
+    text_buffers, dt = timeit(text_encode, rows)
+    report('text encoding', args.rows, dt, *text_buffers)
+    binary_buffers, dt = timeit(binary_encode, rows)
+    report('binary encoding', args.rows, dt, *binary_buffers)
+
+    if args.db:
+        from ..models import db
+        copy_to_db(db, args.rows, text_buffers, binary_buffers)
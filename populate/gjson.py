@@ -1,8 +1,7 @@
 # -*- coding: utf-8 -*-
 
 from pydal import geoPoint
-from .pgcopy import BulkCopyer
-from .base import WTF, BaseParser, BaseCopier
+from .base import WTF, BaseParser, BaseCopier, chunks
 from hashids import Hashids
 myhashids = Hashids()
 from tqdm import tqdm
@@ -18,7 +17,7 @@ class __CommonMethods__(object):
         except (AttributeError, NotImplementedError,) as err:
             raise NotImplementedError(feature["geometry"]["type"])
         else:
-            info_id = method(feature)
+            info_id = method(feature, merge=merge)
             if info_id is None:
                 # import pdb; pdb.set_trace()
                 raise WTF()
@@ -29,7 +28,7 @@ class __CommonMethods__(object):
 class NodeParser(BaseParser, __CommonMethods__):
     """docstring for GeojsonParser."""
 
-    def __init__(self, db, source_name, tags_on_update="replace", properties_on_update="replace"):
+    def __init__(self, db, source_name, tags_on_update="replace", properties_on_update="replace", batch_size=None):
         """
         db @DAL : The database in wich info, node, way_node and relation tables are defined.
         source_name @string : Source name
@@ -37,10 +36,29 @@ class NodeParser(BaseParser, __CommonMethods__):
             - "replace": Replace tags
             - "update": Update tags
         properties_on_update @string : See tags_on_update.
+        batch_size @integer : If given info records are saved in batches of
+            batch_size features with one upsert each (see BaseParser._save_infos).
         """
         super(NodeParser, self).__init__(db, source_name)
         self.tags_on_update = tags_on_update
         self.properties_on_update = properties_on_update
+        self.batch_size = batch_size
+
+    @staticmethod
+    def _vertex_sid(feat_id, wn, sorting):
+        return '{}-{}'.format(feat_id, myhashids.encode(wn, sorting))
+
+    @staticmethod
+    def _ring_sid(feat_id, wn):
+        return '{}-{}'.format(feat_id, myhashids.encode(wn))
+
+    def _infos(self, feature, merge=False):
+        """ Yields the info entities saved parsing the feature (see: _save_infos) """
+        yield dict(sid=feature["id"], gtype='node',
+            tags = feature.get('tags'),
+            properties = feature["properties"],
+            merge = merge
+        )
 
     def _parsePoint(self, feature, merge=False):
         """ """
@@ -70,17 +88,42 @@ class NodeParser(BaseParser, __CommonMethods__):
               "tags": {"<tag name>": <tag value>} # OPTIONAL NON GEOJSON STANDARD
             }
         """
-        for feature in tqdm(features):
-            info_id = self.parse_feature(feature, merge=merge)
+        if not self.batch_size:
+            for feature in tqdm(features):
+                info_id = self.parse_feature(feature, merge=merge)
+        else:
+            for batch in chunks(tqdm(features), self.batch_size):
+                self._save_infos(info for feature in batch for info in self._infos(feature, merge=merge))
+                for feature in batch:
+                    info_id = self.parse_feature(feature, merge=merge)
 
     parse = parse_features
 
 
 class WayParser(NodeParser):
 
+    def _vertex_infos(self, feat_id, coordinates, wn=0):
+        for sorting, _ in enumerate(coordinates):
+            yield dict(sid=self._vertex_sid(feat_id, wn, sorting), gtype='node')
+
+    def _infos(self, feature, merge=False):
+        """ See: NodeParser._infos """
+        if feature['geometry']['type']=='Point':
+            yield from super(WayParser, self)._infos(feature, merge=merge)
+            return
+        yield dict(sid=feature["id"], gtype='way',
+            tags = feature.get('tags'),
+            properties = feature["properties"],
+            merge = merge
+        )
+        if feature['geometry']['type']=='LineString':
+            yield from self._vertex_infos(feature["id"], feature["geometry"]['coordinates'])
+        elif feature['geometry']['type']=='Polygon':
+            yield from self._vertex_infos(feature["id"], feature["geometry"]['coordinates'][0])
+
     def _save_way(self, info_id, feat_id, coordinates, wn=0):
         for sorting, xy in enumerate(coordinates):
-            nsid = '{}-{}'.format(feat_id, myhashids.encode(wn, sorting))
+            nsid = self._vertex_sid(feat_id, wn, sorting)
             node_info_id = self._save_info(nsid, gtype='node')
             node_id = self._save_node(node_info_id, *xy)
             data = dict(info_id=info_id, node_id=node_id, sorting=sorting)
@@ -109,6 +152,22 @@ class WayParser(NodeParser):
 
 class PolygonParser(WayParser):
 
+    def _infos(self, feature, merge=False):
+        """ See: NodeParser._infos """
+        if feature['geometry']['type']=='Polygon' and len(feature["geometry"]['coordinates'])==1 or \
+            not feature['geometry']['type'] in ('Polygon', 'MultiPolygon',):
+            yield from super(PolygonParser, self)._infos(feature, merge=merge)
+            return
+        yield dict(sid=feature["id"], gtype='relation',
+            tags = dict(feature.get('tags', {}), type='multipolygon'),
+            properties = feature["properties"],
+            merge = merge
+        )
+        for wn,waynodes in enumerate(feature["geometry"]['coordinates']):
+            swid = self._ring_sid(feature["id"], wn)
+            yield dict(sid=swid, gtype='way')
+            yield from self._vertex_infos(swid, waynodes, wn=wn)
+
     def _parseMultiPolygon(self, feature, merge=False):
 
         info_id = self._save_info(
@@ -120,7 +179,7 @@ class PolygonParser(WayParser):
         )
 
         for wn,waynodes in enumerate(feature["geometry"]['coordinates']):
-            swid = '{}-{}'.format(feature["id"], myhashids.encode(wn))
+            swid = self._ring_sid(feature["id"], wn)
             way_info_id = self._save_info(swid, gtype='way')
             self._save_way(way_info_id, swid, waynodes, wn=wn)
 
@@ -181,8 +240,10 @@ class NodeCopier(BaseCopier, __CommonMethods__):
             }
         """
 
-        with BulkCopyer(self.db.node) as self._insnodes, \
-            BulkCopyer(self.db.info) as self._insinfo:
+        insinfo, insnodes = self._copyers(self.db.info, self.db.node)
+
+        with insnodes as self._insnodes, \
+            insinfo as self._insinfo:
 
             for feature in features:
                 info_id = self.parse_feature(feature)
@@ -208,9 +269,13 @@ class WayCopier(NodeCopier, WayParser):
             }
         """
 
-        with BulkCopyer(self.db.way_node) as self._insways, \
-            BulkCopyer(self.db.node) as self._insnodes, \
-            BulkCopyer(self.db.info) as self._insinfo:
+        insinfo, insnodes, insways = self._copyers(
+            self.db.info, self.db.node, self.db.way_node
+        )
+
+        with insways as self._insways, \
+            insnodes as self._insnodes, \
+            insinfo as self._insinfo:
 
             for feature in features:
                 info_id = self.parse_feature(feature)
@@ -343,10 +408,14 @@ class PolygonCopier(WayCopier, PolygonParser):
             }
         """
 
-        with BulkCopyer(self.db.relation) as self._insrelation, \
-            BulkCopyer(self.db.way_node) as self._insways, \
-            BulkCopyer(self.db.node) as self._insnodes, \
-            BulkCopyer(self.db.info) as self._insinfo:
+        insinfo, insnodes, insways, insrelation = self._copyers(
+            self.db.info, self.db.node, self.db.way_node, self.db.relation
+        )
+
+        with insrelation as self._insrelation, \
+            insways as self._insways, \
+            insnodes as self._insnodes, \
+            insinfo as self._insinfo:
 
             for feature in tqdm(features):
                 info_id = self.parse_feature(feature)
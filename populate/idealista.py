@@ -13,14 +13,11 @@ Aim of this module is to interface to idealista[*] web API.
 import requests, base64, time
 # from swissknife.log import timeLoggerDecorator, setUpGenericLogger
 import json
-import pyproj
 from shapely.geometry import Point
 from simplejson import JSONDecodeError
 
 NOTSET = None
 
-myproj = pyproj.Proj("epsg:3857")
-
 # logger = setUpGenericLogger("debug")
 
 # apikey = base64.b64encode(b':'.join([b"your_APIKEY", b"your_SECRET"]))
@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+
+import mmap, tempfile
+from array import array
+from bisect import bisect_left
+
+import numpy as np
+
+def _ndarray(column):
+    """ Returns a numpy view of an array or MmapArray column """
+    if not len(column):
+        return np.empty(0, dtype=np.int64)
+    return np.frombuffer(getattr(column, 'view', column), dtype=np.int64, count=len(column))
+
+def _merge(keys, columns, new_keys, new_values):
+    """ Returns the sorted keys and value columns (as new numpy arrays) with
+    new_keys (sorted) and new_values (one row for each key) merged in.
+    Values of existing keys are replaced.
+    """
+    keys = _ndarray(keys)
+    i = np.searchsorted(keys, new_keys)
+    found = i < len(keys)
+    found[found] = keys[i[found]] == new_keys[found]
+    merged_keys = np.insert(keys, i[~found], new_keys[~found])
+    # Positions of the replaced values after insertion
+    j = np.searchsorted(merged_keys, new_keys[found])
+    merged_columns = []
+    for c, column in enumerate(columns):
+        merged = np.insert(_ndarray(column), i[~found], new_values[~found, c])
+        merged[j] = new_values[found, c]
+        merged_columns.append(merged)
+    return merged_keys, merged_columns
+
+class MmapArray(object):
+    """ Growable array of 64 bit integers backed by a memory mapped
+    temporary file, so that its content can be paged out by the OS.
+    """
+
+    itemsize = 8
+
+    def __init__(self, items=(), dir=None, capacity=2**16):
+        """
+        items @iterable : Initial content;
+        dir @string : Directory of the temporary file (default: system default);
+        capacity @int : Initial number of allocated items.
+        """
+        super(MmapArray, self).__init__()
+        self.file = tempfile.TemporaryFile(dir=dir)
+        self.length = 0
+        self.mmap = self.view = None
+        self._map(max(capacity, len(items)))
+        self.extend(items)
+
+    def _map(self, capacity):
+        if self.mmap is not None:
+            self.view.release()
+            self.mmap.close()
+        self.file.truncate(capacity*self.itemsize)
+        self.mmap = mmap.mmap(self.file.fileno(), capacity*self.itemsize)
+        self.view = memoryview(self.mmap).cast('q')
+        self.capacity = capacity
+
+    def _reserve(self, size):
+        if size > self.capacity:
+            self._map(max(size, 2*self.capacity))
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self.length
+        if not 0 <= i < self.length:
+            raise IndexError(i)
+        return self.view[i]
+
+    def append(self, value):
+        self._reserve(self.length+1)
+        self.view[self.length] = value
+        self.length += 1
+
+    def extend(self, items):
+        if isinstance(items, array) and items.typecode == 'q':
+            self._reserve(self.length+len(items))
+            self.mmap[self.length*self.itemsize:(self.length+len(items))*self.itemsize] = items.tobytes()
+            self.length += len(items)
+        else:
+            for value in items:
+                self.append(value)
+
+    def close(self):
+        self.view.release()
+        self.mmap.close()
+        self.file.close()
+
+
+class IdMap(object):
+    """ Compact map of integer ids to one or more integer values.
+    Items are kept in sorted parallel arrays of 64 bit integers and looked up
+    by binary search. Keys inserted in ascending order (as OSM elements come
+    from Overpass and PBF files) are simply appended, the other ones wait in
+    a small dict that is merged into the arrays every merge_every items.
+    Past spill_over items, arrays are moved to memory mapped files (see: MmapArray).
+    """
+
+    def __init__(self, width=1, merge_every=2**16, spill_over=None, spill_dir=None):
+        """
+        width       @int : Number of integer values for each key;
+        merge_every @int : Number of out of order items merged at once;
+        spill_over  @int : Number of items after which arrays are memory mapped
+                           (default: never);
+        spill_dir   @string : Directory of memory mapped files.
+        """
+        super(IdMap, self).__init__()
+        self.width = width
+        self.merge_every = merge_every
+        self.spill_over = spill_over
+        self.spill_dir = spill_dir
+        self.spilled = False
+        self.keys = self._column()
+        self.values = [self._column() for _ in range(width)]
+        self.pending = {}
+        # Number of pending keys already in the arrays
+        self.replaced = 0
+
+    def _column(self, items=()):
+        if self.spilled:
+            return MmapArray(items, dir=self.spill_dir)
+        return array('q', items)
+
+    def _tocolumn(self, data):
+        items = array('q')
+        items.frombytes(data.tobytes())
+        return self._column(items) if self.spilled else items
+
+    def _spill(self):
+        if self.spill_over is None or self.spilled or len(self.keys) <= self.spill_over:
+            return
+        self.spilled = True
+        self.keys = self._column(self.keys)
+        self.values = [self._column(column) for column in self.values]
+
+    def __len__(self):
+        return len(self.keys) + len(self.pending) - self.replaced
+
+    def _pack(self, value):
+        return (value,) if self.width == 1 else tuple(value)
+
+    def _unpack(self, values):
+        return values[0] if self.width == 1 else values
+
+    def __setitem__(self, key, value):
+        values = self._pack(value)
+        if not self.keys or key > self.keys[-1]:
+            self.pending.pop(key, None)
+            self.keys.append(key)
+            for column, value in zip(self.values, values):
+                column.append(value)
+            self._spill()
+        else:
+            if not key in self.pending:
+                try:
+                    self._index(key)
+                except KeyError:
+                    pass
+                else:
+                    self.replaced += 1
+            self.pending[key] = values
+            if len(self.pending) >= self.merge_every:
+                self.merge()
+
+    def _index(self, key):
+        # Binary search is run directly on the buffer of mapped arrays
+        i = bisect_left(getattr(self.keys, 'view', self.keys), key, 0, len(self.keys))
+        if i < len(self.keys) and self.keys[i] == key:
+            return i
+        raise KeyError(key)
+
+    def __getitem__(self, key):
+        try:
+            values = self.pending[key]
+        except KeyError:
+            i = self._index(key)
+            values = tuple(column[i] for column in self.values)
+        return self._unpack(values)
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        else:
+            return True
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def update(self, items):
+        """ items @iterable : (<key>, <value>) couples """
+        for key, value in items:
+            self[key] = value
+
+    def merge(self):
+        """ Merges out of order items into the sorted arrays """
+        if not self.pending:
+            return
+        new_keys = np.fromiter(sorted(self.pending), dtype=np.int64, count=len(self.pending))
+        new_values = np.array([self.pending[key] for key in new_keys.tolist()], dtype=np.int64)
+        keys, values = _merge(self.keys, self.values, new_keys, new_values)
+        keys, values = self._tocolumn(keys), [self._tocolumn(column) for column in values]
+        if self.spilled:
+            self.close()
+        self.keys, self.values, self.pending, self.replaced = keys, values, {}, 0
+        self._spill()
+
+    def close(self):
+        """ Releases memory mapped files """
+        for column in [self.keys]+self.values:
+            if isinstance(column, MmapArray):
+                column.close()
@@ -0,0 +1,267 @@
+# -*- coding: utf-8 -*-
+
+"""
+Local execution of Turbo query conditions.
+
+The same qconditions submitted to Overpass (see: Turbo.build_query) are
+answered by SQL on the info, node, way_node and relation tables:
+
+    * has-kv conditions on jsonb tags: containment (@>) for values,
+      key existence (?) for keys and regular expression matches (~, ~*),
+      all served by the GIN index on tags (see: setup.postgresql.setup_indexes);
+    * bbox-query on the GiST index of node geometries; ways are selected by
+      their nodes and relations by their node and way members.
+
+Before querying, the tracked tiles covering the area are checked: the ones
+not tracked yet, never populated or older than max_age are synced from
+Overpass first (see: refresh), so only stale tiles go through the network.
+Without sync the query is read only.
+
+Tag values are compared as stored (see: base.normalize_tags_for_db).
+"""
+
+import datetime
+import json
+
+import mercantile as mc
+import overpy
+
+from .models import db, register_tiles
+from .base import normalize_tags_for_db
+from .tools import get_uri
+from .tile import BASE_DIM, base_zoom
+from .optutils.base import Turbo
+
+import logging
+logger = logging.getLogger(__name__)
+
+now = lambda: datetime.datetime.utcnow()
+
+# As tilequeue.update_query
+MAX_AGE = datetime.timedelta(days=28*6)
+
+GTYPES = ("node", "way", "relation",)
+
+ENVELOPE = "ST_MakeEnvelope(%s, %s, %s, %s, 4326)"
+
+def condition_sql(k=None, v=None, regv=None, regk=None, modv=None, case=None):
+    """ Returns (<sql>, <placeholders>) of a has-kv condition on info tags
+    (see: tagfilter.Condition for the supported attributes).
+    """
+    if not modv in (None, "", "not",):
+        raise NotImplementedError("Operator not yet supported: {}".format(modv))
+    # Values are matched as saved
+    v, regv = (normalize_tags_for_db(dict(v=v, regv=regv))[key] for key in ("v", "regv",))
+    op = "~*" if case == "ignore" else "~"
+    if not regk is None:
+        # An empty regular expression matches any value
+        sql = """EXISTS (SELECT 1 FROM jsonb_each_text(info.tags::jsonb) AS t(key, value)
+            WHERE t.key {op} %s AND t.value {op} %s)""".format(op=op)
+        placeholders = [regk, regv or ""]
+    elif not regv is None:
+        sql = "(info.tags::jsonb->>%s) {op} %s".format(op=op)
+        placeholders = [k, regv]
+    elif v:
+        sql = "info.tags::jsonb @> %s::jsonb"
+        placeholders = [json.dumps({k: v})]
+    else:
+        sql = "info.tags::jsonb ? %s"
+        placeholders = [k]
+    if modv == "not":
+        # Elements without the key satisfy negated conditions as in Overpass
+        sql = "NOT COALESCE({}, FALSE)".format(sql)
+    return sql, placeholders
+
+def query_sql(query):
+    """ Returns (<sql>, <placeholders>) of a union of intersections of
+    has-kv conditions (see: Turbo.build_query).
+    """
+    unions, placeholders = [], []
+    for intersection in query:
+        # Plain key-value conditions are merged in a single containment
+        values = {cond["k"]: cond["v"] for cond in intersection
+            if cond.get("v") and not any(cond.get(attr) for attr in ("modv", "regv", "regk",))}
+        conditions = []
+        if values:
+            conditions.append("info.tags::jsonb @> %s::jsonb")
+            placeholders.append(json.dumps(normalize_tags_for_db(values)))
+        for cond in intersection:
+            if cond.get("k") in values and cond.get("v") == values[cond["k"]] and not cond.get("modv"):
+                continue
+            sql, args = condition_sql(**cond)
+            conditions.append(sql)
+            placeholders.extend(args)
+        unions.append("({})".format(" AND ".join(conditions) or "TRUE"))
+    return "({})".format(" OR ".join(unions) or "FALSE"), placeholders
+
+def select_ids(gtype, bbox, query, newer_than=None):
+    """ Returns the info ids of the elements of gtype in bbox satisfying query.
+    bbox @dict : {'w': ..., 's': ..., 'e': ..., 'n': ...};
+    query @list : Union of intersections of has-kv conditions;
+    newer_than @string : "%Y-%m-%dT%H:%M:%SZ".
+    """
+    envelope = [float(bbox[key]) for key in ('w', 's', 'e', 'n',)]
+    nodes_in_bbox = "SELECT node.id, node.info_id FROM node WHERE node.geom && {}".format(ENVELOPE)
+    if gtype == "node":
+        spatial = "info.id IN (SELECT info_id FROM ({}) AS n)".format(nodes_in_bbox)
+        spatial_placeholders = envelope
+    elif gtype == "way":
+        spatial = """info.id IN (SELECT way_node.info_id FROM way_node
+            JOIN ({}) AS n ON n.id = way_node.node_id)""".format(nodes_in_bbox)
+        spatial_placeholders = envelope
+    else:
+        spatial = """info.id IN (SELECT relation.info_id FROM relation WHERE relation.member_id IN (
+            SELECT info_id FROM ({0}) AS n
+            UNION
+            SELECT way_node.info_id FROM way_node JOIN ({0}) AS n ON n.id = way_node.node_id
+        ))""".format(nodes_in_bbox)
+        spatial_placeholders = envelope*2
+
+    tags, tags_placeholders = query_sql(query)
+    sql = """SELECT info.id FROM info
+        WHERE info.source_name = 'osm' AND info.gtype = %s AND info.is_active = {true}
+        AND {spatial} AND {tags}""".format(
+        true = db._adapter.represent(True, 'boolean'),
+        spatial = spatial,
+        tags = tags
+    )
+    placeholders = [gtype]+spatial_placeholders+tags_placeholders
+    if not newer_than is None:
+        sql += " AND (info.attrs->>'timestamp') > %s"
+        placeholders.append(newer_than)
+    return [id for id, in db.executesql(sql, placeholders=placeholders)]
+
+def _element(gtype, source_id, tags, attributes, **kw):
+    """ Returns the Overpass JSON like dict of an element """
+    return dict(attributes or {}, type=gtype, id=int(source_id), tags=tags or {}, **kw)
+
+def fetch_elements(ids):
+    """ Returns the elements with the given info ids in the Overpass JSON format,
+    with the nodes of ways and the node and way members of relations (i.e.
+    recurse down as Overpass >).
+    ids @dict : {<gtype>: <info ids>}.
+    """
+    ids = {gtype: set(ids.get(gtype, ())) for gtype in GTYPES}
+
+    relations = []
+    if ids["relation"]:
+        members = {}
+        for info_id, member_id, gtype, source_id, role in db.executesql("""SELECT
+                relation.info_id, relation.member_id, minfo.gtype, minfo.source_id, relation.role
+            FROM relation JOIN info AS minfo ON minfo.id = relation.member_id
+            WHERE relation.info_id = ANY(%s)
+            ORDER BY relation.id""", placeholders=[list(ids["relation"])]):
+            members.setdefault(info_id, []).append(dict(type=gtype, ref=int(source_id), role=role or ""))
+            if gtype in ("node", "way",):
+                ids[gtype].add(member_id)
+        relations = [_element("relation", source_id, tags, attributes, members=members.get(info_id, []))
+            for info_id, source_id, tags, attributes in db.executesql("""SELECT
+                info.id, info.source_id, info.tags, info.attrs
+            FROM info WHERE info.id = ANY(%s)""", placeholders=[list(ids["relation"])])]
+
+    ways = []
+    if ids["way"]:
+        for _, source_id, tags, attributes, refs, node_ids in db.executesql("""SELECT
+                info.id, info.source_id, info.tags, info.attrs,
+                array_agg(ninfo.source_id ORDER BY way_node.sorting),
+                array_agg(ninfo.id)
+            FROM info
+            JOIN way_node ON way_node.info_id = info.id
+            JOIN node ON node.id = way_node.node_id
+            JOIN info AS ninfo ON ninfo.id = node.info_id
+            WHERE info.id = ANY(%s)
+            GROUP BY info.id""", placeholders=[list(ids["way"])]):
+            ways.append(_element("way", source_id, tags, attributes, nodes=list(map(int, refs))))
+            ids["node"].update(node_ids)
+
+    nodes = [_element("node", source_id, tags, attributes, lon=lon, lat=lat)
+        for source_id, tags, attributes, lon, lat in db.executesql("""SELECT
+                info.source_id, info.tags, info.attrs, ST_X(node.geom), ST_Y(node.geom)
+            FROM info JOIN node ON node.info_id = info.id
+            WHERE info.id = ANY(%s)""", placeholders=[list(ids["node"])])
+    ] if ids["node"] else []
+
+    return nodes+ways+relations
+
+def stale_tiles(bbox, zoom, max_age=MAX_AGE):
+    """ Returns the tiles of zoom covering bbox to be synced as
+    {'untracked': <(x, y, z) of tiles not tracked yet>,
+     'populate': <ids of tiles never populated>, 'update': <ids of tiles older than max_age>}
+    Read only, tiles are tracked by refresh.
+    """
+    tiles = {get_uri(tile.x, tile.y, tile.z): (tile.x, tile.y, tile.z,) for tile in mc.tiles(
+        *(float(bbox[key]) for key in ('w', 's', 'e', 'n',)), zooms=[zoom]
+    )}
+    out = {'untracked': [], 'populate': [], 'update': []}
+    tracked = set()
+    for id, uri, created_on, modified_on in db.executesql("""SELECT id, uri, created_on, modified_on
+        FROM tracked_tile WHERE uri = ANY(%s)""", placeholders=[list(tiles)]):
+        tracked.add(uri)
+        if created_on == modified_on:
+            out['populate'].append(id)
+        elif modified_on < now()-max_age:
+            out['update'].append(id)
+    out['untracked'] = [tile for uri, tile in tiles.items() if not uri in tracked]
+    return out
+
+def refresh(bbox, zoom, max_age=MAX_AGE, **kw):
+    """ Tracks the tiles covering bbox and syncs the stale ones (see: stale_tiles).
+    kw : See tools.sync_queued_tiles.
+
+    Returns the stale tiles that could not be synced (i.e. already being
+    synced by other workers or failed), see: stale_tiles.
+    """
+    # Imported here, tools depends on models
+    from .tilequeue import claim_tiles, free_tiles
+    from .tools import sync_queued_tiles
+
+    stale = stale_tiles(bbox, zoom, max_age=max_age)
+    untracked = stale.pop('untracked')
+    if untracked:
+        # Tiles are registered as never populated
+        stale['populate'].extend(register_tiles(untracked)['new'])
+        db.commit()
+    for mode, tile_ids in stale.items():
+        if not tile_ids:
+            continue
+        # Tiles already leased are being synced by other workers
+        qids = claim_tiles(db.tracked_tile.id.belongs(tile_ids), n=len(tile_ids))
+        if not qids:
+            continue
+        try:
+            sync_queued_tiles(qids, update=(mode=='update'), **kw)
+        finally:
+            free_tiles(*qids)
+    left = sum(stale_tiles(bbox, zoom, max_age=max_age).values(), [])
+    if left:
+        logger.warning("{} stale tiles could not be synced".format(len(left)))
+    return left
+
+def elements(lon, lat, qconditions, bdim=BASE_DIM, buffer=3, newer_than=None, max_age=MAX_AGE, sync=True, **kw):
+    """ Returns the elements satisfying qconditions around a point in the
+    Overpass JSON format, as Turbo would for the same conditions (see:
+    Turbo.optimize_centralized_query_by_base_tile).
+
+    lon @float :
+    lat @float :
+    qconditions @list : Query conditions given by distance from point;
+    bdim @float : Base tile dimension;
+    buffer @integer : Number of buffer tiles;
+    newer_than @string : "%Y-%m-%dT%H:%M:%SZ";
+    max_age @timedelta : Max age of tiles considered fresh;
+    sync @bool : Whether to sync stale tiles from Overpass first;
+    kw : See tools.sync_queued_tiles.
+    """
+    zoom = base_zoom(bdim)
+    ids = {gtype: set() for gtype in GTYPES}
+    for cond in Turbo.optimize_centralized_query_by_base_tile(lon, lat, qconditions,
+        bdim=bdim, buffer=buffer, newer_than=newer_than)():
+        if sync:
+            refresh(cond["bbox"], zoom, max_age=max_age, **kw)
+        for gtype in cond["gtypes"] or GTYPES:
+            ids[gtype].update(select_ids(gtype, cond["bbox"], cond["query"], newer_than=cond["newer_than"]))
+    return fetch_elements(ids)
+
+def result(*args, **kw):
+    """ Returns elements (see: elements) as an overpy.Result like Turbo """
+    return overpy.Result.from_json({"elements": elements(*args, **kw)})
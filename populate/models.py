@@ -4,7 +4,7 @@ import mercantile as mc
 
 from .tools import get_uri
 from ..models import db
-from .tile import boxtiles
+from .tile import boxtiles, polygontiles, BASE_DIM
 
 from py4web import Field
 import datetime
@@ -33,6 +33,10 @@ db.define_table("tracked_tile",
         writable = False, readable = True
     ),
     Field("is_active", "boolean", default=True, readable=False, writable=False),
+    # Watermark: all the changes before this timestamp have been synced
+    Field('synced_until', 'datetime', writable=False, readable=True),
+    # Tiles with higher priority are claimed first (see: tilequeue)
+    Field('priority', 'integer', default=0),
     # Field('task_id', "reference scheduler_task", notnull=True, requires=None),
     Field.Virtual('feature', lambda row: mc.feature(
         mc.quadkey_to_tile(mc.quadkey(row.tracked_tile.xtile, row.tracked_tile.ytile, row.tracked_tile.zoom)),
@@ -43,36 +47,104 @@ db.define_table("tracked_tile",
 )
 
 db.define_table("queued_tile",
-    Field("tile_id", "reference tracked_tile", unique=True)
+    Field("tile_id", "reference tracked_tile", unique=True),
+    # Claimed tiles are released when the lease expires (see: tilequeue)
+    Field("leased_until", "datetime"),
+    Field("worker")
 )
 
+# H3 alternative to tracked_tile (see: tools.tilesets)
+db.define_table("tracked_cell",
+    Field('h3index', required=True, unique=True, notnull=True),
+    Field('resolution', 'integer', required=True, notnull=True),
+    Field('created_on', 'datetime',
+        notnull = True,
+        default = now,
+        writable = False, readable = True
+    ),
+    Field('modified_on', 'datetime',
+        update = now,
+        default = now,
+        writable = False, readable = True
+    ),
+    Field("is_active", "boolean", default=True, readable=False, writable=False),
+    Field('synced_until', 'datetime', writable=False, readable=True),
+    Field('priority', 'integer', default=0),
+)
+
+def register_tiles(tiles):
+    """ Registers tiles in bulk with one single statement.
+    tiles @iterable : (<xtile>, <ytile>, <zoom>) tuples.
+
+    returns:
+        {'new': <ids of the registered tiles>, 'old': <ids of the ones already tracked>}
+    """
+    tiles = list(tiles)
+    if not tiles:
+        return {'new': [], 'old': []}
+    xtiles, ytiles, zooms = map(list, zip(*tiles))
+    uris = [get_uri(*tile) for tile in tiles]
+    # created_on==modified_on marks tiles never populated (see: tilequeue)
+    timestamp = now()
+    new = [id for id, in db.executesql("""INSERT INTO tracked_tile (xtile, ytile, zoom, uri, created_on, modified_on, is_active, priority)
+        SELECT v.xtile, v.ytile, v.zoom, v.uri, %s, %s, {true}, 0
+        FROM unnest(%s::integer[], %s::integer[], %s::integer[], %s::text[]) AS v(xtile, ytile, zoom, uri)
+        ON CONFLICT (uri) DO NOTHING
+        RETURNING id""".format(true=db._adapter.represent(True, 'boolean')),
+        placeholders = [timestamp, timestamp, xtiles, ytiles, zooms, uris]
+    )]
+    _new = set(new)
+    old = [id for id, in db.executesql("SELECT id FROM tracked_tile WHERE uri = ANY(%s)",
+        placeholders = [uris]
+    ) if not id in _new]
+    return {'new': new, 'old': old}
+
 def track_tiles(lon, lat, maxdist, buffer=4):
-    """ """
+    """ Tracks the base tiles around a point """
 
     tiles = list(boxtiles(maxdist, lon, lat, buffer=buffer))
+    return dict(register_tiles(tiles), tiles=tiles)
+
+def track_polygon(geom, bdim=BASE_DIM):
+    """ Tracks the base tiles intersecting a polygon
+    geom : Shapely geometry or GeoJSON like geometry dict (lon/lat coordinates).
+    """
+
+    tiles = list(polygontiles(geom, bdim=bdim))
+    return dict(register_tiles(tiles), tiles=tiles)
 
-    get_uri = lambda x, y, z: db.tracked_tile.uri.compute({'xtile': x, 'ytile': y, 'zoom': z})
-    _tiles_i_got = db(
-        db.tracked_tile.uri.belongs(map(lambda xyz: get_uri(*xyz), tiles))
-    ).select()
+def track_cells(cells):
+    """ Registers H3 cells in bulk with one single statement.
+    cells @iterable : H3 indexes.
 
-    tiles_i_got = {r.uri: r for r in _tiles_i_got}
+    returns:
+        {'new': <ids of the registered cells>, 'old': <ids of the ones already tracked>}
+    """
+    from h3 import h3_get_resolution
 
-    _d = lambda xtile, ytile, zoom: vars()
+    cells = list(cells)
+    if not cells:
+        return {'new': [], 'old': []}
+    timestamp = now()
+    new = [id for id, in db.executesql("""INSERT INTO tracked_cell (h3index, resolution, created_on, modified_on, is_active, priority)
+        SELECT v.h3index, v.resolution, %s, %s, {true}, 0
+        FROM unnest(%s::text[], %s::integer[]) AS v(h3index, resolution)
+        ON CONFLICT (h3index) DO NOTHING
+        RETURNING id""".format(true=db._adapter.represent(True, 'boolean')),
+        placeholders = [timestamp, timestamp, cells, list(map(h3_get_resolution, cells))]
+    )]
+    _new = set(new)
+    old = [id for id, in db.executesql("SELECT id FROM tracked_cell WHERE h3index = ANY(%s)",
+        placeholders = [cells]
+    ) if not id in _new]
+    return {'new': new, 'old': old}
 
-    def _loopOtiles():
-        for xtile, ytile, zoom in tiles:
-            myuri = get_uri(xtile, ytile, zoom)
-            if not myuri in tiles_i_got:
-                yield db.tracked_tile.insert(**_d(xtile, ytile, zoom))
-            # elif tiles_i_got[myuri].last_update is None:
-            #     yield tiles_i_got[myuri].id
+def track_polygon_cells(geom, resolution=None, bdim=BASE_DIM):
+    """ Tracks the H3 cells covering a polygon (see: tools.tilesets.h3_polyfill) """
+    from ..tools.tilesets import h3_polyfill
 
-    return {
-        'new': list(_loopOtiles()),
-        'old': [row.id for row in _tiles_i_got],
-        'tiles': tiles
-    }
+    cells = list(h3_polyfill(geom, resolution=resolution, bdim=bdim))
+    return dict(track_cells(cells), cells=cells)
 
 # if __name__=='__main__':
 #     track_tiles(8.938015, 44.405762, 0)
@@ -0,0 +1,258 @@
+# -*- coding: utf-8 -*-
+
+"""
+Asynchronous Overpass client.
+
+Many queries (e.g. one for each reserved tile) are submitted at once, with
+at most concurrency requests in flight for each endpoint and a token bucket
+limiting the request rate. A 429 (Too Many Requests) response empties the
+bucket of the endpoint for the time suggested by its Retry-After header,
+without blocking the other requests already in flight.
+
+The event loop runs in a background thread and responses are handed to the
+writer callback in the calling thread as soon as they arrive, so that slow
+writes (e.g. db imports) never stall the downloads in flight.
+
+aiohttp is used when installed, otherwise requests are run by urllib in
+the default thread pool executor.
+"""
+
+import asyncio
+import queue
+import threading
+from time import monotonic
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+from urllib.request import urlopen
+from urllib.error import HTTPError
+
+import overpy
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+import logging
+logger = logging.getLogger(__name__)
+
+DEFAULT_URL = overpy.Overpass.default_url
+
+def retry_after(value, default):
+    """ Returns the seconds to wait according to a Retry-After header value
+    (delay in seconds or HTTP date).
+    """
+    if not value:
+        return default
+    try:
+        return max(0., float(value))
+    except ValueError:
+        try:
+            when = parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return default
+        return max(0., (when-datetime.now(timezone.utc)).total_seconds())
+
+
+class TokenBucket(object):
+    """ Async token bucket rate limiter """
+
+    def __init__(self, rate=1., capacity=2):
+        """
+        rate   @float : Tokens added per second;
+        capacity @int : Max number of tokens (i.e. burst size).
+        """
+        super(TokenBucket, self).__init__()
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = monotonic()
+        self.paused_until = 0.
+
+    def _refill(self):
+        now = monotonic()
+        if now < self.paused_until:
+            self.updated = now
+            return
+        start = max(self.updated, self.paused_until)
+        self.tokens = min(self.capacity, self.tokens+(now-start)*self.rate)
+        self.updated = now
+
+    async def acquire(self):
+        while True:
+            self._refill()
+            now = monotonic()
+            if now >= self.paused_until and self.tokens >= 1:
+                self.tokens -= 1
+                return
+            if now < self.paused_until:
+                wait = self.paused_until-now
+            else:
+                wait = (1-self.tokens)/self.rate
+            await asyncio.sleep(wait)
+
+    def pause(self, seconds):
+        """ Empties the bucket and stops refilling it for the given seconds """
+        self.tokens = 0
+        self.paused_until = max(self.paused_until, monotonic()+seconds)
+
+
+class Endpoint(object):
+    """ Limits of an Overpass endpoint """
+
+    def __init__(self, url=DEFAULT_URL, concurrency=2, rate=1., burst=2):
+        """
+        url        @string : Overpass interpreter url;
+        concurrency   @int : Max number of requests in flight;
+        rate        @float : Max number of requests started per second;
+        burst         @int : Max number of requests started at once.
+        """
+        super(Endpoint, self).__init__()
+        self.url = url
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.bucket = TokenBucket(rate=rate, capacity=burst)
+
+
+class AsyncOverpass(object):
+    """ Concurrent Overpass client """
+
+    max_retry_count = overpy.Overpass.default_max_retry_count
+    retry_timeout = overpy.Overpass.default_retry_timeout
+    timeout = 300
+
+    def __init__(self, url=DEFAULT_URL, concurrency=2, rate=1., burst=2):
+        """ See: Endpoint """
+        super(AsyncOverpass, self).__init__()
+        self.url = url
+        self.limits = dict(concurrency=concurrency, rate=rate, burst=burst)
+        self.session = None
+        self.endpoint = None
+
+    async def __aenter__(self):
+        # Semaphores are bound to the running loop
+        self.endpoint = Endpoint(self.url, **self.limits)
+        if not aiohttp is None:
+            self.session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=self.timeout))
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        if not self.session is None:
+            await self.session.close()
+            self.session = None
+
+    async def _post(self, query):
+        """ Returns (<status>, <headers>, <body>) """
+        if not self.session is None:
+            async with self.session.post(self.url, data=query) as response:
+                return response.status, response.headers, await response.read()
+
+        def _urlopen():
+            try:
+                f = urlopen(self.url, query, timeout=self.timeout)
+            except HTTPError as err:
+                f = err
+            with f:
+                return f.code, f.headers, f.read()
+
+        return await asyncio.get_running_loop().run_in_executor(None, _urlopen)
+
+    async def fetch(self, query):
+        """ Returns the raw response of query.
+        query @string : The query in Overpass QL or XML.
+        """
+        if not isinstance(query, bytes):
+            query = query.encode("utf-8")
+        endpoint = self.endpoint
+        exceptions = []
+        for retry in range(self.max_retry_count+1):
+            await endpoint.bucket.acquire()
+            async with endpoint.semaphore:
+                status, headers, body = await self._post(query)
+            if status == 200:
+                return body
+            elif status == 400:
+                raise overpy.exception.OverpassBadRequest(query, msgs=None)
+            elif status == 429:
+                wait = retry_after(headers.get("Retry-After"), self.retry_timeout*(retry+1))
+                logger.info("Too many requests to {}, waiting {} seconds".format(self.url, wait))
+                # Slows down all the requests to the endpoint
+                endpoint.bucket.pause(wait)
+                exceptions.append(overpy.exception.OverpassTooManyRequests())
+            elif status == 504:
+                exceptions.append(overpy.exception.OverpassGatewayTimeout())
+                await asyncio.sleep(self.retry_timeout*(retry+1))
+            else:
+                exceptions.append(overpy.exception.OverpassUnknownHTTPStatusCode(status))
+                await asyncio.sleep(self.retry_timeout*(retry+1))
+        raise overpy.exception.MaxRetriesReached(retry_count=self.max_retry_count+1, exceptions=exceptions)
+
+    async def _fetch_item(self, key, query):
+        return key, await self.fetch(query)
+
+    async def fetch_all(self, queries, writer):
+        """ Fetches all queries concurrently and calls writer(<key>, <raw response>)
+        as responses arrive, in the thread running the event loop.
+
+        queries @dict : {<key>: <query>};
+        writer @callable :
+
+        Returns the dict of exceptions raised by failed queries (or by writer) by key.
+        """
+        failures = {}
+        tasks = {asyncio.ensure_future(self._fetch_item(key, query)): key for key, query in queries.items()}
+        pending = set(tasks)
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                key = tasks[task]
+                try:
+                    writer(*task.result())
+                except Exception as err:
+                    logger.warning("Query {} failed: {}".format(key, err))
+                    failures[key] = err
+        return failures
+
+
+def fetch_all(queries, writer, url=DEFAULT_URL, **kw):
+    """ Blocking entry point of AsyncOverpass.fetch_all
+    queries @dict : {<key>: <query>};
+    writer @callable : Called as writer(<key>, <raw response>) in this thread
+        while the other requests go on;
+    url @string : Overpass interpreter url;
+    kw : Endpoint limits (see: Endpoint).
+
+    Returns the dict of exceptions raised by failed queries (or by writer) by key.
+    """
+    responses = queue.Queue()
+    # Written by the loop thread, read after join
+    outcome = {}
+
+    async def _main():
+        async with AsyncOverpass(url, **kw) as client:
+            return await client.fetch_all(queries, lambda key, raw_data: responses.put((key, raw_data,)))
+
+    def _run():
+        try:
+            outcome["failures"] = asyncio.run(_main())
+        except BaseException as err:
+            outcome["error"] = err
+        finally:
+            responses.put(None)
+
+    thread = threading.Thread(target=_run, name="overpass-fetch", daemon=True)
+    thread.start()
+    failures = {}
+    while True:
+        item = responses.get()
+        if item is None:
+            break
+        key, raw_data = item
+        try:
+            writer(key, raw_data)
+        except Exception as err:
+            logger.warning("Writing {} failed: {}".format(key, err))
+            failures[key] = err
+    thread.join()
+    if "error" in outcome:
+        raise outcome["error"]
+    return dict(outcome["failures"], **failures)
@@ -1,7 +1,6 @@
 # -*- coding: utf-8 -*-
 
 import os
-import hashlib
 import geojson
 import overpy
 # from lxml import etree
@@ -15,6 +14,9 @@ from urllib.error import HTTPError
 from io import BytesIO
 
 from .geom import Bbox, BASE_AREA_DIMENSION
+from .cache import ResponseCache
+from .tagfilter import condition
+from .aio import retry_after
 from ...tools.tile import BASE_DIM, tilebbox
 
 class MaxRetriesReached(overpy.exception.OverPyException):
@@ -40,17 +42,30 @@ class Turbo(object):
 
     default_base_resource_path = ""
 
+    # Response cache settings (see: ResponseCache)
+    # Directory of the on disk tier, if None responses are cached in memory only
+    cache_path = None
+    cache_ttl = 3600
+    cache_max_bytes = 256*1024**2
+    cache_max_items = 32
+
     def __init__(self, *args, **kw):
-        self.__cache__ = {}
+        # Shared by all instances with the same settings
+        self.__cache__ = ResponseCache.shared(
+            path = self.cache_path,
+            ttl = self.cache_ttl,
+            max_bytes = self.cache_max_bytes,
+            max_items = self.cache_max_items
+        )
         self.api = overpy.Overpass(*args, **kw)
 
-    def __raw_call__(self, query):
-        """ Reimplements the call to Overpass Turbo web service for DEBUG purposes only.
+    def raw_query(self, query):
+        """ Returns the raw response of query from the Overpass web service.
         Courtesy of: https://github.com/DinoTools/python-overpy/blob/4b5ace5baf854dd84dbfea955d0c67f602bd754d/overpy/__init__.py#L113
-        Query the Overpass API
-        :param String|Bytes query: The query string in Overpass QL
-        :return: The parsed result
-        :rtype: overpy.Result
+        Failed requests are retried as in overpy.Overpass.query, bad requests
+        (400) are not. Every failure is recorded in the MaxRetriesReached
+        exception raised when retries are over.
+        query @string/bytes : The query in Overpass QL or XML.
         """
 
         try:
@@ -63,143 +78,78 @@ class Turbo(object):
         except AttributeError:
             retry_timeout = self.api.default_retry_timeout
 
-        read_chunk_size = 4096
-
         if not isinstance(query, bytes):
             query = query.encode("utf-8")
 
-        retry_num = 0
         retry_exceptions = []
-        do_retry = True if max_retry_count > 0 else False
-        while retry_num <= max_retry_count:
+        wait = 0
+        for retry_num in range(max_retry_count+1):
             if retry_num > 0:
-                sleep(retry_timeout)
-            retry_num += 1
-            t0 = datetime.now()
+                sleep(max(wait, retry_timeout))
+            wait = 0
             try:
                 f = urlopen(self.api.url, query)
-            except HTTPError as e:
-                f = e
-            else:
-                dt = datetime.now()-t0
+            except HTTPError as err:
+                f = err
 
-            response = f.read(read_chunk_size)
-            while True:
-                data = f.read(read_chunk_size)
-                if len(data) == 0:
-                    break
-                response = response + data
-            f.close()
+            with f:
+                response = f.read()
 
             if f.code == 200:
-
-                if PY2:
-                    http_info = f.info()
-                    content_type = http_info.getheader("content-type")
-                else:
-                    content_type = f.getheader("Content-Type")
-
+                content_type = f.getheader("Content-Type")
                 if content_type in ("application/json", "application/osm3s+xml",):
-                    return response, dt
-
-                e = overpy.exception.OverpassUnknownContentType(content_type)
-                if not do_retry:
-                    raise e
-                retry_exceptions.append(e)
-                continue
-
-            if f.code == 400:
-                e = overpy.exception.OverpassBadRequest(query, msgs=None)
-                if not do_retry:
-                    raise e
-                retry_exceptions.append(e)
-                continue
-
-            if f.code == 429:
-                e = overpy.exception.OverpassTooManyRequests
-                if not do_retry:
-                    raise e
-                retry_exceptions.append(e)
-                continue
-
-            if f.code == 504:
-                e = overpy.exception.OverpassGatewayTimeout
-                if not do_retry:
-                    raise e
-                retry_exceptions.append(e)
-                continue
-
-        raise overpy.exception.MaxRetriesReached(retry_count=retry_num, exceptions=retry_exceptions)
+                    return response
+                retry_exceptions.append(overpy.exception.OverpassUnknownContentType(content_type))
+            elif f.code == 400:
+                raise overpy.exception.OverpassBadRequest(query, msgs=None)
+            elif f.code == 429:
+                wait = retry_after(f.headers.get("Retry-After"), retry_timeout)
+                retry_exceptions.append(overpy.exception.OverpassTooManyRequests())
+            elif f.code == 504:
+                retry_exceptions.append(overpy.exception.OverpassGatewayTimeout())
+            else:
+                retry_exceptions.append(overpy.exception.OverpassUnknownHTTPStatusCode(f.code))
+
+        raise overpy.exception.MaxRetriesReached(retry_count=max_retry_count+1, exceptions=retry_exceptions)
 
     def __fake_call__(self, query, *args, **kw):
-        """ Caches responses for DEBUG purposes only """
-
-        queryhash = hashlib.new('sha224')
-        queryhash.update(query)
-        querychecksum = queryhash.hexdigest()
-
-        rp = os.path.join(self.default_base_resource_path, "resources", querychecksum)
-
-        resource_file = os.path.normpath(rp)
-
-        if not os.path.isfile(resource_file):
-            if not os.path.exists(os.path.dirname(resource_file)):
-                try:
-                    os.makedirs(os.path.dirname(resource_file))
-                except OSError as exc: # Guard against race condition
-                    if exc.errno != errno.EEXIST:
-                        raise
-
-            raw_data, dt = self.__raw_call__(query)
-
-            if not raw_data is None:
-                with open(resource_file, "w") as res:
-                    res.write(raw_data)
-            data_dim = os.stat(resource_file).st_size
-            delta_sec = dt.total_seconds()
-            logger.info("Retrieved {} bytes in {} seconds (at a speed of {} Bps)".format(
-                data_dim, delta_sec,
-                data_dim/delta_sec
-            ))
-
-        assert os.path.isfile(resource_file), "File Not Found!"
-        with open(resource_file, mode='rb') as myxml:
-            body = myxml.read()
-        return self.api.parse_json(body) #.nodes
-
-    def __call__(self, query, *args, **kw):
+        """ Calls the Overpass web service with a disk cache under
+        default_base_resource_path for DEBUG purposes only
         """
-        query @string : The OSM query ready to be submitted to the Overpass web service.
+        cache = ResponseCache.shared(
+            path = os.path.join(self.default_base_resource_path, "resources"),
+            ttl = float("inf"),
+            max_bytes = self.cache_max_bytes,
+            max_items = self.cache_max_items
+        )
+        return cache(query, fetch=self.raw_query, parse=self.parse)
+
+    def parse(self, raw_data, **kw):
+        """ Parses a raw JSON or XML Overpass response
+        kw : Parser options (see: overpy.Overpass.parse_json and parse_xml).
         """
+        if raw_data.lstrip()[:1] == b"<":
+            return self.api.parse_xml(raw_data, **kw)
+        return self.api.parse_json(raw_data, **kw)
 
-        queryhash = hashlib.new('sha224')
-        queryhash.update(query)
-        querychecksum = queryhash.hexdigest()
+    def fetch(self, query):
+        """ Returns the raw response of query, from cache when available
+        query @string : The OSM query ready to be submitted to the Overpass web service.
+        """
+        return self.__cache__.raw(query, fetch=self.raw_query)
 
-        try:
-            response = self.__cache__[querychecksum]["response"]
-            assert not response is None, "This should never happen, why it happens?"
-        except (KeyError, AssertionError,):
-            for t in range(1, 4):
-                try:
-                    response = self.api.query(query, *args, **kw) #.nodes
-                    assert not response is None, "This should never happen, why it happens?"
-                except (
-                    overpy.exception.OverpassTooManyRequests,
-                    overpy.exception.OverpassGatewayTimeout,
-                    AssertionError,
-                ):
-                    sleep(t*overpy.Overpass.retry_timeout)
-                    continue
-                else:
-                    self.__cache__[querychecksum] = {
-                        "response": response,
-                        "query": query
-                    }
-                    return self.__cache__[querychecksum]["response"]
-            raise
-        else:
-            return response # self.__cache__[querychecksum]["response"]
+    def __call__(self, query, cache=True, **kw):
+        """ Returns the parsed response of query, from cache when available
+        query @string : The OSM query ready to be submitted to the Overpass web service;
+        cache @bool : Whether to use the response cache;
+        kw : Parser options (see: parse).
+        """
+        if not cache:
+            return self.parse(self.raw_query(query), **kw)
+        elif kw:
+            # Parsed responses are cached with the default options only
+            return self.parse(self.fetch(query), **kw)
+        return self.__cache__(query, fetch=self.raw_query, parse=self.parse)
 
     def nodes(self, *args, **kw):
         return self(*args, **kw)
@@ -366,46 +316,16 @@ class Turbo(object):
     @staticmethod
     def check(tags, k, modv=None, **kw):
         """
-        Evalluates whether the OSM node properties respect the single filter condition.
+        Evaluates whether the OSM node properties respect the single filter condition.
         Returns boolean.
 
-        properties @dict : The node tags (at leas object must support __getitem__);
+        tags       @dict : The node tags (at least object must support __getitem__);
         k        @string : The OSM Overpass Turbo condition tag key;
-        modv     @string : The OSM Overpass Turbo condition operator (None/"not").
-                           If modv is None a value for "regv" must be provided
-                           (NOTE: at the moment the only supported value for
-                           "regv" is the wildcard ".")
-        v        @string : (If provided) is the OSM Overpass Turbo queried tag value.
-
-        || WARNINNG! It's a very raw implementation but enough good for       ||
-        || our actual purposes.                                               ||
-        """
-
-        def _check():
+        modv     @string : The OSM Overpass Turbo condition operator (None/"not");
+        v        @string : (If provided) is the OSM Overpass Turbo queried tag value;
+        regv     @string : (If provided) regular expression the tag value must match;
+        case     @string : "ignore" for case insensitive regular expressions.
 
-            try:
-                rvalue = tags[k]
-            except KeyError:
-                return False
-            else:
-                try:
-                    cvalue = kw["v"]
-                except KeyError:
-                    try:
-                        cvalue = kw["regv"]
-                    except KeyError:
-                        return True
-                    else:
-                        if cvalue==".":
-                            return True
-                        else:
-                            raise NotImplementedError("Filter not yet supported.")
-                else:
-                    return not cvalue or cvalue==rvalue
-
-        if not modv:
-            return _check()
-        elif modv=="not":
-            return not _check()
-        else:
-            raise NotImplementedError("Operator not yet supported")
+        To evaluate whole qconditions at once see: tagfilter.compile_qconditions
+        """
+        return condition(k=k, modv=modv, **kw)(tags)
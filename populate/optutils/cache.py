@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+
+"""
+Overpass response cache.
+
+Two tiers:
+    * memory: an LRU of parsed responses, so repeated queries in a process
+      don't even hit the JSON parser;
+    * disk (optional): zlib compressed raw responses stored by content
+      checksum (identical responses of different queries are stored once)
+      with an sqlite index of queries, expiration times and sizes.
+      The total size is kept below max_bytes evicting the least recently
+      used entries.
+
+Entries expire after ttl seconds. For queries filtered by a "newer" timestamp
+the ttl is also limited to the time elapsed since that timestamp, so the
+cached answer of a small incremental sync is not reused for longer than the
+window it covers.
+"""
+
+import os, re, zlib, sqlite3, hashlib, tempfile
+from collections import OrderedDict
+from contextlib import closing, contextmanager
+from threading import Lock
+from time import time
+from datetime import datetime, timezone
+
+# Matches both XML (<newer than="..."/>) and QL ((newer:"...")) filters
+_newer = re.compile(r"""newer(?:\s+than=|:)\s*["']([0-9]{4}-[0-9]{2}-[0-9]{2}T[0-9:]+Z)["']""")
+
+def querykey(query):
+    """ Returns the checksum of a query (string or bytes) """
+    if not isinstance(query, bytes):
+        query = query.encode("utf-8")
+    return hashlib.sha224(query).hexdigest()
+
+def newer_than(query):
+    """ Returns the most recent "newer" filter timestamp of query as epoch seconds """
+    if isinstance(query, bytes):
+        query = query.decode("utf-8")
+    stamps = [
+        datetime.strptime(stamp, "%Y-%m-%dT%H:%M:%SZ").replace(tzinfo=timezone.utc).timestamp()
+        for stamp in _newer.findall(query)
+    ]
+    return max(stamps) if stamps else None
+
+
+class ResponseCache(object):
+    """ Size bounded two tier (memory and disk) cache of Overpass responses """
+
+    __shared__ = {}
+
+    def __init__(self, path=None, ttl=3600, min_ttl=60, max_bytes=256*1024**2, max_items=32, level=6):
+        """
+        path   @string : Directory of the disk tier (default: no disk tier);
+        ttl       @int : Max life of entries in seconds;
+        min_ttl   @int : Min life of entries filtered by a "newer" timestamp;
+        max_bytes @int : Max size of the compressed disk tier;
+        max_items @int : Max number of parsed responses kept in memory;
+        level     @int : zlib compression level.
+        """
+        super(ResponseCache, self).__init__()
+        self.path = path
+        self.ttl = ttl
+        self.min_ttl = min_ttl
+        self.max_bytes = max_bytes
+        self.max_items = max_items
+        self.level = level
+        self.memory = OrderedDict()
+        self.lock = Lock()
+        if path is not None:
+            os.makedirs(os.path.join(path, "objects"), exist_ok=True)
+            with self._index() as conn:
+                conn.execute("""CREATE TABLE IF NOT EXISTS entry (
+                    key TEXT PRIMARY KEY,
+                    checksum TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    expires REAL NOT NULL,
+                    accessed REAL NOT NULL
+                )""")
+                conn.execute("CREATE INDEX IF NOT EXISTS entry_checksum ON entry (checksum)")
+
+    @classmethod
+    def shared(cls, **kw):
+        """ Returns the process wide cache instance with the given configuration """
+        key = tuple(sorted(kw.items()))
+        try:
+            return cls.__shared__[key]
+        except KeyError:
+            return cls.__shared__.setdefault(key, cls(**kw))
+
+    def expires(self, query, now=None):
+        """ Returns the expiration time of the response of query """
+        now = now or time()
+        ttl = self.ttl
+        since = newer_than(query)
+        if not since is None:
+            ttl = min(ttl, max(self.min_ttl, now-since))
+        return now+ttl
+
+    # Memory tier
+
+    def recall(self, key):
+        """ Returns the parsed response cached in memory or None """
+        with self.lock:
+            try:
+                expires, value = self.memory[key]
+            except KeyError:
+                return None
+            if expires < time():
+                del self.memory[key]
+                return None
+            self.memory.move_to_end(key)
+            return value
+
+    def remember(self, key, value, expires):
+        with self.lock:
+            self.memory[key] = (expires, value,)
+            self.memory.move_to_end(key)
+            while len(self.memory) > self.max_items:
+                self.memory.popitem(last=False)
+
+    # Disk tier
+
+    @contextmanager
+    def _index(self):
+        """ Yields a connection to the index, committed (or rolled back)
+        and closed on exit.
+        """
+        with closing(sqlite3.connect(os.path.join(self.path, "index.sqlite"), timeout=60)) as conn:
+            with conn:
+                yield conn
+
+    def _object_path(self, checksum):
+        return os.path.join(self.path, "objects", checksum[:2], checksum[2:])
+
+    def load(self, key):
+        """ Returns the raw response stored on disk and its expiration time
+        or (None, None).
+        """
+        if self.path is None:
+            return None, None
+        now = time()
+        with self._index() as conn:
+            row = conn.execute("SELECT checksum, expires FROM entry WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None, None
+            checksum, expires = row
+            if expires < now:
+                self._evict(conn, [key])
+                return None, None
+            conn.execute("UPDATE entry SET accessed = ? WHERE key = ?", (now, key,))
+        try:
+            with open(self._object_path(checksum), "rb") as obj:
+                return zlib.decompress(obj.read()), expires
+        except (OSError, zlib.error):
+            with self._index() as conn:
+                self._evict(conn, [key])
+            return None, None
+
+    def store(self, key, data, expires):
+        """ Stores a raw response on disk """
+        if self.path is None:
+            return
+        checksum = hashlib.sha224(data).hexdigest()
+        filepath = self._object_path(checksum)
+        if not os.path.isfile(filepath):
+            os.makedirs(os.path.dirname(filepath), exist_ok=True)
+            # Atomic write
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(filepath))
+            with os.fdopen(fd, "wb") as obj:
+                obj.write(zlib.compress(data, self.level))
+            os.replace(tmp, filepath)
+        size = os.path.getsize(filepath)
+        with self._index() as conn:
+            conn.execute("INSERT OR REPLACE INTO entry VALUES (?, ?, ?, ?, ?)",
+                (key, checksum, size, expires, time(),))
+            self._shrink(conn)
+
+    def _evict(self, conn, keys):
+        """ Removes entries and the objects no longer referenced """
+        checksums = set()
+        for key in keys:
+            row = conn.execute("SELECT checksum FROM entry WHERE key = ?", (key,)).fetchone()
+            if not row is None:
+                conn.execute("DELETE FROM entry WHERE key = ?", (key,))
+                checksums.add(row[0])
+        for checksum in checksums:
+            if conn.execute("SELECT 1 FROM entry WHERE checksum = ? LIMIT 1", (checksum,)).fetchone() is None:
+                try:
+                    os.remove(self._object_path(checksum))
+                except FileNotFoundError:
+                    pass
+
+    def _shrink(self, conn):
+        """ Drops expired entries and then the least recently used ones
+        until the stored objects fit into max_bytes.
+        """
+        self._evict(conn, [key for key, in conn.execute(
+            "SELECT key FROM entry WHERE expires < ?", (time(),)
+        )])
+        # Objects shared by more entries are counted once
+        total, = conn.execute("SELECT coalesce(sum(size), 0) FROM (SELECT DISTINCT checksum, size FROM entry)").fetchone()
+        if total <= self.max_bytes:
+            return
+        for key, checksum, size in conn.execute(
+            "SELECT key, checksum, size FROM entry ORDER BY accessed"
+        ).fetchall():
+            shared, = conn.execute("SELECT count(*) FROM entry WHERE checksum = ?", (checksum,)).fetchone()
+            self._evict(conn, [key])
+            if shared == 1:
+                total -= size
+            if total <= self.max_bytes:
+                break
+
+    def clear(self):
+        """ Empties both tiers """
+        with self.lock:
+            self.memory.clear()
+        if not self.path is None:
+            with self._index() as conn:
+                self._evict(conn, [key for key, in conn.execute("SELECT key FROM entry")])
+
+    def _raw(self, key, query, fetch):
+        data, expires = self.load(key)
+        if data is None:
+            data, expires = fetch(query), self.expires(query)
+            self.store(key, data, expires)
+        return data, expires
+
+    def raw(self, query, fetch):
+        """ Returns the raw response of query.
+        fetch @callable : Called with query on cache miss, returns the raw response.
+        """
+        data, _ = self._raw(querykey(query), query, fetch)
+        return data
+
+    def __call__(self, query, fetch, parse):
+        """ Returns the parsed response of query.
+        fetch @callable : Called with query on cache miss, returns the raw response;
+        parse @callable : Called with the raw response, returns the parsed one.
+        """
+        key = querykey(query)
+        response = self.recall(key)
+        if response is None:
+            data, expires = self._raw(key, query, fetch)
+            response = parse(data)
+            self.remember(key, response, expires)
+        return response
@@ -1,14 +1,23 @@
 # -*- coding: utf-8 -*-
 
-import pyproj
 import geojson
+import numpy as np
+
+from ...tools.proj import transform, WGS84
 
 base_proj = "epsg:3857"
-osmproj = pyproj.Proj(base_proj)
 
 BASE_AREA_DIMENSION = 200
 MIN_INFLUENCE_DISTANCE = 200
 
+def _ring(minx, miny, maxx, maxy):
+    """ Returns the closed ring of a box """
+    return (minx, miny,), \
+        (maxx, miny,), \
+        (maxx, maxy,), \
+        (minx, maxy,), \
+        (minx, miny,),
+
 class GeoDict2(dict):
     """docstring for GeoDict2."""
 
@@ -63,8 +72,7 @@ class GeoDict2(dict):
         try:
             feat = self.geom[crs].feature
         except KeyError:
-            myproj = pyproj.Proj(crs)
-            e, n = myproj(*self.geom["epsg:4326"].xy)
+            e, n = transform(*self.geom["epsg:4326"].xy, dst=crs)
             geom = Point(e, n, type="EPSG", properties={'code': crs.split(":")[1]})
             feat = geom.feature
         return geojson.Feature(geometry=feat.geometry, id=self.id, properties=dict(self.properties, **kw))
@@ -124,8 +132,7 @@ class Bbox(GeoDict2):
         _crss = set([crs for crs in crss if crs!="epsg:4326"] + [base_proj])
 
         def _ring(crs):
-            myproj = pyproj.Proj(crs)
-            e, n = myproj(lon, lat)
+            e, n = transform(lon, lat, dst=crs)
             mine = e - buffer
             maxe = e + buffer
             minn = n - buffer
@@ -139,9 +146,12 @@ class Bbox(GeoDict2):
         # import pdb; pdb.set_trace()
         geom = dict([Polygon.factory((_r,), crs=_crs) for _crs,_r in ((a,b) for a,b in (_ring(crs) for crs in _crss))])
 
-        myproj = pyproj.Proj(_crs)
-        minlon, minlat = myproj(*map(min, zip(*_r)), inverse=True)
-        maxlon, maxlat = myproj(*map(max, zip(*_r)), inverse=True)
+        # Lower left and upper right corners back to longitude and latitude at once
+        ll, _, ur, _, _ = _ring(base_proj)[1]
+        (minlon, maxlon), (minlat, maxlat) = transform((ll[0], ur[0],), (ll[1], ur[1],),
+            src = base_proj,
+            dst = WGS84
+        )
         _ring = (minlon, minlat,), \
             (maxlon, minlat,), \
             (maxlon, maxlat,), \
@@ -205,16 +215,54 @@ class Bbox(GeoDict2):
         keys = ("w", "s", "e", "n",)
         return dict(zip(keys, map(str, values)))
 
-    def split(self, n=10):
-        incr = self.buffer * 2 / float(n)
-        first = incr/2.
-        coordinates = self.coordinates()[0][0]
-        cellcoords = []
-        side = first
-        for i in range(n):
-            for j in range(n):
-                est, nord = osmproj( coordinates[0] + first + (incr*i), coordinates[1] + first + (incr*j) , inverse=True)
-                yield Bbox.bufferfactory(est, nord, side)
+    def grid(self, n=10, crss=(base_proj,)):
+        """ Returns the bounds of the n*n cells of the bbox (see: split) by crs
+        as {<crs>: (<minx array>, <miny array>, <maxx array>, <maxy array>)},
+        cells ordered by column.
+        n     @int : Number of cells on each side;
+        crss @list : A list of valid crs (EPSG:3857 and EPSG:4326 are always included).
+        """
+        side = self.buffer / float(n)
+        minx, miny = self.coordinates()[0][0]
+        offsets = side*(2*np.arange(n)+1)
+        cx, cy = np.meshgrid(minx+offsets, miny+offsets, indexing="ij")
+        cx, cy = cx.ravel(), cy.ravel()
+        cells = n*n
+
+        # Corners and centers back to longitude and latitude in a single call
+        lons, lats = transform(
+            np.concatenate((cx-side, cx+side, cx,)),
+            np.concatenate((cy-side, cy+side, cy,)),
+            src = base_proj,
+            dst = WGS84
+        )
+
+        bounds = {
+            base_proj: (cx-side, cy-side, cx+side, cy+side,),
+            WGS84: (lons[:cells], lats[:cells], lons[cells:2*cells], lats[cells:2*cells],)
+        }
+        for crs in set(crss)-set(bounds):
+            x, y = transform(lons[2*cells:], lats[2*cells:], dst=crs)
+            bounds[crs] = (x-side, y-side, x+side, y+side,)
+        return bounds
+
+    def split(self, n=10, crss=(base_proj,)):
+        """ Yields the n*n cells of the bbox as Bbox objects, built on demand
+        from grid.
+        """
+        bounds = self.grid(n, crss=crss)
+        side = self.buffer / float(n)
+        for cell in range(n*n):
+            geom = {}
+            for crs, (minx, miny, maxx, maxy) in bounds.items():
+                ring = _ring(float(minx[cell]), float(miny[cell]), float(maxx[cell]), float(maxy[cell]))
+                if crs == WGS84:
+                    geom[crs] = Polygon((ring,))
+                else:
+                    geom.update([Polygon.factory((ring,), crs=crs)])
+            bbox_new = Bbox.new(geom=geom)
+            bbox_new.buffer = side
+            yield bbox_new
 
 class Geom(object):
 
@@ -290,20 +338,17 @@ class Polygon(Geom):
         _rings @list : List of longitude and latitude coordinates;
         crs  @string : Name of the desidered crs
         """
-        custom_proj = pyproj.Proj(crs)
         try:
             _type = kw["type"]
             props = kw["properties"]
         except KeyError:
             _type, props = list(cls.known_crs[crs].items())[0]
 
-        rings = tuple(map(
-            lambda ring: tuple(map(
-                lambda coords: custom_proj(*coords),
-                ring
-            )),
-            _rings
-        ))
+        # One transform call for each ring
+        rings = tuple(
+            tuple(zip(*transform(*map(list, zip(*ring)), dst=crs)))
+            for ring in _rings
+        )
         return crs, cls(rings, properties=props, type=_type)
 
 class Bbox(GeoDict2):
@@ -352,8 +397,7 @@ class Bbox(GeoDict2):
         _crss = set([crs for crs in crss if crs!="epsg:4326"] + [base_proj])
 
         def _ring(crs):
-            myproj = pyproj.Proj(crs)
-            e, n = myproj(lon, lat)
+            e, n = transform(lon, lat, dst=crs)
             mine = e - buffer
             maxe = e + buffer
             minn = n - buffer
@@ -367,9 +411,12 @@ class Bbox(GeoDict2):
         # import pdb; pdb.set_trace()
         geom = dict([Polygon.factory((_r,), crs=_crs) for _crs,_r in ((a,b) for a,b in (_ring(crs) for crs in _crss))])
 
-        myproj = pyproj.Proj(base_proj)
-        minlon, minlat = myproj(*map(min, zip(*_ring(base_proj)[1])), inverse=True)
-        maxlon, maxlat = myproj(*map(max, zip(*_ring(base_proj)[1])), inverse=True)
+        # Lower left and upper right corners back to longitude and latitude at once
+        ll, _, ur, _, _ = _ring(base_proj)[1]
+        (minlon, maxlon), (minlat, maxlat) = transform((ll[0], ur[0],), (ll[1], ur[1],),
+            src = base_proj,
+            dst = WGS84
+        )
         _ring = (minlon, minlat,), \
             (maxlon, minlat,), \
             (maxlon, maxlat,), \
@@ -433,13 +480,51 @@ class Bbox(GeoDict2):
         keys = ("w", "s", "e", "n",)
         return dict(zip(keys, map(str, values)))
 
-    def split(self, n=10):
-        incr = self.buffer * 2 / float(n)
-        first = incr/2.
-        coordinates = self.coordinates()[0][0]
-        cellcoords = []
-        side = first
-        for i in range(n):
-            for j in range(n):
-                est, nord = osmproj( coordinates[0] + first + (incr*i), coordinates[1] + first + (incr*j) , inverse=True)
-                yield Bbox.bufferfactory(est, nord, side)
+    def grid(self, n=10, crss=(base_proj,)):
+        """ Returns the bounds of the n*n cells of the bbox (see: split) by crs
+        as {<crs>: (<minx array>, <miny array>, <maxx array>, <maxy array>)},
+        cells ordered by column.
+        n     @int : Number of cells on each side;
+        crss @list : A list of valid crs (EPSG:3857 and EPSG:4326 are always included).
+        """
+        side = self.buffer / float(n)
+        minx, miny = self.coordinates()[0][0]
+        offsets = side*(2*np.arange(n)+1)
+        cx, cy = np.meshgrid(minx+offsets, miny+offsets, indexing="ij")
+        cx, cy = cx.ravel(), cy.ravel()
+        cells = n*n
+
+        # Corners and centers back to longitude and latitude in a single call
+        lons, lats = transform(
+            np.concatenate((cx-side, cx+side, cx,)),
+            np.concatenate((cy-side, cy+side, cy,)),
+            src = base_proj,
+            dst = WGS84
+        )
+
+        bounds = {
+            base_proj: (cx-side, cy-side, cx+side, cy+side,),
+            WGS84: (lons[:cells], lats[:cells], lons[cells:2*cells], lats[cells:2*cells],)
+        }
+        for crs in set(crss)-set(bounds):
+            x, y = transform(lons[2*cells:], lats[2*cells:], dst=crs)
+            bounds[crs] = (x-side, y-side, x+side, y+side,)
+        return bounds
+
+    def split(self, n=10, crss=(base_proj,)):
+        """ Yields the n*n cells of the bbox as Bbox objects, built on demand
+        from grid.
+        """
+        bounds = self.grid(n, crss=crss)
+        side = self.buffer / float(n)
+        for cell in range(n*n):
+            geom = {}
+            for crs, (minx, miny, maxx, maxy) in bounds.items():
+                ring = _ring(float(minx[cell]), float(miny[cell]), float(maxx[cell]), float(maxy[cell]))
+                if crs == WGS84:
+                    geom[crs] = Polygon((ring,))
+                else:
+                    geom.update([Polygon.factory((ring,), crs=crs)])
+            bbox_new = Bbox.new(geom=geom)
+            bbox_new.buffer = side
+            yield bbox_new
@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+
+"""
+Local evaluation of Overpass tag conditions.
+
+Query conditions (see: Turbo.build_query) are compiled once into a single
+predicate, i.e. a union of intersections of has-kv conditions:
+
+    [[{"k": ..., "modv": ..., "v/regv": ...}, ...], ...]
+
+Supported has-kv attributes, with the Overpass semantics:
+    k     : Tag key, alone it tests the presence of the key
+            (as in Turbo.check an empty v does the same);
+    v     : Tag value;
+    regv  : Regular expression searched in the value of k (or of the keys
+            matching regk);
+    regk  : Regular expression searched in tag keys;
+    modv  : "not" negates the condition, i.e. [k!=v], [k!~regv], [!k];
+    case  : "ignore" for case insensitive regular expressions.
+
+Predicates run on single tag dicts, on batches of elements and on tag
+columns (i.e. {<key>: <sequence of values, None if missing>}) where
+regular expressions are evaluated once per distinct value.
+"""
+
+import re
+from functools import lru_cache
+
+import numpy as np
+
+# Memoized regular expression results (tag values repeat a lot)
+_MEMO_SIZE = 2**14
+
+class Condition(object):
+    """ A single has-kv condition """
+
+    def __init__(self, k=None, v=None, regv=None, regk=None, modv=None, case=None):
+        super(Condition, self).__init__()
+        if not modv in (None, "", "not",):
+            raise NotImplementedError("Operator not yet supported: {}".format(modv))
+        if k is None and regk is None:
+            raise ValueError("A key (k) or key regular expression (regk) is required")
+        flags = re.IGNORECASE if case == "ignore" else 0
+        self.k = k
+        self.v = v or None
+        self.negated = modv == "not"
+        self.regk = None if regk is None else lru_cache(_MEMO_SIZE)(re.compile(regk, flags).search)
+        self.regv = None if regv is None else lru_cache(_MEMO_SIZE)(re.compile(regv, flags).search)
+
+    def _value(self, value):
+        """ Tests a value of a matching key """
+        if not self.regv is None:
+            return not self.regv(value) is None
+        elif not self.v is None:
+            return value == self.v
+        return True
+
+    def _test(self, tags):
+        if not self.regk is None:
+            return any(not self.regk(key) is None and self._value(value)
+                for key, value in tags.items())
+        try:
+            value = tags[self.k]
+        except KeyError:
+            return False
+        return self._value(value)
+
+    def __call__(self, tags):
+        """ Returns whether tags satisfy the condition
+        tags @dict : Element tags (None for untagged elements).
+        """
+        return self._test(tags or {}) != self.negated
+
+    def _column(self, values, size):
+        if values is None:
+            return np.zeros(size, dtype=bool)
+        # Evaluated once for each distinct value
+        memo = {}
+        out = np.empty(size, dtype=bool)
+        for i, value in enumerate(values):
+            try:
+                out[i] = memo[value]
+            except KeyError:
+                out[i] = memo[value] = not value is None and self._value(value)
+        return out
+
+    def mask(self, columns, size):
+        """ Returns the boolean array of the rows satisfying the condition
+        columns @dict : {<key>: <sequence of values, None if missing>};
+        size @int : Number of rows.
+        """
+        if self.regk is None:
+            out = self._column(columns.get(self.k), size)
+        else:
+            out = np.zeros(size, dtype=bool)
+            for key, values in columns.items():
+                if not self.regk(key) is None:
+                    out |= self._column(values, size)
+        return ~out if self.negated else out
+
+
+class TagFilter(object):
+    """ Compiled union of intersections of tag conditions """
+
+    def __init__(self, unions):
+        """
+        unions @list : [(<gtypes or None>, [<Condition>, ...]), ...].
+        """
+        super(TagFilter, self).__init__()
+        self.unions = unions
+
+    def _unions(self, gtype):
+        return (conditions for gtypes, conditions in self.unions
+            if gtype is None or gtypes is None or gtype in gtypes)
+
+    def __call__(self, tags, gtype=None):
+        """ Returns whether an element satisfies the filter
+        tags @dict : Element tags;
+        gtype @string : Element type, if given only conditions for it are considered.
+        """
+        return any(all(condition(tags) for condition in conditions)
+            for conditions in self._unions(gtype))
+
+    def select(self, elements, tags=lambda element: element.get("tags")):
+        """ Yields the elements satisfying the filter
+        elements @iterable : Elements, by default dicts in the Overpass JSON
+            format (see: pipeline);
+        tags @callable : Returns the tags of an element.
+        """
+        for element in elements:
+            if self(tags(element), gtype=element.get("type") if isinstance(element, dict) else None):
+                yield element
+
+    def mask(self, columns, size, gtype=None):
+        """ Columnar version of __call__, returns the boolean array of the
+        rows satisfying the filter.
+        columns @dict : {<key>: <sequence of values, None if missing>};
+        size @int : Number of rows;
+        gtype @string : Type of all the elements.
+        """
+        out = np.zeros(size, dtype=bool)
+        for conditions in self._unions(gtype):
+            current = np.ones(size, dtype=bool)
+            for condition in conditions:
+                current &= condition.mask(columns, size)
+            out |= current
+        return out
+
+def compile_query(query, gtypes=None):
+    """ Compiles a query, i.e. unions of intersections of has-kv conditions
+    (see: Turbo.build_query), returns a TagFilter.
+    """
+    gtypes = None if gtypes is None else frozenset(gtypes)
+    return TagFilter([(gtypes, [Condition(**cond) for cond in intersection]) for intersection in query])
+
+def compile_qconditions(qconditions, gtypes=None):
+    """ Compiles the union of the queries of qconditions, e.g.:
+
+    qconditions = [{
+        "query": [[{"k": ..., "modv": ..., "v/regv": ...}, ...], ...],
+        "gtypes": [...], # Optional
+        ...
+    }, ...]
+
+    gtypes @list : Default element types of the conditions without gtypes.
+    """
+    unions = []
+    for cond in qconditions:
+        unions.extend(compile_query(cond["query"], gtypes=cond.get("gtypes", gtypes)).unions)
+    return TagFilter(unions)
+
+@lru_cache(maxsize=256)
+def _condition(items):
+    return Condition(**dict(items))
+
+def condition(**kw):
+    """ Returns the compiled condition, cached for repeated uses """
+    return _condition(tuple(sorted(kw.items())))
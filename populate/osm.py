@@ -4,12 +4,15 @@ from itertools import zip_longest
 
 # from pydal.helpers.serializers import json as jsondumps
 from pydal import geoPoint
-from .pgcopy import BulkCopyer
-from .base import BaseParser, BaseCopier, WTF
+from .base import BaseParser, BaseCopier, WTF, chunks
+from .idmap import IdMap
 from overpy.exception import DataIncomplete
 from overpy import RelationNode, RelationWay, RelationRelation
 from shapely.geometry import Point as shPoint
 from shapely.geometry import Polygon as shPolygon
+from shapely.strtree import STRtree
+from shapely.prepared import prep
+from numbers import Integral
 # from swissknife.log import timeLoggerDecorator
 
 class MPolyRolesManager(object):
@@ -40,55 +43,120 @@ class MPolyRolesManager(object):
         return self
 
     def __exit__(self, exc_type, exc_value, traceback):
+        """ Assigns every inner ring to the smallest outer ring containing it.
+        Candidate outers are filtered by bbox with a STRtree and then checked
+        with prepared geometries, so the cost is no more quadratic.
+        Choosing the smallest container handles islands within holes: a hole
+        of an island is assigned to the island and not to the outer ring that
+        contains both.
+        Reference: http://wiki.openstreetmap.org/wiki/Relation:multipolygon
+        """
+
+        outers = self.members["outer"]
+        if not outers:
+            return
+
+        outer_geoms = [self.geoms[outer.id] for outer in outers]
+        tree = STRtree(outer_geoms)
+        # shapely<2 queries return geometries, shapely>=2 returns indexes
+        positions = {id(geom): n for n, geom in enumerate(outer_geoms)}
+        prepared = {}
 
-        # ~~ TODO ~~
-        # WARNING! Islands within a hole are not considered at the moment.
-        # Reference: http://wiki.openstreetmap.org/wiki/Relation:multipolygon
         for inner in self.members["inner"]:
-            for outer in self.members["outer"]:
-                if self.geoms[inner.id].within(self.geoms[outer.id]):
-                    try:
-                        o = self.relation[outer.id]
-                    except KeyError:
-                        self.relation[outer.id] = [inner.id]
-                    else:
-                        o.append(inner.id)
+            geom = self.geoms[inner.id]
+            container = None
+            for hit in tree.query(geom):
+                n = hit if isinstance(hit, Integral) else positions[id(hit)]
+                try:
+                    outer_geom = prepared[n]
+                except KeyError:
+                    outer_geom = prepared[n] = prep(outer_geoms[n])
+                if outer_geom.contains(geom) and (container is None or \
+                    outer_geoms[n].area < outer_geoms[container].area):
+                    container = n
+
+            if not container is None:
+                try:
+                    o = self.relation[outers[container].id]
+                except KeyError:
+                    self.relation[outers[container].id] = [inner.id]
+                else:
+                    o.append(inner.id)
 
 
 class __CommonMethods__(object):
     """docstring for __Base__."""
 
-    def _save_way(self, info_id, way):
+    def _new_cache(self, node={}, way={}, relation={}, spill_over=None):
+        """ Returns the source id caches:
+            nodes: (<info id>, <node id>), ways and relations: <info id>
+        Initial content can be given as {<source id>: <cached value>}.
+        """
+        cache = {
+            "nodes": IdMap(width=2, spill_over=spill_over),
+            "ways": IdMap(spill_over=spill_over),
+            "relations": IdMap(spill_over=spill_over),
+        }
+        for key, items in zip(("nodes", "ways", "relations",), (node, way, relation,)):
+            cache[key].update(sorted(items.items()))
+        return cache
 
-        if self.db.way_node(info_id=info_id) is None:
-            return self.db.way_node.bulk_insert((dict(
-                info_id = info_id,
-                node_id =  self.cache["nodes"][node.id]["node_id"],
-                sorting = sorting,
-            ) for sorting, node in enumerate(way.nodes)))
+    def _save_way(self, info_id, way):
+        node_ids = [self.cache["nodes"][node.id][1] for node in way.nodes]
+        ways_batch = getattr(self, '_ways_batch', None)
+        if ways_batch is None:
+            self._reconcile_ways({info_id: node_ids})
         else:
-            res = self.db(self.db.way_node.info_id==info_id).select(
-                orderby = self.db.way_node.sorting
-            )
-            for srt,_dd in enumerate(zip_longest(res, way.nodes)):
-                rec,node = _dd
-                if node is None:
-                    rec.delete_record()
+            # Reconciled all together at the end of the batch
+            ways_batch[info_id] = node_ids
+
+    def _reconcile_ways(self, ways):
+        """ Aligns the way_node records of the given ways to their new node lists.
+        The differences are computed in memory and applied with at most one
+        delete, one insert and one update statement for all the ways.
+
+        ways @dict : {<way info id>: [<node id>, ...]}
+        """
+        if not ways:
+            return
+
+        current = {}
+        for row in self.db(self.db.way_node.info_id.belongs(list(ways))).select(
+            self.db.way_node.id,
+            self.db.way_node.info_id,
+            self.db.way_node.node_id,
+            self.db.way_node.sorting,
+            orderby = self.db.way_node.info_id|self.db.way_node.sorting
+        ):
+            current.setdefault(row.info_id, []).append(row)
+
+        to_delete, to_insert, to_update = [], [], []
+        for info_id, node_ids in ways.items():
+            for srt,_dd in enumerate(zip_longest(current.get(info_id, []), node_ids)):
+                rec,node_id = _dd
+                if node_id is None:
+                    to_delete.append(rec.id)
                 elif rec is None:
-                    self.db.way_node.insert(
-                        info_id = info_id,
-                        node_id = self.cache["nodes"][node.id]["node_id"],
-                        sorting = srt
-                    )
-                elif rec.node_id==self.cache["nodes"][node.id]["node_id"]:
-                    # It just fix wrong values that would not exist.
-                    if rec.sorting!=srt:
-                        rec.update_record(sorting = srt)
-                else:
-                    rec.update_record(
-                        node_id = self.cache["nodes"][node.id]["node_id"],
-                        sorting = srt
-                    )
+                    to_insert.append((info_id, node_id, srt,))
+                elif rec.node_id!=node_id or rec.sorting!=srt:
+                    # It also fixes wrong sorting values that would not exist.
+                    to_update.append((rec.id, node_id, srt,))
+
+        if to_delete:
+            self.db.executesql("DELETE FROM way_node WHERE id = ANY(%s)",
+                placeholders = [to_delete]
+            )
+        if to_insert:
+            self.db.executesql("""INSERT INTO way_node (info_id, node_id, sorting)
+                SELECT * FROM unnest(%s::integer[], %s::integer[], %s::integer[])""",
+                placeholders = list(map(list, zip(*to_insert)))
+            )
+        if to_update:
+            self.db.executesql("""UPDATE way_node SET node_id = v.node_id, sorting = v.sorting
+                FROM unnest(%s::integer[], %s::integer[], %s::integer[]) AS v(id, node_id, sorting)
+                WHERE way_node.id = v.id""",
+                placeholders = list(map(list, zip(*to_update)))
+            )
 
     def parseNode(self, node):
 
@@ -102,7 +170,7 @@ class __CommonMethods__(object):
             )
             coordinates = map(float, (node.lon, node.lat,))
             node_id = self._save_node(info_id, *coordinates)
-            out = self.cache["nodes"][node.id] = {"id": info_id, "node_id": node_id}
+            out = self.cache["nodes"][node.id] = (info_id, node_id,)
             return out
 
     def parseWay(self, way):
@@ -117,8 +185,8 @@ class __CommonMethods__(object):
                 attributes = way.attributes
             )
             self._save_way(info_id, way)
-            out = self.cache["ways"][way.id] = {"id": info_id}
-            return out
+            self.cache["ways"][way.id] = info_id
+            return info_id
 
 
 class Parser(BaseParser, __CommonMethods__):
@@ -129,8 +197,21 @@ class Parser(BaseParser, __CommonMethods__):
         db @DAL : The database in wich info, node, way_node and relation tables are defined.
         """
         super(Parser, self).__init__(db, source_name='osm')
-        # Nodes and way cached by their source id
-        self.cache = {"nodes": {}, "ways": {}}
+        # Elements cached by their source id
+        self.cache = self._new_cache()
+        # If given, info records are saved in batches of batch_size elements
+        # (see BaseParser._save_infos)
+        self.batch_size = kwargs.get('batch_size')
+
+    def _prefetch_infos(self, elements, gtype):
+        """ Saves in batches the info records of the given OSM elements """
+        for batch in chunks(elements, self.batch_size):
+            self._save_infos(dict(
+                sid = element.id,
+                gtype = gtype,
+                tags = element.tags,
+                attributes = element.attributes
+            ) for element in batch)
 
     def parseRelation(self, relation):
         """
@@ -144,6 +225,8 @@ class Parser(BaseParser, __CommonMethods__):
 
         References:
             * https://wiki.openstreetmap.org/wiki/Relation
+
+        Returns the info id of the relation.
         """
 
         info_id = self._save_info(relation.id,
@@ -151,6 +234,8 @@ class Parser(BaseParser, __CommonMethods__):
             attributes = relation.attributes,
             gtype = "relation"
         )
+        # Cached before members, nested relations are resolved by info id
+        self.cache["relations"][relation.id] = info_id
 
         _relations = self.db(self.db.relation.info_id==info_id)
 
@@ -159,17 +244,17 @@ class Parser(BaseParser, __CommonMethods__):
             for member in relation.members:
                 if isinstance(member, RelationWay):
                     try:
-                        member_id = self.cache["ways"][member.ref]["id"]
+                        member_id = self.cache["ways"][member.ref]
                     except KeyError:
                         continue
                 elif isinstance(member, RelationNode):
                     try:
-                        member_id = self.cache["nodes"][member.ref]["id"]
+                        member_id = self.cache["nodes"][member.ref][0]
                     except KeyError:
                         continue
                 elif isinstance(member, RelationRelation):
                     try:
-                        member_id = self.cache["relations"][member.ref]["id"]
+                        member_id = self.cache["relations"][member.ref]
                     except KeyError:
                         try:
                             _member = member._result.get_relation(
@@ -178,11 +263,11 @@ class Parser(BaseParser, __CommonMethods__):
                         except DataIncomplete:
                             continue
                         else:
-                            member_id = self.parseRelation(_member)["id"]
+                            member_id = self.parseRelation(_member)
                 else:
                     raise WTF()
 
-                return self.db.relation.insert(info_id=info_id, member_id=member_id, role=member.role)
+                self.db.relation.insert(info_id=info_id, member_id=member_id, role=member.role)
 
         else:
 
@@ -205,17 +290,17 @@ class Parser(BaseParser, __CommonMethods__):
             for member in relation.members:
                 if isinstance(member, RelationWay):
                     try:
-                        member_id = self.cache["ways"][member.ref]["id"]
+                        member_id = self.cache["ways"][member.ref]
                     except KeyError:
                         continue
                 elif isinstance(member, RelationNode):
                     try:
-                        member_id = self.cache["nodes"][member.ref]["id"]
+                        member_id = self.cache["nodes"][member.ref][0]
                     except KeyError:
                         continue
                 elif isinstance(member, RelationRelation):
                     try:
-                        member_id = self.cache["relations"][member.ref]["id"]
+                        member_id = self.cache["relations"][member.ref]
                     except KeyError:
                         try:
                             _member = member._result.get_relation(
@@ -224,16 +309,18 @@ class Parser(BaseParser, __CommonMethods__):
                         except DataIncomplete:
                             continue
                         else:
-                            member_id = self.parseRelation(_member)["id"]
+                            member_id = self.parseRelation(_member)
                 else:
                     raise WTF()
 
-                return self._save_relation(
+                self._save_relation(
                     info_id,
                     member_id,
                     role = member.role
                 )
 
+        return info_id
+
     # @timeLoggerDecorator()
     def parse(self, nodes, ways, relations):
         """ Saves overpass query result into db.
@@ -246,11 +333,22 @@ class Parser(BaseParser, __CommonMethods__):
         # ways = nodes[0]._result.ways
         # relations = nodes[0]._result.relations
 
+        if self.batch_size:
+            nodes, ways, relations = list(nodes), list(ways), list(relations)
+            self._prefetch_infos(nodes, "node")
+            self._prefetch_infos(ways, "way")
+            self._prefetch_infos(relations, "relation")
+
         for node in nodes:
             self.parseNode(node)
 
-        for way in ways:
-            self.parseWay(way)
+        self._ways_batch = {}
+        try:
+            for way in ways:
+                self.parseWay(way)
+            self._reconcile_ways(self._ways_batch)
+        finally:
+            self._ways_batch = None
 
         for relation in relations:
             self.parseRelation(relation)
@@ -262,21 +360,30 @@ class Copier(BaseCopier, __CommonMethods__):
     def __init__(self, db, **kwargs):
         """
         db @DAL : The database in wich info, node, way_node and relation tables are defined.
+        node, way, relation @dict : Elements already in db as
+            {<source id>: (<info id>, <node id>)} for nodes and
+            {<source id>: <info id>} for ways and relations;
+        spill_over @int : Number of cached elements of a type after which the
+            cache is moved to memory mapped files (see: IdMap).
         """
         super(Copier, self).__init__(db, source_name='osm')
-        # Nodes and way cached by their source id
-        self.cache = {
-            "nodes": kwargs.get('node', {}),
-            "ways": kwargs.get('way', {}),
-            "relations": kwargs.get('relation', {}),
-        }
+        # Elements cached by their source id
+        self.cache = self._new_cache(
+            node = kwargs.get('node', {}),
+            way = kwargs.get('way', {}),
+            relation = kwargs.get('relation', {}),
+            spill_over = kwargs.get('spill_over')
+        )
 
     def _save_way(self, info_id, way):
 
-        for sorting, node in enumerate(way.nodes):
+        # Nodes not in cache (e.g. infos without geometry) are skipped
+        # keeping sorting contiguous
+        node_ids = [self.cache["nodes"].get(node.id, (None, None,))[1] for node in way.nodes]
+        for sorting, node_id in enumerate(filter(lambda id: not id is None, node_ids)):
             data = dict(
                 info_id = info_id,
-                node_id =  self.cache["nodes"][node.id]["id"],
+                node_id = node_id,
                 sorting = sorting
             )
 
@@ -286,7 +393,7 @@ class Copier(BaseCopier, __CommonMethods__):
         """ """
 
         try:
-            info_id = self.cache["relations"][relation.id]["id"]
+            info_id = self.cache["relations"][relation.id]
         except KeyError:
             info_id = self._save_info(relation.id,
                 tags = relation.tags,
@@ -298,17 +405,17 @@ class Copier(BaseCopier, __CommonMethods__):
 
             if isinstance(member, RelationWay):
                 try:
-                    member_id = self.cache["ways"][member.ref]["id"]
+                    member_id = self.cache["ways"][member.ref]
                 except KeyError:
                     continue
             elif isinstance(member, RelationNode):
                 try:
-                    member_id = self.cache["nodes"][member.ref]["id"]
+                    member_id = self.cache["nodes"][member.ref][0]
                 except KeyError:
                     continue
             elif isinstance(member, RelationRelation):
                 try:
-                    member_id = self.cache["relations"][member.ref]["id"]
+                    member_id = self.cache["relations"][member.ref]
                 except KeyError:
                     try:
                         _member = member._result.get_relation(
@@ -317,13 +424,13 @@ class Copier(BaseCopier, __CommonMethods__):
                     except DataIncomplete:
                         continue
                     else:
-                        member_id = self.parseRelation(_member)["id"]
+                        member_id = self.parseRelation(_member)
             else:
                 raise WTF()
 
             self._save_relation(info_id, member_id, role=member.role)
-        out = self.cache["relations"][relation.id] = {"id": info_id}
-        return out
+        self.cache["relations"][relation.id] = info_id
+        return info_id
 
     # @timeLoggerDecorator()
     def parse(self, nodes, ways, relations):
@@ -334,10 +441,14 @@ class Copier(BaseCopier, __CommonMethods__):
         # ways = nodes[0]._result.ways
         # relations = nodes[0]._result.relations
 
-        with BulkCopyer(self.db.relation) as self._insrelation, \
-            BulkCopyer(self.db.way_node) as self._insways, \
-            BulkCopyer(self.db.node) as self._insnodes, \
-            BulkCopyer(self.db.info) as self._insinfo:
+        insinfo, insnodes, insways, insrelation = self._copyers(
+            self.db.info, self.db.node, self.db.way_node, self.db.relation
+        )
+
+        with insrelation as self._insrelation, \
+            insways as self._insways, \
+            insnodes as self._insnodes, \
+            insinfo as self._insinfo:
 
             # TODO: # BulkCopyer(db.filter_attribution) as self.insfilter, \
 
@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+
+"""
+Incremental sync from OSM change documents.
+
+Supported formats:
+    * osmChange (https://wiki.openstreetmap.org/wiki/OsmChange), i.e. minutely
+      replication diffs:
+        <osmChange><create>...</create><modify>...</modify><delete>...</delete></osmChange>
+    * Overpass augmented diffs (adiff queries):
+        <osm><action type="create|modify|delete">[<old>...</old><new>...</new>]</action></osm>
+
+Changes are applied in bulk: created and modified elements are upserted in
+batches, deleted ones are only deactivated (is_active set to false) so that
+references to them are preserved.
+"""
+
+from xml.etree.ElementTree import iterparse
+from io import BytesIO
+from datetime import datetime
+
+from .base import BaseParser, chunks
+from .osm import __CommonMethods__
+
+import logging
+logger = logging.getLogger(__name__)
+
+GTYPES = ("node", "way", "relation",)
+
+ACTIONS = ("create", "modify", "delete",)
+
+# Meta attributes as in the Overpass JSON output
+_int_attributes = ("version", "changeset", "uid",)
+
+def _element(elem):
+    """ Returns the Overpass JSON like dict of an OSM element XML node """
+    element = {"type": elem.tag, "id": int(elem.get("id"))}
+    for key, value in elem.attrib.items():
+        if key in ("id", "visible",):
+            continue
+        elif key in ("lat", "lon",):
+            element[key] = float(value)
+        elif key in _int_attributes:
+            element[key] = int(value)
+        else:
+            element[key] = value
+    tags, nodes, members = {}, [], []
+    for child in elem:
+        if child.tag == "tag":
+            tags[child.get("k")] = child.get("v")
+        elif child.tag == "nd":
+            nodes.append(int(child.get("ref")))
+        elif child.tag == "member":
+            members.append(dict(type=child.get("type"), ref=int(child.get("ref")), role=child.get("role")))
+    if tags:
+        element["tags"] = tags
+    if elem.tag == "way":
+        element["nodes"] = nodes
+    elif elem.tag == "relation":
+        element["members"] = members
+    return element
+
+def iter_changes(source):
+    """ Yields (<action>, <element>) from an osmChange or augmented diff document.
+    Elements are dicts in the Overpass JSON format (see: pipeline).
+
+    source @bytes/string/file : Raw document, file path or file like object.
+    """
+    if isinstance(source, bytes):
+        source = BytesIO(source)
+    elif isinstance(source, str) and source.lstrip().startswith("<"):
+        source = BytesIO(source.encode("utf-8"))
+
+    action = None
+    # Augmented diffs only: versions of the element of the current action
+    # by section (old, new or None when not given)
+    versions = None
+    section = None
+    depth = 0
+    for event, elem in iterparse(source, events=("start", "end",)):
+        if event == "start":
+            if elem.tag in GTYPES:
+                depth += 1
+            elif elem.tag in ACTIONS:
+                action = elem.tag
+            elif elem.tag == "action":
+                action, versions = elem.get("type"), {}
+            elif elem.tag in ("old", "new",):
+                section = elem.tag
+            continue
+
+        if elem.tag in GTYPES:
+            depth -= 1
+            # Nested elements (i.e. members with geometry) are not changes
+            if depth == 0 and action in ACTIONS:
+                if versions is None:
+                    yield action, _element(elem)
+                else:
+                    versions[section] = _element(elem)
+                elem.clear()
+        elif elem.tag in ("old", "new",):
+            section = None
+        elif elem.tag == "action":
+            # For deletions the new version (visible="false") could be missing
+            element = versions.get("new") or versions.get(None) or versions.get("old")
+            if not element is None and action in ACTIONS:
+                yield action, element
+            action, versions = None, None
+            elem.clear()
+        elif elem.tag in ACTIONS:
+            action = None
+            elem.clear()
+
+
+class ChangeApplier(BaseParser, __CommonMethods__):
+    """ Applies OSM changes (see: iter_changes) in bulk """
+
+    def __init__(self, db, batch_size=10000):
+        """
+        db @DAL : The database in wich info, node, way_node and relation tables are defined;
+        batch_size @int : Number of elements saved at once.
+        """
+        super(ChangeApplier, self).__init__(db, source_name='osm')
+        self.batch_size = batch_size
+        self.missing = 0
+
+    def _suid(self, gtype, sid):
+        return self.db.info.suid.compute(dict(source_name=self.source_name, gtype=gtype, source_id=str(sid)))
+
+    def _ids(self, gtype, sids, node_ids=False):
+        """ Returns {<source id>: <info id>} (or <node id> if node_ids) of
+        the given elements stored in db.
+        """
+        if not sids:
+            return {}
+        suids = [self._suid(gtype, sid) for sid in set(sids)]
+        if node_ids:
+            sql = """SELECT info.source_id, node.id FROM info JOIN node ON node.info_id = info.id
+                WHERE info.suid = ANY(%s)"""
+        else:
+            sql = "SELECT info.source_id, info.id FROM info WHERE info.suid = ANY(%s)"
+        return {int(sid): id for sid, id in self.db.executesql(sql, placeholders=[suids])}
+
+    def _save_infos_of(self, gtype, elements):
+        ids = self._save_infos(dict(
+            sid = element["id"],
+            gtype = gtype,
+            tags = element.get("tags"),
+            attributes = {k: v for k, v in element.items() if not k in ("type", "id", "lat", "lon", "tags", "nodes", "members",)} or None
+        ) for element in elements)
+        # Ids are used here, not through _save_info
+        self._info_ids.clear()
+        return {int(sid): id for (_, sid), id in ids.items()}
+
+    def _save_nodes(self, elements):
+        info_ids = self._save_infos_of("node", elements)
+        values = [(info_ids[element["id"]], element["lon"], element["lat"],)
+            for element in elements if element["id"] in info_ids]
+        if not values:
+            return
+        placeholders = list(map(list, zip(*values)))
+        self.db.executesql("""UPDATE node SET geom = ST_SetSRID(ST_MakePoint(v.lon, v.lat), 4326)
+            FROM unnest(%s::integer[], %s::float8[], %s::float8[]) AS v(info_id, lon, lat)
+            WHERE node.info_id = v.info_id""", placeholders=placeholders)
+        self.db.executesql("""INSERT INTO node (info_id, geom)
+            SELECT v.info_id, ST_SetSRID(ST_MakePoint(v.lon, v.lat), 4326)
+            FROM unnest(%s::integer[], %s::float8[], %s::float8[]) AS v(info_id, lon, lat)
+            WHERE NOT EXISTS (SELECT 1 FROM node WHERE node.info_id = v.info_id)""", placeholders=placeholders)
+
+    def _save_ways(self, elements):
+        info_ids = self._save_infos_of("way", elements)
+        node_ids = self._ids("node", [ref for element in elements for ref in element["nodes"]], node_ids=True)
+        ways = {}
+        for element in elements:
+            refs = element["nodes"]
+            ways[info_ids[element["id"]]] = [node_ids[ref] for ref in refs if ref in node_ids]
+            self.missing += len(refs)-len(ways[info_ids[element["id"]]])
+        self._reconcile_ways(ways)
+
+    def _save_relations(self, elements):
+        info_ids = self._save_infos_of("relation", elements)
+        member_ids = {gtype: self._ids(gtype, [m["ref"] for element in elements
+            for m in element["members"] if m["type"]==gtype]) for gtype in GTYPES}
+        # Members of newly created relations could be created in the same batch
+        member_ids["relation"].update(info_ids)
+        values = []
+        for element in elements:
+            for member in element["members"]:
+                try:
+                    member_id = member_ids[member["type"]][member["ref"]]
+                except KeyError:
+                    self.missing += 1
+                    continue
+                values.append((info_ids[element["id"]], member_id, member["role"],))
+        self.db.executesql("DELETE FROM relation WHERE info_id = ANY(%s)",
+            placeholders = [list(info_ids.values())]
+        )
+        if values:
+            self.db.executesql("""INSERT INTO relation (info_id, member_id, role)
+                SELECT * FROM unnest(%s::integer[], %s::integer[], %s::text[])""",
+                placeholders = list(map(list, zip(*values)))
+            )
+
+    def _delete(self, gtype, elements):
+        """ Deactivates deleted elements """
+        self.db.executesql("""UPDATE info SET is_active = %s, modified_on = %s
+            WHERE suid = ANY(%s)""",
+            placeholders = [False, datetime.utcnow(), [self._suid(gtype, e["id"]) for e in elements]]
+        )
+
+    def apply(self, changes):
+        """ Applies changes to db.
+
+        changes @iterable : (<action>, <element>) as yielded by iter_changes.
+
+        Returns the number of changes applied by action.
+        """
+        # Only the last change of each element matters
+        last = {gtype: {} for gtype in GTYPES}
+        for action, element in changes:
+            last[element["type"]][element["id"]] = (action, element,)
+
+        counts = dict.fromkeys(ACTIONS, 0)
+        savers = {"node": self._save_nodes, "way": self._save_ways, "relation": self._save_relations}
+        # Nodes before ways before relations so that references are resolved
+        for gtype in GTYPES:
+            upserts, deletes = [], []
+            for action, element in last[gtype].values():
+                counts[action] += 1
+                (deletes if action == "delete" else upserts).append(element)
+            for batch in chunks(upserts, self.batch_size):
+                savers[gtype](batch)
+            for batch in chunks(deletes, self.batch_size):
+                self._delete(gtype, batch)
+
+        if self.missing:
+            logger.warning("{} references to elements not found were skipped".format(self.missing))
+        return counts
+
+def apply(source, db, batch_size=10000):
+    """ Applies an osmChange or augmented diff document to db
+    (see: iter_changes and ChangeApplier.apply).
+    """
+    return ChangeApplier(db, batch_size=batch_size).apply(iter_changes(source))
@@ -0,0 +1,335 @@
+# -*- coding: utf-8 -*-
+
+"""
+Native OpenStreetMap PBF (.osm.pbf) reader.
+
+Blobs are read sequentially from the file and decoded (decompression and
+protobuf parsing) by the worker processes of the import pipeline, so bulk
+imports of extracts or planet files don't need an Overpass server.
+Elements are produced in the Overpass JSON format (see: pipeline) and copied
+with the PipelineCopier.
+
+Only the subset of the protobuf wire format used by the OSM PBF schema is
+implemented (see: https://wiki.openstreetmap.org/wiki/PBF_Format).
+"""
+
+import struct, zlib, lzma
+from datetime import datetime, timezone
+
+from . import pipeline
+
+# Header features this reader is able to handle
+SUPPORTED_FEATURES = {"OsmSchema-V0.6", "DenseNodes"}
+
+MEMBER_TYPES = ("node", "way", "relation",)
+
+class PBFError(Exception):
+    """ Malformed or unsupported PBF file """
+
+def _varint(buf, pos):
+    result = shift = 0
+    while True:
+        byte = buf[pos]
+        pos += 1
+        result |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return result, pos
+        shift += 7
+
+def _fields(buf):
+    """ Yields (<field number>, <wire type>, <value>) of a protobuf message """
+    pos, end = 0, len(buf)
+    while pos < end:
+        key, pos = _varint(buf, pos)
+        number, wtype = key >> 3, key & 7
+        if wtype == 0:
+            value, pos = _varint(buf, pos)
+        elif wtype == 2:
+            length, pos = _varint(buf, pos)
+            value = buf[pos:pos+length]
+            pos += length
+        elif wtype == 1:
+            value = buf[pos:pos+8]
+            pos += 8
+        elif wtype == 5:
+            value = buf[pos:pos+4]
+            pos += 4
+        else:
+            raise PBFError("Unsupported wire type: {}".format(wtype))
+        yield number, wtype, value
+
+def _packed(wtype, value):
+    """ Returns the list of varints of a packed (or not) repeated field """
+    if wtype == 0:
+        return [value]
+    out, pos, end = [], 0, len(value)
+    while pos < end:
+        item, pos = _varint(value, pos)
+        out.append(item)
+    return out
+
+def _signed(value):
+    """ int32/int64 from the raw varint """
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+def _zigzag(value):
+    """ sint32/sint64 from the raw varint """
+    return (value >> 1) ^ -(value & 1)
+
+def _delta(values):
+    out, last = [], 0
+    for value in values:
+        last += _zigzag(value)
+        out.append(last)
+    return out
+
+def _string(buf):
+    return bytes(buf).decode("utf-8")
+
+def read_blobs(fileobj):
+    """ Yields (<blob type>, <raw blob>) from a PBF file object """
+    while True:
+        size = fileobj.read(4)
+        if not size:
+            break
+        if len(size) < 4:
+            raise PBFError("Truncated file")
+        header = fileobj.read(struct.unpack("!I", size)[0])
+        btype, datasize = None, 0
+        for number, _, value in _fields(memoryview(header)):
+            if number == 1:
+                btype = _string(value)
+            elif number == 3:
+                datasize = value
+        blob = fileobj.read(datasize)
+        if len(blob) < datasize:
+            raise PBFError("Truncated file")
+        yield btype, blob
+
+def decompress(blob):
+    """ Returns the uncompressed content of a Blob message """
+    for number, _, value in _fields(memoryview(blob)):
+        if number == 1:
+            return bytes(value)
+        elif number == 3:
+            return zlib.decompress(value)
+        elif number == 4:
+            return lzma.decompress(value)
+        elif number in (5, 6, 7):
+            raise PBFError("Unsupported blob compression (field {})".format(number))
+    return b""
+
+def check_header(data):
+    """ Raises PBFError if the HeaderBlock requires unsupported features """
+    for number, _, value in _fields(memoryview(data)):
+        if number == 4:
+            feature = _string(value)
+            if not feature in SUPPORTED_FEATURES:
+                raise PBFError("Unsupported required feature: {}".format(feature))
+
+def iter_blobs(path):
+    """ Yields the raw OSMData blobs of a PBF file after checking its header """
+    with open(path, "rb") as fileobj:
+        for btype, blob in read_blobs(fileobj):
+            if btype == "OSMHeader":
+                check_header(decompress(blob))
+            elif btype == "OSMData":
+                yield blob
+
+
+class _Block(object):
+    """ Decoding context of a PrimitiveBlock """
+
+    def __init__(self, data):
+        super(_Block, self).__init__()
+        self.strings = []
+        self.granularity = 100
+        self.date_granularity = 1000
+        self.lat_offset = self.lon_offset = 0
+        self.groups = []
+        for number, wtype, value in _fields(memoryview(data)):
+            if number == 1:
+                self.strings = [_string(s) for _, _, s in _fields(value)]
+            elif number == 2:
+                self.groups.append(value)
+            elif number == 17:
+                self.granularity = value
+            elif number == 18:
+                self.date_granularity = value
+            elif number == 19:
+                self.lat_offset = _signed(value)
+            elif number == 20:
+                self.lon_offset = _signed(value)
+
+    def lat(self, value):
+        return (self.lat_offset + self.granularity * value) / 1e9
+
+    def lon(self, value):
+        return (self.lon_offset + self.granularity * value) / 1e9
+
+    def timestamp(self, value):
+        return datetime.fromtimestamp(value * self.date_granularity / 1000., timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+    def tags(self, keys, vals):
+        return {self.strings[k]: self.strings[v] for k, v in zip(keys, vals)}
+
+    def attributes(self, version, timestamp, changeset, uid, user_sid):
+        """ Overpass like meta attributes """
+        out = {}
+        if version is not None and version >= 0:
+            out["version"] = version
+        if timestamp:
+            out["timestamp"] = self.timestamp(timestamp)
+        if changeset:
+            out["changeset"] = changeset
+        if uid:
+            out["uid"] = uid
+        if user_sid:
+            out["user"] = self.strings[user_sid]
+        return out
+
+    def info(self, buf):
+        values = {1: None, 2: 0, 3: 0, 4: 0, 5: 0}
+        for number, _, value in _fields(buf):
+            if number in (1, 2, 3, 4,):
+                values[number] = _signed(value)
+            elif number == 5:
+                values[number] = value
+        return self.attributes(*(values[n] for n in range(1, 6)))
+
+    def element(self, gtype, id, keys, vals, attributes, **kw):
+        element = dict(type=gtype, id=id, **kw)
+        if keys:
+            element["tags"] = self.tags(keys, vals)
+        element.update(attributes)
+        return element
+
+    def nodes(self, buf):
+        id, keys, vals, attributes, lat, lon = 0, [], [], {}, 0, 0
+        for number, wtype, value in _fields(buf):
+            if number == 1:
+                id = _zigzag(value)
+            elif number == 2:
+                keys += _packed(wtype, value)
+            elif number == 3:
+                vals += _packed(wtype, value)
+            elif number == 4:
+                attributes = self.info(value)
+            elif number == 8:
+                lat = _zigzag(value)
+            elif number == 9:
+                lon = _zigzag(value)
+        yield self.element("node", id, keys, vals, attributes, lat=self.lat(lat), lon=self.lon(lon))
+
+    def dense_info(self, buf, size):
+        columns = {}
+        for number, wtype, value in _fields(buf):
+            if number == 1:
+                columns[1] = [_signed(v) for v in _packed(wtype, value)]
+            elif number in (2, 3, 4, 5,):
+                columns[number] = _delta(_packed(wtype, value))
+        columns = [columns.get(n) or [0]*size for n in range(1, 6)]
+        for values in zip(*columns):
+            yield self.attributes(*values)
+
+    def dense(self, buf):
+        ids, lats, lons, keys_vals, infos = [], [], [], [], None
+        for number, wtype, value in _fields(buf):
+            if number == 1:
+                ids = _delta(_packed(wtype, value))
+            elif number == 5:
+                infos = value
+            elif number == 8:
+                lats = _delta(_packed(wtype, value))
+            elif number == 9:
+                lons = _delta(_packed(wtype, value))
+            elif number == 10:
+                keys_vals = _packed(wtype, value)
+        attributes = self.dense_info(infos, len(ids)) if infos is not None else ({} for _ in ids)
+        kv = iter(keys_vals)
+        for id, lat, lon, attrs in zip(ids, lats, lons, attributes):
+            keys, vals = [], []
+            if keys_vals:
+                # Tags of each node are a sequence of key/value string ids
+                # ended by 0
+                for key in kv:
+                    if key == 0:
+                        break
+                    keys.append(key)
+                    vals.append(next(kv))
+            yield self.element("node", id, keys, vals, attrs, lat=self.lat(lat), lon=self.lon(lon))
+
+    def ways(self, buf):
+        id, keys, vals, attributes, refs = 0, [], [], {}, []
+        for number, wtype, value in _fields(buf):
+            if number == 1:
+                id = _signed(value)
+            elif number == 2:
+                keys += _packed(wtype, value)
+            elif number == 3:
+                vals += _packed(wtype, value)
+            elif number == 4:
+                attributes = self.info(value)
+            elif number == 8:
+                refs = _delta(_packed(wtype, value))
+        yield self.element("way", id, keys, vals, attributes, nodes=refs)
+
+    def relations(self, buf):
+        id, keys, vals, attributes, roles, memids, types = 0, [], [], {}, [], [], []
+        for number, wtype, value in _fields(buf):
+            if number == 1:
+                id = _signed(value)
+            elif number == 2:
+                keys += _packed(wtype, value)
+            elif number == 3:
+                vals += _packed(wtype, value)
+            elif number == 4:
+                attributes = self.info(value)
+            elif number == 8:
+                roles = _packed(wtype, value)
+            elif number == 9:
+                memids = _delta(_packed(wtype, value))
+            elif number == 10:
+                types = _packed(wtype, value)
+        members = [dict(type=MEMBER_TYPES[t], ref=ref, role=self.strings[r])
+            for r, ref, t in zip(roles, memids, types)]
+        yield self.element("relation", id, keys, vals, attributes, members=members)
+
+    def __iter__(self):
+        decoders = {1: self.nodes, 2: self.dense, 3: self.ways, 4: self.relations}
+        for group in self.groups:
+            for number, _, value in _fields(group):
+                try:
+                    decoder = decoders[number]
+                except KeyError:
+                    # Changesets are not supported
+                    continue
+                yield from decoder(value)
+
+def decode(blob):
+    """ Returns the elements of an OSMData blob in the Overpass JSON format """
+    return list(_Block(decompress(blob)))
+
+def prepare_blob(blob, format='text'):
+    """ Decodes a blob and prepares its elements for copy (see: pipeline.prepare).
+    To be run in worker processes.
+    """
+    return pipeline.prepare(decode(blob), format=format)
+
+def iter_elements(path):
+    """ Yields all the elements of a PBF file, decoded in this process """
+    for blob in iter_blobs(path):
+        yield from decode(blob)
+
+def copy(path, db, workers=None, max_pending=None, **copy_options):
+    """ Copies the content of a PBF file to db decoding blobs in parallel.
+
+    path @string : Path of the .osm.pbf file;
+    For other parameters see: pipeline.copy_chunks.
+    """
+    return pipeline.copy_chunks(iter_blobs(path), db,
+        transform = prepare_blob,
+        workers = workers,
+        max_pending = max_pending,
+        **copy_options
+    )
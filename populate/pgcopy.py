@@ -1,8 +1,18 @@
 # -*- coding: utf-8 -*-
 
-import csv, io
+import csv, io, re
+from struct import Struct
+from datetime import datetime, date, timedelta, timezone
 # from swissknife.log import timeLoggerDecorator
 
+csv.register_dialect('custom', delimiter='\t', quotechar=None, quoting=csv.QUOTE_NONE)
+
+_copy_escapes = str.maketrans({'\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r'})
+
+def copy_text(value):
+    """ Returns the value escaped for the text COPY format (None is NULL) """
+    return '\\N' if value is None else str(value).translate(_copy_escapes)
+
 class BulkCopyer(object):
     """
     Courtesy of: https://www.citusdata.com/blog/2017/11/08/faster-bulk-loading-in-postgresql-with-copy/
@@ -19,26 +29,52 @@ class BulkCopyer(object):
     #     return 0 if last_row is None else last_row.id
     #     return self.db.executesql("select nextval('{}_id_seq')".format(self.table_name))[0][0]-1
 
-    def __init__(self, table):
+    # Number of ids reserved from the table sequence with a single query.
+    block_size = 1000
+    # Buffer thresholds (in characters and rows) over which buffered rows are
+    # streamed to the db. None means no limit.
+    max_bytes = 32*1024**2
+    max_rows = None
+
+    def __init__(self, table, block_size=None, max_bytes=None, max_rows=None, upstream=()):
         """
         table @DAL.Table : "db.graph_path"
+        block_size  @int : Number of ids to reserve from the table sequence
+                           in a single round trip (default: BulkCopyer.block_size).
+        max_bytes   @int : Buffer size over which rows are flushed to the db
+                           (default: BulkCopyer.max_bytes);
+        max_rows    @int : Number of buffered rows over which rows are flushed
+                           to the db (default: BulkCopyer.max_rows);
+        upstream   @list : BulkCopyer objects of referenced tables that have to
+                           be flushed before this one (i.e. info before node).
         """
         super(BulkCopyer, self).__init__()
 
+        if not block_size is None:
+            self.block_size = block_size
+        if not max_bytes is None:
+            self.max_bytes = max_bytes
+        if not max_rows is None:
+            self.max_rows = max_rows
+        self.upstream = list(upstream)
+        self.__ids = iter(())
+
         self.db = table._db
         self.adapter = table._db._adapter
         self.table_name = table._tablename
         self.table = table
-        csv.register_dialect('custom', delimiter='\t', quotechar="", quoting=csv.QUOTE_NONE)
+        self._reset()
+
+    def _reset(self):
         self.csv = io.StringIO()
-        self.writer = csv.DictWriter(self.csv, fieldnames=table.fields(), dialect='custom')
+        self.writer = csv.DictWriter(self.csv, fieldnames=self.table.fields(), dialect='custom')
+        self.rows = 0
 
     def __enter__(self):
         # self.maxid = self.__nextid()
         return self
 
     def __exit__(self, exception_type, exception_value, traceback):
-        # self.csv.seek(0)
 
         if traceback is None:
             # foo = {}
@@ -46,27 +82,261 @@ class BulkCopyer(object):
             #     foo['level'] = current.plugins.planetstore.log_level
 
             # with timeLoggerDecorator("Coping to {}".format(self.table_name), **foo):
-            content = self.csv.getvalue()
-            if content:
-                try:
-                    self.adapter.cursor.copy_from(io.StringIO(content), self.table_name, null='NULL')
-                except Exception as err:
-                    self.db.rollback()
-                    with open("/tmp/{}".format(self.table_name), "w") as foo:
-                        foo.write(self.csv.getvalue())
-                    raise
-                else:
-                #     maxid = self.db(self.table).select(self.table.id.max().with_alias('maxid')).first().maxid
-                #     nextid = self.__nextid()
-                #     if nextid<=maxcid:
-                #         self.db.executesql(syncquery(self.table_name))
-                    self.db.commit()
+            self.flush()
+            #     maxid = self.db(self.table).select(self.table.id.max().with_alias('maxid')).first().maxid
+            #     nextid = self.__nextid()
+            #     if nextid<=maxcid:
+            #         self.db.executesql(syncquery(self.table_name))
+            self.db.commit()
         else:
+            # Rows already flushed are in the open transaction, a later
+            # commit would persist a partial import
+            self.db.rollback()
             raise
 
+    def flush(self):
+        """ Streams buffered rows to the db with COPY FROM STDIN and empties the
+        buffer. Upstream copyers are flushed first so that foreign keys are
+        always satisfied. Nothing is committed here.
+        """
+        for copyer in self.upstream:
+            copyer.flush()
+
+        if self.rows:
+            self.csv.seek(0)
+            try:
+                self.adapter.cursor.copy_from(self.csv, self.table_name, null='NULL')
+            except Exception as err:
+                self.db.rollback()
+                with open("/tmp/{}".format(self.table_name), "w") as foo:
+                    foo.write(self.csv.getvalue())
+                raise
+            self._reset()
+
+    @staticmethod
+    def point(*coordinates, srid=4326):
+        """ Returns the point geometry value in the format expected by COPY
+        coordinates @tuple : lon, lat, height (optional)
+        """
+        return "SRID={:d};POINT({})".format(srid, ' '.join(map(repr, coordinates)))
+
+    def _is_full(self):
+        return (not self.max_rows is None and self.rows >= self.max_rows) or \
+            (not self.max_bytes is None and self.csv.tell() >= self.max_bytes)
+
+    def _reserve_ids(self, n):
+        """ Reserves n ids from the table sequence with one single query.
+        Every nextval call is atomic so the reserved ids are never shared with
+        other sessions writing to the same table, even if, in case of concurrent
+        writers, they are not guaranteed to be contiguous.
+        Reserved ids left unused at the end of the copy are just lost as gaps.
+
+        n @int : Number of ids to reserve.
+        """
+        sql = "select nextval('{}_id_seq') from generate_series(1, {:d})"
+        return [row[0] for row in self.db.executesql(sql.format(self.table_name, n))]
+
+    def nextid(self):
+        """ -> [1] """
+        try:
+            return next(self.__ids)
+        except StopIteration:
+            self.__ids = iter(self._reserve_ids(self.block_size))
+            return next(self.__ids)
+
     def writerow(self, d):
         """ -> [1] """
-        # self.maxid += 1
-        d['id'] = self.db.executesql("select nextval('{}_id_seq')".format(self.table_name))[0][0]
+        d['id'] = self.nextid()
         self.writer.writerow(d)
+        self.rows += 1
+        if self._is_full():
+            self.flush()
         return d['id']
+
+
+# PostgreSQL binary COPY format
+# Reference: https://www.postgresql.org/docs/current/sql-copy.html#id-1.9.3.55.9.4
+
+PGCOPY_HEADER = b'PGCOPY\n\xff\r\n\x00' + Struct('!ii').pack(0, 0)
+PGCOPY_TRAILER = Struct('!h').pack(-1)
+
+PG_EPOCH = datetime(2000, 1, 1)
+PG_EPOCH_DATE = PG_EPOCH.date()
+
+_int2 = Struct('!h')
+_int4 = Struct('!i')
+_int8 = Struct('!q')
+_float8 = Struct('!d')
+_length = _int4.pack
+_null = _length(-1)
+
+# EWKB flags
+WKB_Z = 0x80000000
+WKB_SRID = 0x20000000
+WKB_POINT = 1
+
+_ewkt_point = re.compile(
+    r'^\s*(?:SRID=(\d+);)?\s*POINT\s*Z?\s*\(\s*(\S+)\s+(\S+)(?:\s+(\S+))?\s*\)\s*$',
+    re.IGNORECASE
+)
+
+def ewkb_point(*coordinates, srid=4326):
+    """ Returns the little endian EWKB of a point
+    coordinates @tuple : lon, lat, height (optional)
+    srid @integer : Spatial reference identifier
+    """
+    gtype = WKB_POINT | WKB_SRID | (WKB_Z if len(coordinates)>2 else 0)
+    return Struct('<BII{:d}d'.format(len(coordinates))).pack(1, gtype, srid, *coordinates)
+
+def ewkb(value, srid=4326):
+    """ Converts a geometry value as accepted by the text COPY format (EWKT/WKT)
+    to EWKB. Points are encoded directly, other geometries through shapely.
+    """
+    if isinstance(value, (bytes, bytearray,)):
+        return bytes(value)
+    match = _ewkt_point.match(value)
+    if not match is None:
+        _srid, *coordinates = match.groups()
+        return ewkb_point(
+            *map(float, filter(lambda c: not c is None, coordinates)),
+            srid = srid if _srid is None else int(_srid)
+        )
+    from shapely import wkt, wkb
+    _srid, _, text = value.rpartition(';')
+    return wkb.dumps(wkt.loads(text), srid=int(_srid[5:]) if _srid else srid)
+
+def _encode_text(value):
+    if isinstance(value, bool):
+        value = 'T' if value else 'F'
+    return str(value).encode('utf-8')
+
+def _encode_bool(value):
+    if isinstance(value, str):
+        value = value.upper() in ('T', 'TRUE', '1', 'Y', 'YES', 'ON',)
+    return b'\x01' if value else b'\x00'
+
+def _encode_timestamp(value):
+    if not value.tzinfo is None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return _int8.pack((value-PG_EPOCH)//timedelta(microseconds=1))
+
+encoders = {
+    'smallint': lambda value: _int2.pack(int(value)),
+    'integer': lambda value: _int4.pack(int(value)),
+    'bigint': lambda value: _int8.pack(int(value)),
+    'double precision': lambda value: _float8.pack(float(value)),
+    'boolean': _encode_bool,
+    'text': _encode_text,
+    'character': _encode_text,
+    'character varying': _encode_text,
+    'json': _encode_text,
+    'jsonb': lambda value: b'\x01' + _encode_text(value),
+    'timestamp without time zone': _encode_timestamp,
+    'timestamp with time zone': _encode_timestamp,
+    'date': lambda value: _int4.pack((value-PG_EPOCH_DATE).days),
+    'geometry': ewkb,
+}
+
+
+class BinaryRowEncoder(object):
+    """ Encodes dict rows to the PostgreSQL binary COPY format """
+
+    def __init__(self, columns, defaults={}):
+        """
+        columns   @list : (<field name>, <PostgreSQL type name>) couples in COPY order;
+        defaults  @dict : Values (or callables) used for fields missing in rows.
+        """
+        super(BinaryRowEncoder, self).__init__()
+        try:
+            self.columns = [(name, encoders[pgtype],) for name, pgtype in columns]
+        except KeyError as err:
+            raise NotImplementedError("Type {} not supported by binary COPY".format(err))
+        self.defaults = defaults
+        self.count = _int2.pack(len(self.columns))
+
+    def __call__(self, row):
+        """ Returns the encoded row tuple as bytes
+        row @dict :
+        """
+        out = [self.count]
+        for name, encoder in self.columns:
+            try:
+                value = row[name]
+            except KeyError:
+                value = self.defaults.get(name)
+                if callable(value):
+                    value = value()
+            if value is None or value == 'NULL':
+                out.append(_null)
+            else:
+                data = encoder(value)
+                out.append(_length(len(data)))
+                out.append(data)
+        return b''.join(out)
+
+
+class BinaryBulkCopyer(BulkCopyer):
+    """ BulkCopyer sending rows in the PostgreSQL binary COPY format.
+    Column types are read from the db catalog, so every value is sent already
+    in its final representation and the server doesn't need to parse it.
+    """
+
+    def __init__(self, table, *args, **kwargs):
+        self.columns = self.__get_columns(table)
+        super(BinaryBulkCopyer, self).__init__(table, *args, **kwargs)
+        self.encoder = BinaryRowEncoder(
+            [(name, pgtype,) for name, _, pgtype in self.columns],
+            defaults = {field.name: field.default for field in table}
+        )
+        self.copy_sql = "COPY {} ({}) FROM STDIN WITH (FORMAT binary)".format(
+            self.table_name, ', '.join('"{}"'.format(rname) for _, rname, _ in self.columns)
+        )
+
+    @staticmethod
+    def __get_columns(table):
+        """ Returns (<field name>, <column name>, <column type>) for each table field """
+        rnames = {(getattr(field, '_raw_rname', None) or field.name): field.name for field in table}
+        res = table._db.executesql("""SELECT attname, format_type(atttypid, NULL)
+            FROM pg_attribute
+            WHERE attrelid = '{}'::regclass AND attnum > 0 AND NOT attisdropped
+            ORDER BY attnum""".format(table._tablename))
+        return [(rnames[rname], rname, pgtype,) for rname, pgtype in res if rname in rnames]
+
+    def _reset(self):
+        self.csv = io.BytesIO()
+        self.csv.write(PGCOPY_HEADER)
+        self.rows = 0
+
+    def flush(self):
+        """ See: BulkCopyer.flush """
+        for copyer in self.upstream:
+            copyer.flush()
+
+        if self.rows:
+            self.csv.write(PGCOPY_TRAILER)
+            self.csv.seek(0)
+            try:
+                self.adapter.cursor.copy_expert(self.copy_sql, self.csv)
+            except Exception as err:
+                self.db.rollback()
+                with open("/tmp/{}.pgcopy".format(self.table_name), "wb") as foo:
+                    foo.write(self.csv.getvalue())
+                raise
+            self._reset()
+
+    point = staticmethod(ewkb_point)
+
+    def writerow(self, d):
+        """ See: BulkCopyer.writerow """
+        d['id'] = self.nextid()
+        self.csv.write(self.encoder(d))
+        self.rows += 1
+        if self._is_full():
+            self.flush()
+        return d['id']
+
+
+copyers = {
+    'text': BulkCopyer,
+    'binary': BinaryBulkCopyer
+}
@@ -0,0 +1,303 @@
+# -*- coding: utf-8 -*-
+
+"""
+Pipelined OSM import.
+
+Elements are decoded in a background thread, transformed into ready to copy
+row values by a process pool and written by the calling process into the
+BulkCopyer targets. Stages are connected by bounded queues so memory usage
+only depends on chunk size and number of chunks in flight.
+
+    decode (thread) -> transform (process pool) -> write (BulkCopyer)
+
+Elements are dicts in the Overpass JSON output format, i.e.:
+    {"type": "node", "id": 1, "lat": 44.4, "lon": 8.9, "tags": {...}, "version": 1, ...}
+    {"type": "way", "id": 2, "nodes": [1, ...], "tags": {...}, ...}
+    {"type": "relation", "id": 3, "members": [{"type": "way", "ref": 2, "role": "outer"}, ...], ...}
+"""
+
+from collections import deque
+from multiprocessing import Pool, cpu_count
+from threading import Thread
+from queue import Queue
+from datetime import datetime
+from io import BytesIO
+
+from .base import BaseCopier, jsondumps, normalize_tags_for_db, chunks
+from .pgcopy import copyers as copyers_by_format
+from .idmap import IdMap
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+try:
+    from ujson import loads as jsloads
+except ImportError:
+    from json import loads as jsloads
+
+import logging
+logger = logging.getLogger(__name__)
+
+SOURCE_NAME = 'osm'
+
+# Element keys that are not OSM meta attributes (see overpy)
+_not_attributes = {"type", "id", "lat", "lon", "tags", "nodes", "members", "center", "geometry", "bounds"}
+
+_suid = lambda gtype, source_id: "{}-{}-{}".format(SOURCE_NAME, gtype, source_id)
+
+def _json(value):
+    return 'NULL' if value is None else jsondumps(value)
+
+def prepare(elements, format='text'):
+    """ Transforms elements into tuples of ready to copy values.
+    To be run in worker processes.
+
+    elements @list : Overpass JSON like elements;
+    format @string : COPY format ("text" or "binary").
+
+    returns:
+        [(<gtype>, <source id>, <suid>, <tags>, <attributes>, <payload>), ...]
+        where payload is the point geometry for nodes, the list of node ids
+        for ways and the list of (<member type>, <ref>, <role>) for relations.
+    """
+    point = copyers_by_format[format].point
+    out = []
+    for element in elements:
+        gtype = element["type"]
+        tags = element.get("tags")
+        attributes = {k: v for k, v in element.items() if not k in _not_attributes}
+        if gtype == "node":
+            payload = point(float(element["lon"]), float(element["lat"]))
+        elif gtype == "way":
+            payload = element.get("nodes", [])
+        elif gtype == "relation":
+            payload = [(m["type"], m["ref"], m.get("role"),) for m in element.get("members", [])]
+        else:
+            continue
+        out.append((
+            gtype,
+            element["id"],
+            _suid(gtype, element["id"]),
+            _json(None if tags is None else normalize_tags_for_db(tags)),
+            _json(attributes or None),
+            payload,
+        ))
+    return out
+
+def iter_elements(source):
+    """ Yields elements from an Overpass JSON response.
+    source @bytes/file : Raw response or file like object.
+    """
+    if isinstance(source, (bytes, str,)):
+        if ijson is None:
+            yield from jsloads(source)["elements"]
+            return
+        source = BytesIO(source if isinstance(source, bytes) else source.encode())
+    if ijson is None:
+        yield from jsloads(source.read())["elements"]
+    else:
+        yield from ijson.items(source, "elements.item", use_float=True)
+
+def background(iterable, maxsize=4):
+    """ Consumes iterable in a background thread through a bounded queue """
+    queue = Queue(maxsize)
+    end = object()
+    failure = []
+
+    def _main():
+        try:
+            for item in iterable:
+                queue.put(item)
+        except Exception as err:
+            failure.append(err)
+        finally:
+            queue.put(end)
+
+    Thread(target=_main, daemon=True).start()
+    while True:
+        item = queue.get()
+        if item is end:
+            break
+        yield item
+    if failure:
+        raise failure[0]
+
+def run(chunks, writer, transform=prepare, workers=None, max_pending=None, **kw):
+    """ Transforms chunks in a process pool and hands results to writer in
+    input order, with at most max_pending chunks in flight.
+
+    chunks @iterable : Input chunks;
+    writer @callable : Called in this process with every transformed chunk;
+    transform @callable : Picklable function run by workers on every chunk;
+    workers     @int : Number of worker processes (default: number of cpus);
+    max_pending @int : Max number of chunks in flight (default: 2*workers);
+    kw : Further transform keyword arguments.
+    """
+    workers = workers or cpu_count()
+    max_pending = max_pending or 2*workers
+    with Pool(workers) as pool:
+        pending = deque()
+        for chunk in chunks:
+            pending.append(pool.apply_async(transform, (chunk,), kw))
+            if len(pending) >= max_pending:
+                writer(pending.popleft().get())
+        while pending:
+            writer(pending.popleft().get())
+
+
+class PipelineCopier(BaseCopier):
+    """ Writes transformed elements (see: prepare) with BulkCopyer.
+    Elements already in db are not written again but their ids are used
+    for references.
+    """
+
+    def __init__(self, db):
+        """
+        db @DAL : The database in wich info, node, way_node and relation tables are defined.
+        """
+        super(PipelineCopier, self).__init__(db, source_name=SOURCE_NAME)
+        # Ids cached by source id:
+        # nodes: (<info id>, <node id>), ways and relations: <info id>
+        self.cache = {"node": IdMap(width=2), "way": IdMap(), "relation": IdMap()}
+        # Members referring to relations not yet written, written at the end
+        self.members = []
+        self.missing = 0
+
+    @property
+    def format(self):
+        return self.copy_options.get('format', 'text')
+
+    def __enter__(self):
+        self._insinfo, self._insnodes, self._insways, self._insrelation = self.copyers = self._copyers(
+            self.db.info, self.db.node, self.db.way_node, self.db.relation
+        )
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self._write_deferred_members()
+            if self.missing:
+                logger.warning("{} references to elements not found were skipped".format(self.missing))
+            # Flushes and commits in foreign key order
+            for copyer in self.copyers:
+                copyer.__exit__(None, None, None)
+        else:
+            # Flushed rows are in the open transaction (see: BulkCopyer.__exit__)
+            self.db.rollback()
+
+    def _already_in_db(self, suids):
+        """ Caches ids of elements already in db and returns their suids """
+        res = self.db.executesql("""SELECT info.gtype, info.source_id, info.suid, info.id, node.id
+            FROM info LEFT JOIN node ON node.info_id = info.id
+            WHERE info.suid = ANY(%s)""", placeholders=[suids])
+        for gtype, source_id, _, info_id, node_id in res:
+            if gtype == "node":
+                # Node infos without geometry are not referenced by ways
+                if not node_id is None:
+                    self.cache["node"][int(source_id)] = (info_id, node_id,)
+            else:
+                self.cache[gtype][int(source_id)] = info_id
+        return set(row[2] for row in res)
+
+    def _write_info(self, gtype, source_id, suid, tags, attributes, timestamp):
+        return self._insinfo.writerow(dict(
+            source_name = self.source_name,
+            source_id = source_id,
+            gtype = gtype,
+            suid = suid,
+            tags = tags,
+            properties = 'NULL',
+            attributes = attributes,
+            created_on = timestamp,
+            modified_on = timestamp
+        ))
+
+    def __call__(self, rows):
+        """ Writes a chunk of transformed elements """
+        skip = self._already_in_db([row[2] for row in rows])
+        timestamp = datetime.now()
+        for gtype, source_id, suid, tags, attributes, payload in rows:
+            if suid in skip or source_id in self.cache[gtype]:
+                continue
+            info_id = self._write_info(gtype, source_id, suid, tags, attributes, timestamp)
+            if gtype == "node":
+                node_id = self._insnodes.writerow(dict(info_id=info_id, geom=payload))
+                self.cache["node"][source_id] = (info_id, node_id,)
+            elif gtype == "way":
+                self.cache["way"][source_id] = info_id
+                # Missing nodes are skipped keeping sorting contiguous (as
+                # osmchange does), i.e. consecutive nodes stay graph edges
+                sorting = 0
+                for ref in payload:
+                    _, node_id = self.cache["node"].get(ref, (None, None,))
+                    if node_id is None:
+                        self.missing += 1
+                        continue
+                    self._insways.writerow(dict(info_id=info_id, node_id=node_id, sorting=sorting))
+                    sorting += 1
+            else:
+                self.cache["relation"][source_id] = info_id
+                # Nodes and ways come before relations, only references to
+                # relations could be still unknown.
+                self.members.extend(self._write_members(info_id, payload, defer=True))
+
+    def _write_member(self, info_id, mtype, ref, role):
+        member_id = self.cache[mtype][ref]
+        if mtype == "node":
+            member_id = member_id[0]
+        self._insrelation.writerow(dict(info_id=info_id, member_id=member_id, role=role))
+
+    def _write_members(self, info_id, members, defer=False):
+        """ Writes relation members and yields the deferred ones """
+        for mtype, ref, role in members:
+            try:
+                self._write_member(info_id, mtype, ref, role)
+            except KeyError:
+                if defer and mtype == "relation":
+                    yield (info_id, [(mtype, ref, role,)],)
+                else:
+                    self.missing += 1
+
+    def _write_deferred_members(self):
+        for info_id, members in self.members:
+            for _ in self._write_members(info_id, members):
+                pass
+        self.members = []
+
+
+def copy_chunks(chunks, db, transform=prepare, workers=None, max_pending=None, **copy_options):
+    """ Copies chunks to db through the pipeline.
+
+    chunks @iterable : Input chunks;
+    db @DAL : The database in wich info, node, way_node and relation tables are defined;
+    transform @callable : Picklable function returning the prepared elements
+        of a chunk (see: prepare), called with the format keyword argument;
+    workers @int : Number of transform worker processes;
+    max_pending @int : Max number of chunks in flight;
+    copy_options : BulkCopyer options (see: BaseCopier.copy_options).
+    """
+    copier = PipelineCopier(db)
+    copier.copy_options = copy_options
+    with copier:
+        run(background(chunks), copier,
+            transform = transform,
+            workers = workers,
+            max_pending = max_pending,
+            format = copier.format
+        )
+    return copier.cache
+
+def copy(elements, db, workers=None, chunk_size=5000, max_pending=None, **copy_options):
+    """ Copies OSM elements to db through the pipeline.
+
+    elements @iterable : Overpass JSON like elements (see: iter_elements);
+    chunk_size @int : Number of elements transformed by a worker at once;
+    For other parameters see: copy_chunks.
+    """
+    return copy_chunks(chunks(elements, chunk_size), db,
+        workers = workers,
+        max_pending = max_pending,
+        **copy_options
+    )
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+
+"""
+Overpass request planning for tile syncs.
+
+Dirty tiles are merged bottom up into their quadtree parents, as long as
+the parent is filled enough by dirty tiles (so that few clean tiles are
+downloaded again) and the expected size of the merged request stays within
+budget. Each resulting group is fetched with a single query on the bbox of
+its tile and the combined result can be split back onto the member tiles.
+"""
+
+from collections import defaultdict
+
+import mercantile as mc
+
+class Group(object):
+    """ A set of tiles fetched together on the bbox of a quadtree tile """
+
+    def __init__(self, tile, members, weight, area):
+        """
+        tile @tuple : (<x>, <y>, <zoom>) of the fetched tile;
+        members @dict : {<key>: (<x>, <y>, <zoom>)} of the merged tiles;
+        weight @float : Expected cost of the request;
+        area @int : Area covered by members in tiles of the max zoom.
+        """
+        super(Group, self).__init__()
+        self.tile = tile
+        self.members = members
+        self.weight = weight
+        self.area = area
+
+    def __repr__(self):
+        return "<Group {} of {} tiles>".format(self.tile, len(self.members))
+
+    @property
+    def bbox(self):
+        """ Bounds in the Overpass bbox-query format """
+        bounds = mc.bounds(*self.tile)
+        return dict(zip(('w', 's', 'e', 'n',), map(str, bounds)))
+
+def plan(tiles, budget=64, min_fill=.5, weight=None):
+    """ Merges neighbouring tiles into quadtree parents.
+
+    tiles @iterable : (<key>, <x>, <y>, <zoom>) of the tiles to fetch;
+    budget @float : Max expected cost of a single request;
+    min_fill @float : Min ratio of the area of a parent covered by tiles to fetch;
+    weight @callable : Returns the expected cost of fetching a tile given its
+        key (e.g. its element count or response size at the previous sync).
+        Default: 1 for each tile, i.e. budget is the max number of tiles.
+
+    Returns the list of groups (see: Group).
+    """
+    weight = weight or (lambda key: 1)
+    tiles = list(tiles)
+    if not tiles:
+        return []
+    maxzoom = max(z for _, _, _, z in tiles)
+
+    level = defaultdict(list)
+    for key, x, y, z in tiles:
+        level[z].append(Group((x, y, z,), {key: (x, y, z,)}, weight(key), 4**(maxzoom-z)))
+
+    out = []
+    for z in range(maxzoom, 0, -1):
+        parents = defaultdict(list)
+        for group in level.pop(z, []):
+            x, y, _ = group.tile
+            parents[(x//2, y//2, z-1,)].append(group)
+        for parent, children in parents.items():
+            members = {}
+            for child in children:
+                members.update(child.members)
+            merged = Group(parent, members,
+                weight = sum(child.weight for child in children),
+                area = min(4**(maxzoom-z+1), sum(child.area for child in children))
+            )
+            if merged.weight <= budget and merged.area >= min_fill*4**(maxzoom-z+1):
+                level[z-1].append(merged)
+            else:
+                out.extend(children)
+    out.extend(level.pop(0, []))
+    return out
+
+def split(result, group):
+    """ Assigns the elements of a combined response to the member tiles of the group.
+
+    result @overpy.Result : The response of the group query;
+    group @Group :
+
+    Returns {<key>: {"node": [<id>, ...], "way": [...], "relation": [...]}};
+    ways and relations are assigned to the tiles of their nodes.
+    """
+    out = {key: {"node": [], "way": [], "relation": []} for key in group.members}
+    lookup = {tile: key for key, tile in group.members.items()}
+    zooms = set(z for _, _, z in group.members.values())
+
+    def _keys(lon, lat):
+        for z in zooms:
+            tile = mc.tile(float(lon), float(lat), z)
+            try:
+                yield lookup[(tile.x, tile.y, tile.z,)]
+            except KeyError:
+                continue
+
+    node_keys = {}
+    for node in result.nodes:
+        node_keys[node.id] = keys = set(_keys(node.lon, node.lat))
+        for key in keys:
+            out[key]["node"].append(node.id)
+
+    way_keys = {}
+    for way in result.ways:
+        way_keys[way.id] = keys = set()
+        for node_id in way._node_ids:
+            keys.update(node_keys.get(node_id, ()))
+        for key in keys:
+            out[key]["way"].append(way.id)
+
+    for relation in result.relations:
+        keys = set()
+        for member in relation.members:
+            if member._type_value == "node":
+                keys.update(node_keys.get(member.ref, ()))
+            elif member._type_value == "way":
+                keys.update(way_keys.get(member.ref, ()))
+        for key in keys:
+            out[key]["relation"].append(relation.id)
+
+    return out
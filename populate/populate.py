@@ -1,10 +1,10 @@
 # -*- coding: utf-8 -*-
 
 from geojson import Point, Feature, FeatureCollection
-from itertools import groupby
 from .gjson import NodeParser, PolygonParser, WayParser
 from .gjson import NodeCopier, PolygonCopier, WayCopier
 from .osm import Parser, Copier
+from .stream import iter_features, route, BATCH_SIZE
 try:
     from ujson import loads as jsloads
 except ImportError:
@@ -12,10 +12,15 @@ except ImportError:
 
 from ..models import db
 
-def collection2db(collection, source_name='__GENERIC__', copy=False, **kw):
-    data = jsloads(collection) if isinstance(collection, str) else collection
-    grouping = lambda feat: feat['geometry']['type']
-    data_by_type = groupby(sorted(data['features'], key=grouping), key=grouping)
+def collection2db(collection, source_name='__GENERIC__', copy=False, batch_size=BATCH_SIZE, **kw):
+    """
+    collection : GeoJSON FeatureCollection as dict, json string, file object
+                 or file path, also newline-delimited (see: stream.iter_features).
+                 Features are streamed and routed to parsers in batches.
+    source_name @string : Source name
+    copy @bool : Use the COPY based loaders
+    batch_size @int : Number of features handed to parsers at once
+    """
     if copy:
         node_parser = NodeCopier(db, source_name, **kw)
         polygon_parser = PolygonCopier(db, source_name, **kw)
@@ -25,15 +30,11 @@ def collection2db(collection, source_name='__GENERIC__', copy=False, **kw):
         polygon_parser = PolygonParser(db, source_name, **kw)
         linestring_parser = WayParser(db, source_name, **kw)
 
-    for tt, features in data_by_type:
-        if tt=='Point':
-            node_parser.parse(features)
-        elif tt=='Polygon':
-            polygon_parser.parse(features)
-        elif tt == 'LineString':
-            linestring_parser.parse(features)
-        else:
-            raise NotImplementedError
+    route(iter_features(collection), {
+        'Point': node_parser,
+        'Polygon': polygon_parser,
+        'LineString': linestring_parser
+    }, batch_size=batch_size)
 
 def feature2db(feature, source_name='__GENERIC__', **kw):
     data = jsloads(feature) if isinstance(feature, str) else feature
@@ -83,22 +84,28 @@ def osm2db(nodes, ways, relations, copy=True, **kw):
             ).select(
                 db.info.id,
                 db.info.gtype,
-                db.info.source_id
+                db.info.source_id,
+                db.node.id,
+                left = db.node.on(db.node.info_id==db.info.id)
             ).group_by_value(db.info.gtype)
 
+            in_db = {k: set(int(row.info.source_id) for row in rows) for k,rows in res.items()}
+
+            # Cached ids as expected by Copier. Node infos without a node row have
+            # no node id to be referenced by ways, they are left out.
             already_in_db = {
-                k: {int(row.source_id): row for row in rows} \
-                    for k,rows in res.items()
+                k: {int(row.info.source_id): (row.info.id, row.node.id,) if k=='node' else row.info.id \
+                    for row in rows if k!='node' or not row.node.id is None} for k,rows in res.items()
             }
 
             def is_not_in_db(k):
 
                 try:
-                    myobjs = already_in_db[k]
+                    myobjs = in_db[k]
                 except KeyError:
                     return lambda _: True
                 else:
-                    return lambda nn: not str(nn.id) in myobjs
+                    return lambda nn: not nn.id in myobjs
 
             Copier(db, source_name='OSM', **already_in_db).parse(
                 nodes = filter(is_not_in_db('node'), nodes),
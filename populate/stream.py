@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+
+"""
+Streaming GeoJSON ingestion helpers.
+
+Features are read one at a time (with ijson, when installed, or from
+newline-delimited GeoJSON) and routed in batches to the parser of their
+geometry type, so memory usage only depends on the batch size.
+
+Multi line FeatureCollections are streamed with ijson only, without it
+(or with file objects that are not seekable) they are loaded whole.
+"""
+
+import os
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+try:
+    from ujson import loads as jsloads
+except ImportError:
+    from json import loads as jsloads
+
+import logging
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 10000
+
+def _iter_file(fileobj):
+    """ Yields features from a GeoJSON FeatureCollection or a newline-delimited
+    GeoJSON (one feature per line) file object.
+    Multi line FeatureCollections are loaded in memory when ijson is not
+    installed or fileobj is not seekable.
+    """
+    first = fileobj.readline()
+    try:
+        data = jsloads(first)
+    except ValueError:
+        # Multi line FeatureCollection
+        data = None
+    if isinstance(data, dict):
+        if data.get("type") == "Feature":
+            yield data
+            for line in fileobj:
+                if line.strip():
+                    yield jsloads(line)
+            return
+        elif data.get("type") == "FeatureCollection":
+            # The whole collection in one line
+            yield from data["features"]
+            return
+
+    if ijson is None or not fileobj.seekable():
+        logger.warning("Multi line FeatureCollection loaded in memory ({})".format(
+            "ijson not installed" if ijson is None else "file not seekable"
+        ))
+        yield from jsloads(first + fileobj.read())["features"]
+    else:
+        fileobj.seek(0)
+        yield from ijson.items(fileobj, "features.item", use_float=True)
+
+def iter_features(source):
+    """ Yields GeoJSON features one at a time.
+
+    source : One of:
+        * a FeatureCollection as dict (or any object with a "features" iterable);
+        * a FeatureCollection as json string;
+        * a file object or a file path of a FeatureCollection or a
+          newline-delimited GeoJSON.
+    """
+    if hasattr(source, "read"):
+        yield from _iter_file(source)
+    elif isinstance(source, (str, bytes,)) and not source.lstrip()[:1] in ("{", b"{",) and os.path.isfile(source):
+        with open(source, "rb") as fileobj:
+            yield from _iter_file(fileobj)
+    elif isinstance(source, (str, bytes,)):
+        yield from jsloads(source)["features"]
+    else:
+        yield from source["features"]
+
+def route(features, parsers, batch_size=BATCH_SIZE):
+    """ Routes features on the fly to the parser of their geometry type.
+    Features are handed to parsers in batches of at most batch_size elements.
+
+    features @iterable : GeoJSON features;
+    parsers @dict : {<geometry type>: <parser with a parse method>};
+    batch_size @int :
+    """
+    batches = {}
+    for feature in features:
+        gtype = feature["geometry"]["type"]
+        try:
+            parser = parsers[gtype]
+        except KeyError:
+            raise NotImplementedError(gtype)
+        batch = batches.setdefault(gtype, [])
+        batch.append(feature)
+        if len(batch) >= batch_size:
+            parser.parse(batch)
+            batches[gtype] = []
+
+    for gtype, batch in batches.items():
+        if batch:
+            parsers[gtype].parse(batch)
@@ -2,11 +2,15 @@
 # -*- coding: utf-8 -*-
 
 import mercantile as mc
-from math import modf
-import pyproj
+from math import modf, log2, floor, pi
+from ..tools.proj import transform
 
 BASE_DIM = 155
 
+# Web Mercator (EPSG:3857) equator circumference in meters (as in mercantile)
+CE = 2*pi*6378137.0
+MAX_ZOOM = 29
+
 class Bbox(object):
     """docstring for Bbox."""
 
@@ -24,12 +28,7 @@ class Bbox(object):
         self.maxy = maxy
 
     def dims(self, crs="epsg:3857"):
-        osmproj = pyproj.Proj(crs)
-        minx, miny = osmproj(self.minx, self.miny)
-        maxx, maxy = osmproj(self.maxx, self.maxy)
-        # transformer = Transformer.from_crs(self.crs, crs)
-        # minx, miny = transformer.transform(self.minx, self.miny)
-        # maxx, maxy = transformer.transform(self.maxx, self.maxy)
+        (minx, maxx), (miny, maxy) = transform((self.minx, self.maxx), (self.miny, self.maxy), dst=crs)
         return maxx-minx, maxy-miny
 
     @property
@@ -41,6 +40,19 @@ class Bbox(object):
         return str(self.osm)
 
 
+def base_zoom(bdim=BASE_DIM):
+    """ Returns the lowest zoom level of tiles smaller than bdim**2 square
+    meters (in EPSG:3857 units, so it doesn't depend on latitude).
+    bdim @float : Base tile dimension in meters.
+    """
+    zoom = floor(log2(CE/bdim))+1
+    # Guards against rounding at exact powers of 2
+    while zoom < MAX_ZOOM and CE/2**zoom >= bdim:
+        zoom += 1
+    while zoom > 0 and CE/2**(zoom-1) < bdim:
+        zoom -= 1
+    return max(0, min(MAX_ZOOM, zoom))
+
 def get_base_tile(lon, lat, bdim=BASE_DIM):
     """
     lon  @float : Center longitude.
@@ -52,14 +64,8 @@ def get_base_tile(lon, lat, bdim=BASE_DIM):
                               point of given coordinates.
         zoom_level @integer : The tile zoom level.
     """
-    max_zoom_level = 30
-    max_area = bdim**2
-    for zoom_level in range(max_zoom_level):
-        tt = mc.tile(lon, lat, zoom_level)
-        bb = mc.xy_bounds(tt)
-        if (bb.right-bb.left)*(bb.top-bb.bottom) < max_area:
-            break
-    return tt, zoom_level
+    zoom_level = base_zoom(bdim)
+    return mc.tile(lon, lat, zoom_level), zoom_level
 
 def __get_box_dim(bt, dist):
     """ """
@@ -118,3 +124,20 @@ def boxtiles(dist, lon, lat, bdim=BASE_DIM, buffer=4):
     #             bounds.north
     #         )
     # return out
+
+def polygontiles(geom, bdim=BASE_DIM):
+    """ Yields the base tiles intersecting a polygon.
+    geom : Shapely geometry or GeoJSON like geometry dict (lon/lat coordinates);
+    bdim @float : Base tile dimension in meters.
+    """
+    from shapely.geometry import shape, box
+    from shapely.prepared import prep
+
+    if not hasattr(geom, "bounds"):
+        geom = shape(geom)
+    centroid = geom.centroid
+    _, zoom = get_base_tile(centroid.x, centroid.y, bdim)
+    pgeom = prep(geom)
+    for tt in mc.tiles(*geom.bounds, zooms=[zoom]):
+        if pgeom.intersects(box(*mc.bounds(tt))):
+            yield tt.x, tt.y, tt.z,
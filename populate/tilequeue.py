@@ -1,46 +1,120 @@
 # -*- coding: utf-8 -*-
 
+"""
+Multi worker tile queue.
+
+Tiles are claimed for a lease period: a tile is available when it's not
+queued or its lease expired (e.g. because the worker crashed). Workers
+working on a tile for longer than the lease have to renew it (see: heartbeat).
+Candidate tiles are locked with FOR UPDATE SKIP LOCKED so concurrent
+workers never wait for each other or claim the same tiles.
+"""
+
 from .models import db
-import datetime
+import datetime, os, socket
 
 now = lambda: datetime.datetime.utcnow()
 
+# Default lease period in seconds
+LEASE = 600
+
 populate_query = (db.tracked_tile.created_on==db.tracked_tile.modified_on)
 
 update_query = lambda :( db.tracked_tile.modified_on<(now()-datetime.timedelta(days=28*6)))
 
-def __reserve_tiles(query, n=10):
-    """ """
+# Default min age of the changes applied to a tile (see: diff_query)
+DIFF_INTERVAL = datetime.timedelta(hours=1)
 
-    res = db(
-        query & \
-        ~db.tracked_tile.id.belongs(db(db.queued_tile)._select(db.queued_tile.tile_id))
-        # (db.tracked_tile.id!=db.queued_tile.tile_id)
-    ).select(
-        db.tracked_tile.id,
-        limitby = (0,n,),
-        orderby = (db.tracked_tile.modified_on|db.tracked_tile.id)
+def diff_query(min_age=DIFF_INTERVAL):
+    """ Already populated tiles not synced for longer than min_age,
+    i.e. the ones diffs apply to (see: tools.sync_queued_tiles).
+    """
+    synced_until = db.tracked_tile.synced_until
+    return (db.tracked_tile.created_on!=db.tracked_tile.modified_on) & (
+        (synced_until<(now()-min_age)) | \
+        ((synced_until==None) & (db.tracked_tile.modified_on<(now()-min_age)))
     )
 
-    def _loopOtiles():
-        for row in res:
-            yield db.queued_tile.insert(tile_id=row.id)
+default_worker = lambda: "{}:{:d}".format(socket.gethostname(), os.getpid())
+
+def claim_tiles(query, n=10, worker=None, lease=LEASE):
+    """ Atomically claims up to n available tiles matching query, by
+    priority and then least recently updated first.
+
+    query @Query : Filter on tracked_tile;
+    n @int : Max number of tiles;
+    worker @string : Worker identifier (default: host name and process id);
+    lease @int : Lease period in seconds.
+
+    Returns the list of queued tile ids.
+    """
+    sql = """WITH candidate AS (
+        SELECT tracked_tile.id FROM tracked_tile
+        WHERE {query} AND NOT EXISTS (
+            SELECT 1 FROM queued_tile
+            WHERE queued_tile.tile_id = tracked_tile.id AND queued_tile.leased_until > now()
+        )
+        ORDER BY COALESCE(tracked_tile.priority, 0) DESC, tracked_tile.modified_on, tracked_tile.id
+        LIMIT %s
+        FOR UPDATE OF tracked_tile SKIP LOCKED
+    )
+    INSERT INTO queued_tile (tile_id, leased_until, worker)
+    SELECT id, now() + make_interval(secs => %s), %s FROM candidate
+    ON CONFLICT (tile_id) DO UPDATE SET
+        leased_until = EXCLUDED.leased_until,
+        worker = EXCLUDED.worker
+    WHERE queued_tile.leased_until IS NULL OR queued_tile.leased_until <= now()
+    RETURNING queued_tile.id""".format(
+        # Escaped as the statement has placeholders
+        query = db._adapter.expand(query).replace("%", "%%")
+    )
 
-    out = list(_loopOtiles())
+    out = [id for id, in db.executesql(sql, placeholders=[n, lease, worker or default_worker()])]
     db.commit()
     return out
 
-def reserve_tiles_for_populate(n=10):
-    return __reserve_tiles(populate_query, n=n)
+def reserve_tiles_for_populate(n=10, **kw):
+    return claim_tiles(populate_query, n=n, **kw)
 
-def reserve_tiles_for_update(n=10):
-    return __reserve_tiles(update_query(), n=n)
+def reserve_tiles_for_update(n=10, **kw):
+    return claim_tiles(update_query(), n=n, **kw)
+
+def reserve_tiles_for_diff(n=10, min_age=DIFF_INTERVAL, **kw):
+    return claim_tiles(diff_query(min_age=min_age), n=n, **kw)
+
+def heartbeat(qid, *qids, lease=LEASE):
+    """ Renews the lease of queued tiles.
+    Returns the ids of the renewed ones, the others expired and could
+    already be claimed by another worker.
+    """
+    out = [id for id, in db.executesql("""UPDATE queued_tile
+        SET leased_until = now() + make_interval(secs => %s)
+        WHERE id = ANY(%s) AND leased_until > now()
+        RETURNING id""", placeholders=[lease, list((qid,)+qids)])]
+    db.commit()
+    return out
 
 def free_tiles(qid, *qids):
     """ """
     db(db.queued_tile.id.belongs((qid,)+qids)).delete()
     db.commit()
 
+def free_expired_tiles():
+    """ Drops expired leases, returns their number """
+    # Leases are compared with the db clock like in claim_tiles
+    count = len(db.executesql("""DELETE FROM queued_tile
+        WHERE leased_until IS NULL OR leased_until <= now() RETURNING id"""))
+    db.commit()
+    return count
+
+def set_priority(priority, tile_id, *tile_ids):
+    """ Tiles with higher priority are claimed first """
+    # Not through the DAL, that would also touch modified_on
+    db.executesql("UPDATE tracked_tile SET priority = %s WHERE id = ANY(%s)",
+        placeholders = [priority, list((tile_id,)+tile_ids)]
+    )
+    db.commit()
+
 def queued_dbset(qid, *qids):
     """ """
 
@@ -3,6 +3,7 @@
 from ...common import logger, T
 from .optutils.base import Turbo
 from . import io
+from . import pipeline
 from .tile import boxtiles
 
 import mercantile as mc
@@ -75,9 +76,14 @@ class MyTqdm(dict):
     def __exit__(self, exc_type, exc_value, traceback):
         self.tqdm.close()
 
-def fetch_and_log_from_osm(query, pgcopy=False):
+def fetch_and_log_from_osm(query, pgcopy=False, workers=None, **kw):
     """
     query @string : The OSM filter query; Overpass QL or XML.
+    pgcopy  @bool : Use the COPY based loader.
+    workers  @int : If given the response is imported through the parallel
+                    pipeline (see: pipeline.copy) with the given number of
+                    transform worker processes. It always uses COPY.
+    kw : Further pipeline.copy options.
     """
 
     # out_task_id = web2py_uuid()
@@ -85,7 +91,20 @@ def fetch_and_log_from_osm(query, pgcopy=False):
     # plugins.planet.logger.info(query)
 
     turbo = Turbo()
-    data = turbo(query)
+
+    if workers:
+        raw_data = turbo.fetch(query)
+        logger.info("Response size: {}".format(smartbytes(len(raw_data))))
+        pipeline.copy(pipeline.iter_elements(raw_data), io.db, workers=workers, **kw)
+        return
+
+    save_osm_data(turbo(query), pgcopy=pgcopy)
+
+def save_osm_data(data, pgcopy=False):
+    """ Saves a parsed Overpass response
+    data @overpy.Result :
+    pgcopy  @bool : Use the COPY based loader.
+    """
 
     nodes = list(tqdm(
         data.nodes,
@@ -145,8 +164,8 @@ class Syncher(object):
             'gtypes': ['node', 'way', 'relation'],
         }
 
-    def __call__(self, newer_than=None):
-        """
+    def query(self, newer_than=None):
+        """ Returns the Overpass query of the tile
         newer_than @datetime : Last update timestamp
         """
         if newer_than is None:
@@ -155,8 +174,124 @@ class Syncher(object):
             _query = dict(self.base_query,
                 newer_than = newer_than.strftime("%Y-%m-%dT%H:%M:%SZ")
             )
+        return Turbo.build_query(lambda: [_query])
+
+    def diff_query(self, since, until=None, timeout=180):
+        """ Returns the Overpass augmented diff query of the tile (see: osmchange)
+        since @datetime : Changes start timestamp;
+        until @datetime : Changes end timestamp (default: now).
+        """
+        fmt = "%Y-%m-%dT%H:%M:%SZ"
+        bbox = "{s},{w},{n},{e}".format(**self.bbox)
+        return '[out:xml][timeout:{timeout:d}][adiff:"{since}"{until}];' \
+            '(node({bbox});way({bbox});relation({bbox}););(._;>;);out meta;'.format(
+            timeout = timeout,
+            since = since.strftime(fmt),
+            until = "" if until is None else ',"{}"'.format(until.strftime(fmt)),
+            bbox = bbox
+        )
 
+    def __call__(self, newer_than=None):
+        """
+        newer_than @datetime : Last update timestamp
+        """
         fetch_and_log_from_osm(
-            Turbo.build_query(lambda: [_query]),
+            self.query(newer_than=newer_than),
             # pgcopy = pgcopy and not update
         )
+
+def sync_queued_tiles(qids, update=False, diff=False, pgcopy=False, workers=None, budget=64, min_fill=.5, **kw):
+    """ Fetches concurrently the tiles reserved in queue (see: tilequeue) and
+    saves responses as they arrive. Neighbouring tiles are fetched together
+    (see: planner.plan) and all marked as synced by a successful request.
+
+    qids @list : Queued tile ids (i.e. the output of tilequeue.reserve_tiles_for_*);
+    update @bool : Fetch only elements changed since the last tile update;
+    diff @bool : Apply the changes since the tile watermark (synced_until) from
+                 Overpass augmented diffs, deletions included (see: osmchange);
+    pgcopy @bool : Use the COPY based loader;
+    workers @int : If given responses are imported through the parallel pipeline;
+    budget @int : Max number of tiles fetched with a single request (1: no merge);
+    min_fill @float : Min ratio of a merged bbox covered by queued tiles;
+    kw : Overpass endpoint limits (see: optutils.aio.Endpoint).
+
+    Returns the dict of exceptions of failed requests (or imports) by group tile.
+    """
+    # Imported here, tilequeue depends on models that depend on this module
+    from .tilequeue import queued_dbset, heartbeat, now
+    from .optutils import aio
+    from . import planner, osmchange
+
+    db = io.db
+    until = now()
+    tiles = {tile.id: tile for tile in queued_dbset(*qids).select(db.tracked_tile.ALL)}
+    groups = {group.tile: group for group in planner.plan(
+        ((tile.id, tile.xtile, tile.ytile, tile.zoom,) for tile in tiles.values()),
+        budget = budget,
+        min_fill = min_fill
+    )}
+
+    def _query(group):
+        # The oldest member update is the safe lower bound for the whole group
+        if diff:
+            since = min(tiles[key].synced_until or tiles[key].modified_on for key in group.members)
+            return Syncher(*group.tile).diff_query(since, until=until)
+        newer_than = min(tiles[key].modified_on for key in group.members) if update else None
+        return Syncher(*group.tile).query(newer_than=newer_than)
+
+    queries = {key: _query(group) for key, group in groups.items()}
+    logger.info("{} tiles fetched with {} requests".format(len(tiles), len(queries)))
+    turbo = Turbo()
+
+    def _save(key, raw_data):
+        group = groups[key]
+        logger.info("{}: {}".format(group, smartbytes(len(raw_data))))
+        if diff:
+            logger.info("{}: {}".format(group, osmchange.apply(raw_data, db)))
+        elif workers:
+            pipeline.copy(pipeline.iter_elements(raw_data), db, workers=workers)
+        else:
+            data = turbo.parse(raw_data)
+            save_osm_data(data, pgcopy=pgcopy)
+            if len(group.members) > 1:
+                for tile_id, elements in planner.split(data, group).items():
+                    logger.debug("Tile {}: {}".format(tiles[tile_id].uri,
+                        ", ".join("{} {}s".format(len(ids), gtype) for gtype, ids in elements.items())
+                    ))
+        # The request covered every member, empty ones included. Tiles of
+        # failed requests or imports are never marked (see: _writer)
+        db(db.tracked_tile.id.belongs(list(group.members))).update(modified_on=now(), synced_until=until)
+        db.commit()
+        # Keeps the tiles still to be synced claimed
+        heartbeat(*qids)
+
+    def _writer(key, raw_data):
+        # Called in this thread (see: aio.fetch_all), failures are
+        # reported by key as the failed requests
+        try:
+            _save(key, raw_data)
+        except Exception:
+            db.rollback()
+            raise
+
+    return aio.fetch_all(queries, _writer, url=turbo.api.url, **kw)
+
+def sync_tiles(n=10, update=False, diff=False, min_age=None, **kw):
+    """ Reserves up to n tiles, syncs them (see: sync_queued_tiles) and frees them.
+    Diffs are applied to already populated tiles only, synced for longer
+    than min_age (see: tilequeue.diff_query).
+    """
+    from .tilequeue import reserve_tiles_for_populate, reserve_tiles_for_update, \
+        reserve_tiles_for_diff, free_tiles, DIFF_INTERVAL
+    if diff:
+        qids = reserve_tiles_for_diff(n=n, min_age=min_age or DIFF_INTERVAL)
+    elif update:
+        qids = reserve_tiles_for_update(n=n)
+    else:
+        qids = reserve_tiles_for_populate(n=n)
+    if not qids:
+        return {}
+    try:
+        return sync_queued_tiles(qids, update=update, diff=diff, **kw)
+    finally:
+        free_tiles(*qids)
@@ -25,7 +25,7 @@ if __name__ == '__main__':
         parser.print_help()
         raise Exception(message)
     else:
-        from .postgresql import setup_views, setup_functions
+        from .postgresql import setup_views, setup_functions, setup_indexes, refresh_views
         # TODO: Cache postgresq super user credentials
         # from diskcache import Cache
         # from .postgresql import setup_views
@@ -37,8 +37,33 @@ if __name__ == '__main__':
     #     dest = 'db_setup'
     # )
 
+    parser.add_argument("-m", "--materialized",
+        help = 'Store ways, graph, polys and mpolys as tables refreshed incrementally',
+        action = 'store_true',
+        default = False,
+        dest = 'materialized'
+    )
+
+    parser.add_argument("-r", "--refresh",
+        help = 'Refresh materialized views with the changes logged since last refresh and exit',
+        action = 'store_true',
+        default = False,
+        dest = 'refresh'
+    )
+
+    parser.add_argument("--no-jsonb",
+        help = 'Do not migrate json columns to jsonb (indexes are created anyway)',
+        action = 'store_false',
+        default = True,
+        dest = 'jsonb'
+    )
+
     args = parser.parse_args()
 
-    setup_views()
-    setup_functions()
-    print("That's it!")
+    if args.refresh:
+        print("{} elements refreshed".format(refresh_views()))
+    else:
+        setup_indexes(jsonb=args.jsonb)
+        setup_views(materialized=args.materialized)
+        setup_functions()
+        print("That's it!")
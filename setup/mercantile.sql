@@ -1,138 +1,121 @@
+-- Tile functions as in the mercantile python module.
+-- All functions are plain SQL expressions, neither STRICT nor with variables,
+-- so that the planner can inline them (and run them in parallel plans).
+
 CREATE OR REPLACE FUNCTION public.T_sinh(x double precision)
-RETURNS double precision LANGUAGE sql IMMUTABLE STRICT AS $$
+RETURNS double precision LANGUAGE sql IMMUTABLE PARALLEL SAFE AS $$
   -- sinh function has been introduced in version 12 of PostgreSQL
   SELECT (exp(x)-exp(-1*x))/2
 $$;
 
+CREATE OR REPLACE FUNCTION public.T_clamp(v double precision, lim double precision, truncated boolean default TRUE)
+RETURNS double precision LANGUAGE sql IMMUTABLE PARALLEL SAFE AS $$
+  -- Clamps v between -lim and lim if truncated
+  SELECT CASE WHEN truncated THEN LEAST(GREATEST(v, -lim), lim) ELSE v END
+$$;
+
 CREATE OR REPLACE FUNCTION public.T_truncate(pnt geometry)
-RETURNS geometry LANGUAGE plpgsql IMMUTABLE STRICT AS $$
-  DECLARE
-    lon double precision;
-    lat double precision;
-    -- srid integer;
+RETURNS geometry LANGUAGE sql IMMUTABLE PARALLEL SAFE AS $$
+  SELECT ST_SetSRID(ST_MakePoint(T_clamp(ST_X(pnt), 180.0), T_clamp(ST_Y(pnt), 90.0)), 4326)
+$$;
 
-  BEGIN
-    lon := GREATEST(ST_X(pnt), -180.0);
-    lon := LEAST(ST_X(pnt), 180.0);
-    lat := GREATEST(ST_Y(pnt), -90.0);
-    lat := LEAST(ST_Y(pnt), 90.0);
+CREATE OR REPLACE FUNCTION public.T_lng(xtile double precision, zoom integer)
+RETURNS double precision LANGUAGE sql IMMUTABLE PARALLEL SAFE AS $$
+  -- Longitude of the left side of a tile column
+  SELECT xtile / 2^zoom * 360.0 - 180.0
+$$;
 
-    RETURN ST_SetSRID(ST_MakePoint(lon, lat), 4326);
-  END
+CREATE OR REPLACE FUNCTION public.T_lat(ytile double precision, zoom integer)
+RETURNS double precision LANGUAGE sql IMMUTABLE PARALLEL SAFE AS $$
+  -- Latitude of the upper side of a tile row
+  SELECT degrees(atan(T_sinh(pi() * (1 - 2 * ytile / 2^zoom))))
 $$;
 
-CREATE OR REPLACE FUNCTION public.T_ul(tile geometry)
-RETURNS geometry LANGUAGE plpgsql IMMUTABLE STRICT AS $$
-  -- Returns the upper left point of a tile
-  DECLARE
-    xtile integer;
-    ytile integer;
-    zoom integer;
-    Z2 double precision;
-    lon double precision;
-    lat double precision;
-    lat_rad double precision;
+CREATE OR REPLACE FUNCTION public.T_x(lon double precision)
+RETURNS double precision LANGUAGE sql IMMUTABLE PARALLEL SAFE AS $$
+  -- Longitude to the [0, 1] unit Mercator x
+  SELECT lon / 360.0 + 0.5
+$$;
 
-  BEGIN
-    xtile := ST_X(tile);
-    ytile := ST_Y(tile);
-    zoom := ST_Z(tile);
+CREATE OR REPLACE FUNCTION public.T_y(sinlat double precision)
+RETURNS double precision LANGUAGE sql IMMUTABLE PARALLEL SAFE AS $$
+  -- Sine of latitude to the [0, 1] unit Mercator y (NULL at the poles)
+  SELECT 0.5 - 0.25 * ln(NULLIF(1.0 + sinlat, 0) / NULLIF(1.0 - sinlat, 0)) / pi()
+$$;
 
-    Z2 := pow(2, zoom);
-    lon := (xtile / Z2 * 360.0) - 180.0;
-    lat_rad := atan(T_sinh(pi() * (1 - 2 * ytile / Z2)));
-    lat := degrees(lat_rad);
+CREATE OR REPLACE FUNCTION public.T_index(v double precision, zoom integer)
+RETURNS integer LANGUAGE sql IMMUTABLE PARALLEL SAFE AS $$
+  -- Unit Mercator coordinate to tile index.
+  -- To address loss of precision in round-tripping between tile
+  -- and lng/lat, points within EPSILON (1e-14) of the right side of a tile
+  -- are counted in the next tile over.
+  SELECT LEAST(GREATEST(floor((v + 1e-14) * 2^zoom), 0), 2^zoom - 1)::integer
+$$;
 
-    RETURN ST_SetSRID(ST_MakePoint(lon, lat), 4326);
-  END
+CREATE OR REPLACE FUNCTION public.T_ul(tile geometry)
+RETURNS geometry LANGUAGE sql IMMUTABLE PARALLEL SAFE AS $$
+  -- Returns the upper left point of a tile
+  SELECT ST_SetSRID(ST_MakePoint(
+    T_lng(ST_X(tile), ST_Z(tile)::integer),
+    T_lat(ST_Y(tile), ST_Z(tile)::integer)
+  ), 4326)
 $$;
 
 CREATE OR REPLACE FUNCTION public.T_bounds(tile geometry)
-RETURNS geometry LANGUAGE plpgsql IMMUTABLE STRICT AS $$
+RETURNS geometry LANGUAGE sql IMMUTABLE PARALLEL SAFE AS $$
   -- Returns the bounding box polygon of a tile
-  DECLARE
-    xtile integer;
-    ytile integer;
-    zoom integer;
-    bl geometry;
-    ur geometry;
-
-  BEGIN
-    xtile := ST_X(tile);
-    ytile := ST_Y(tile);
-    zoom := ST_Z(tile);
-
-    bl = T_ul(ST_MakePoint(xtile, ytile - 1, zoom));
-    ur = T_ul(ST_MakePoint(xtile + 1, ytile, zoom));
-
-    RETURN ST_SetSRID(ST_MakeEnvelope(ST_X(bl), ST_Y(bl), ST_X(ur), ST_Y(ur)), 4326);
-  END
+  SELECT ST_MakeEnvelope(
+    T_lng(ST_X(tile), ST_Z(tile)::integer),
+    T_lat(ST_Y(tile) + 1, ST_Z(tile)::integer),
+    T_lng(ST_X(tile) + 1, ST_Z(tile)::integer),
+    T_lat(ST_Y(tile), ST_Z(tile)::integer),
+    4326
+  )
 $$;
 
 CREATE OR REPLACE FUNCTION public.T_uxy(pnt geometry, truncated boolean default FALSE)
-RETURNS geometry LANGUAGE plpgsql IMMUTABLE STRICT AS $$
-  DECLARE
-    sinlat double precision;
-    x double precision;
-    y double precision;
-
-  BEGIN
-
-    IF truncated THEN
-      pnt = T_truncate(pnt);
-    END IF;
-
-    sinlat := sin(radians(ST_Y(pnt)));
-
-    IF sinlat=1 THEN
-      RETURN NULL;
-    ELSE
-      x = ST_X(pnt) / 360.0 + 0.5;
-      y = 0.5 - 0.25*ln((1.0 + sinlat) / (1.0 - sinlat)) / pi();
-      RETURN ST_SetSRID(ST_MakePoint(x, y), 3857);
-    END IF;
-  END
+RETURNS geometry LANGUAGE sql IMMUTABLE PARALLEL SAFE AS $$
+  -- Returns the point in unit Mercator coordinates (NULL at the poles)
+  SELECT ST_SetSRID(ST_MakePoint(
+    T_x(T_clamp(ST_X(pnt), 180.0, truncated)),
+    T_y(sin(radians(T_clamp(ST_Y(pnt), 90.0, truncated))))
+  ), 3857)
 $$;
 
 CREATE OR REPLACE FUNCTION public.T_tile(pnt geometry, zoom integer, truncated boolean default FALSE)
-RETURNS geometry LANGUAGE plpgsql IMMUTABLE STRICT AS $$
+RETURNS geometry LANGUAGE sql IMMUTABLE PARALLEL SAFE AS $$
   -- Get the tile containing a point
-  DECLARE
-    EPSILON double precision = pow(10, -14);
-    pnt_merc geometry;
-    Z2 integer;
-    xtile integer;
-    ytile integer;
-
-  BEGIN
-    pnt_merc = T_uxy(pnt, truncated);
-    Z2 := pow(2, zoom);
-
-    IF ST_X(pnt_merc)<=0 THEN
-      xtile = 0;
-    ELSIF ST_X(pnt_merc)>=1 THEN
-      xtile = Z2 - 1;
-    ELSE
-        -- To address loss of precision in round-tripping between tile
-        -- and lng/lat, points within EPSILON of the right side of a tile
-        -- are counted in the next tile over.
-        xtile = (floor((ST_X(pnt_merc) + EPSILON) * Z2))::integer;
-    END IF;
-
-    IF ST_Y(pnt_merc)<=0 THEN
-      ytile = 0;
-    ELSIF ST_Y(pnt_merc)>=1 THEN
-      ytile = Z2 - 1;
-    ELSE
-      ytile = (floor((ST_Y(pnt_merc) + EPSILON) * Z2))::integer;
-    END IF;
-
-    RETURN ST_MakePoint(xtile, ytile, zoom);
-  END
+  SELECT ST_MakePoint(
+    T_index(T_x(T_clamp(ST_X(pnt), 180.0, truncated)), zoom),
+    T_index(T_y(sin(radians(T_clamp(ST_Y(pnt), 90.0, truncated)))), zoom),
+    zoom
+  )
 $$;
 
 CREATE OR REPLACE FUNCTION public.T_tilename(tile geometry)
-RETURNS text LANGUAGE sql IMMUTABLE STRICT AS $$
+RETURNS text LANGUAGE sql IMMUTABLE PARALLEL SAFE AS $$
   -- Return the tile coordinate string in the format 'tilex/tiley/zoom'
-  SELECT CONCAT_WS('/', ST_X(tile)::text, ST_Y(tile)::text, ST_Z(tile)::text)
+  -- (i.e. the tracked_tile uri)
+  SELECT ST_X(tile)::integer::text || '/' || ST_Y(tile)::integer::text || '/' || ST_Z(tile)::integer::text
 $$;
+
+CREATE OR REPLACE FUNCTION public.T_tiles(geom geometry, zoom integer, truncated boolean default FALSE)
+RETURNS SETOF geometry LANGUAGE sql IMMUTABLE PARALLEL SAFE ROWS 16 AS $$
+  -- Returns all the tiles intersecting a geometry (EPSG:4326)
+  SELECT ST_MakePoint(x, y, zoom)
+  FROM
+    generate_series(
+      T_index(T_x(T_clamp(ST_XMin(geom), 180.0, truncated)), zoom),
+      T_index(T_x(T_clamp(ST_XMax(geom), 180.0, truncated)), zoom)
+    ) AS x,
+    generate_series(
+      T_index(T_y(sin(radians(T_clamp(ST_YMax(geom), 90.0, truncated)))), zoom),
+      T_index(T_y(sin(radians(T_clamp(ST_YMin(geom), 90.0, truncated)))), zoom)
+    ) AS y
+  WHERE ST_Intersects(T_bounds(ST_MakePoint(x, y, zoom)), geom)
+$$;
+
+-- Functional index recipe (see: setup.postgresql.setup_tile_index), e.g.:
+--   CREATE INDEX node_tile_18_idx ON node (T_tilename(T_tile(geom, 18)));
+-- so that nodes are bucketed into tracked tiles of that zoom by:
+--   SELECT ... FROM node JOIN tracked_tile ON T_tilename(T_tile(node.geom, 18)) = tracked_tile.uri
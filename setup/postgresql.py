@@ -24,10 +24,21 @@ def setup_view(name, query, *fields, **options):
             db(query)._select(*fields, **options)
         )
 
-def setup_views():
-    """"""
+def setup_views(materialized=False):
+    """
+    materialized @boolean : Whether to store ways, graph, polys and mpolys
+        as tables refreshed incrementally (see: refresh_views) instead of views.
+    """
     # db._adapter.reconnect()
 
+    # Materialized tables are filled from views of the same name suffixed
+    # by _v, with their refresh key as last column
+    if materialized:
+        suffix = "_v"
+    else:
+        suffix = ""
+        teardown_materialized_views()
+
     setup_view("data_source", db.info.id>0,
         "min(info.id) as id",
         db.info.source_name,
@@ -102,15 +113,15 @@ def setup_views():
         First(db.info.source_id, 'text', alias='source_id'),
     ]
 
-    setup_view("ways", way_query & "(info.tags::jsonb ? 'highway')::boolean",
+    setup_view("ways"+suffix, way_query & "(info.tags::jsonb ? 'highway')::boolean",
         First(db.info.id, alias='id'),
         "ST_MakeLine(node.geom ORDER BY way_node.sorting) as geom",
-        *base_geom_fields,
+        *base_geom_fields + (["way_node.info_id as way_info_id"] if materialized else []),
         groupby = db.way_node.info_id
     )
 
 
-    setup_view("graph", """SELECT
+    setup_view("graph"+suffix, """SELECT
         -- snode.info_id::text||'-'||tnode.info_id::text as id,
         swnode.id,
         data_source.id as src_id,
@@ -127,7 +138,7 @@ def setup_views():
         info.properties,
         ST_Distance(ST_Transform(snode.geom, 3857), ST_Transform(tnode.geom, 3857)) as len,
         snode.geom as snode,
-        tnode.geom as tnode
+        tnode.geom as tnode{key}
     FROM
         info,
         info as sinfo,
@@ -146,7 +157,9 @@ def setup_views():
     	tnode.id = twnode.node_id AND
         swnode.info_id = twnode.info_id AND
         swnode.sorting+1 = twnode.sorting AND
-        (info.tags::jsonb ? 'highway')::boolean""")
+        (info.tags::jsonb ? 'highway')::boolean""".format(
+            key = ",\n        info.id as way_info_id" if materialized else ""
+        ))
 
     polys_query_template = """SELECT
         subq.id,
@@ -168,7 +181,7 @@ def setup_views():
     -- (subq.tags::jsonb ?| array['landuse', 'boundary', 'building'])::boolean)
     ;"""
 
-    setup_view("polys", polys_query_template.format(db(
+    setup_view("polys"+suffix, polys_query_template.format(db(
         way_query
     )._select(
         # Record identifier
@@ -224,7 +237,7 @@ def setup_views():
         ORDER BY relation_id, relation.role DESC
     ) as subq WHERE ST_IsClosed(subq.geom);""")
 
-    setup_view("mpolys", """SELECT *,
+    setup_view("mpolys"+suffix, """SELECT *,
         ST_MakePolygon(polys[1], polys[2:array_length(polys, 1)]) as geom,
         ST_Centroid(polys[1]) AS centroid
         FROM (SELECT
@@ -235,11 +248,207 @@ def setup_views():
                 percentile_disc(0) WITHIN GROUP (ORDER BY source_id) as source_id,
                 (array_agg(tags))[1] as tags,
                 (array_agg(properties))[1] as properties,
-                array_agg(geom ORDER BY role DESC) as polys
+                array_agg(geom ORDER BY role DESC) as polys{key}
             FROM _splitted_polys
             GROUP BY relation_id
             ORDER BY relation_id
-        ) as subq""")
+        ) as subq""".format(
+            key = ",\n                relation_id" if materialized else ""
+        ))
+
+    if materialized:
+        setup_materialized_views()
+
+    db.commit()
+
+# (<name>, <refresh key>, <geometry columns>)
+MATERIALIZED_VIEWS = (
+    ("ways", "way_info_id", ("geom",),),
+    ("graph", "way_info_id", ("geom",),),
+    ("polys", "way_info_id", ("geom", "centroid",),),
+    ("mpolys", "relation_id", ("geom", "centroid",),),
+)
+
+# (<table>, <info id column>)
+LOGGED_TABLES = (
+    ("info", "id",),
+    ("node", "info_id",),
+    ("way_node", "info_id",),
+    ("relation", "info_id",),
+)
+
+def __relkind(name):
+    """ Returns the kind of a relation ('r': table, 'v': view) or None """
+    rows = db.executesql("SELECT relkind FROM pg_class WHERE oid = to_regclass(%s)",
+        placeholders = [name]
+    )
+    return rows[0][0] if rows else None
+
+def setup_changelog():
+    """ Sets up the import changelog, i.e. the ids of the info records
+    touched by any statement on the info, node, way_node and relation tables
+    and of the ways of the touched nodes.
+    Statement triggers with transition tables log each statement at once,
+    so that bulk imports (i.e. COPY) are not slowed down row by row.
+    """
+    db.executesql("""CREATE TABLE IF NOT EXISTS import_changelog (
+        info_id integer NOT NULL,
+        changed_on timestamp NOT NULL DEFAULT now()
+    )""")
+
+    # Ways of the changed nodes are logged too: they are resolved from the
+    # transition tables, so deleted node rows are covered as well
+    db.executesql("""CREATE OR REPLACE FUNCTION log_import_changes() RETURNS trigger AS $$
+    DECLARE
+        changed text;
+    BEGIN
+        IF TG_OP = 'INSERT' THEN
+            changed := 'SELECT * FROM new_rows';
+        ELSIF TG_OP = 'UPDATE' THEN
+            changed := 'SELECT * FROM new_rows UNION ALL SELECT * FROM old_rows';
+        ELSE
+            changed := 'SELECT * FROM old_rows';
+        END IF;
+        EXECUTE format('INSERT INTO import_changelog (info_id) SELECT DISTINCT %I FROM (%s) AS r', TG_ARGV[0], changed);
+        IF TG_TABLE_NAME = 'node' THEN
+            EXECUTE format('INSERT INTO import_changelog (info_id) SELECT DISTINCT way_node.info_id
+                FROM way_node JOIN (%s) AS r ON r.id = way_node.node_id', changed);
+        END IF;
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql""")
+
+    # Transition tables are not supported by triggers on more than one event
+    transitions = dict(
+        insert = "NEW TABLE AS new_rows",
+        update = "OLD TABLE AS old_rows NEW TABLE AS new_rows",
+        delete = "OLD TABLE AS old_rows"
+    )
+
+    for table, column in LOGGED_TABLES:
+        for event, referencing in transitions.items():
+            trigger = "{}_log_{}".format(table, event)
+            db.executesql("DROP TRIGGER IF EXISTS {} ON {}".format(trigger, table))
+            db.executesql("""CREATE TRIGGER {trigger} AFTER {event} ON {table}
+                REFERENCING {referencing}
+                FOR EACH STATEMENT EXECUTE PROCEDURE log_import_changes('{column}')""".format(
+                trigger = trigger,
+                event = event.upper(),
+                table = table,
+                referencing = referencing,
+                column = column
+            ))
+
+def setup_materialized_views():
+    """ (Re)builds the materialized tables from their views
+    (see: setup_views) and starts logging changes.
+    """
+    setup_changelog()
+    # Everything logged so far is in the new tables
+    db.executesql("TRUNCATE import_changelog")
+
+    for name, key, geoms in MATERIALIZED_VIEWS:
+        if __relkind(name) == 'v':
+            db.executesql("DROP VIEW {}".format(name))
+        db.executesql("DROP TABLE IF EXISTS {}".format(name))
+        db.executesql("CREATE TABLE {name} AS SELECT * FROM {name}_v".format(name=name))
+        db.executesql("CREATE INDEX {name}_{key}_idx ON {name} ({key})".format(name=name, key=key))
+        for geom in geoms:
+            db.executesql("CREATE INDEX {name}_{geom}_gist ON {name} USING GIST ({geom})".format(name=name, geom=geom))
+        db.executesql("ANALYZE {}".format(name))
+
+def teardown_materialized_views():
+    """ Drops the materialized tables and the change logging triggers """
+    for name, _, _ in MATERIALIZED_VIEWS:
+        if __relkind(name) == 'r':
+            db.executesql("DROP TABLE {}".format(name))
+        db.executesql("DROP VIEW IF EXISTS {}_v".format(name))
+    for table, _ in LOGGED_TABLES:
+        for event in ("insert", "update", "delete",):
+            db.executesql("DROP TRIGGER IF EXISTS {}_log_{} ON {}".format(table, event, table))
+    db.executesql("DROP TABLE IF EXISTS import_changelog")
+
+def refresh_views():
+    """ Refreshes the materialized tables (see: setup_views) for the
+    elements changed since the last refresh, i.e. the logged info ids
+    (ways of changed nodes included, see: setup_changelog) and their relations.
+
+    Returns the number of refreshed info ids.
+    """
+    ids = [id for id, in db.executesql("""WITH claimed AS (
+            DELETE FROM import_changelog RETURNING info_id
+        ), changed AS (
+            SELECT DISTINCT info_id AS id FROM claimed
+        )
+        SELECT changed.id FROM changed
+        UNION
+        SELECT relation.info_id FROM relation
+        JOIN changed ON changed.id = relation.member_id""")]
+
+    if ids:
+        for name, key, _ in MATERIALIZED_VIEWS:
+            # Ids are given as an array so that the condition is pushed
+            # down into the grouped subqueries of the views
+            db.executesql("DELETE FROM {name} WHERE {key} = ANY(%s::integer[])".format(name=name, key=key),
+                placeholders = [ids]
+            )
+            db.executesql("""INSERT INTO {name}
+                SELECT * FROM {name}_v WHERE {key} = ANY(%s::integer[])""".format(name=name, key=key),
+                placeholders = [ids]
+            )
+
+    db.commit()
+    return len(ids)
+
+# Views depending on info columns, dependents first
+VIEWS = ("mpolys", "mpolys_v", "_splitted_polys", "polys", "polys_v", "graph",
+    "graph_v", "ways", "ways_v", "points", "housenumbers", "addresses", "data_source",)
+
+# (<name>, <table>, <method>, <columns>)
+INDEXES = (
+    ("node_geom_gist", "node", "GIST", "geom",),
+    ("node_info_id_idx", "node", "BTREE", "info_id",),
+    ("way_node_info_id_sorting_idx", "way_node", "BTREE", "info_id, sorting",),
+    ("way_node_node_id_idx", "way_node", "BTREE", "node_id",),
+    ("relation_info_id_idx", "relation", "BTREE", "info_id",),
+    ("relation_member_id_idx", "relation", "BTREE", "member_id",),
+    ("info_source_idx", "info", "BTREE", "source_name, gtype, source_id",),
+)
+
+def __column_type(table, column):
+    rows = db.executesql("""SELECT data_type FROM information_schema.columns
+        WHERE table_schema = current_schema() AND table_name = %s AND column_name = %s""",
+        placeholders = [table, column]
+    )
+    return rows[0][0] if rows else None
+
+def setup_indexes(jsonb=True):
+    """ Provisions the indexes used by views and parsers.
+
+    jsonb @boolean : Whether to migrate the json columns of info to jsonb.
+        Views depending on them are dropped, run setup_views afterwards.
+        Otherwise tags are indexed as the (tags::jsonb) expression used by views.
+    """
+    # rname of the attributes field
+    columns = ("tags", "properties", "attrs",)
+
+    if jsonb and any(__column_type("info", col) == "json" for col in columns):
+        for name in VIEWS:
+            if __relkind(name) == 'v':
+                db.executesql("DROP VIEW {} CASCADE".format(name))
+        db.executesql("ALTER TABLE info {}".format(", ".join(
+            "ALTER COLUMN {0} TYPE jsonb USING {0}::jsonb".format(col) for col in columns
+        )))
+
+    tags = "tags" if __column_type("info", "tags") == "jsonb" else "(tags::jsonb)"
+    db.executesql("DROP INDEX IF EXISTS info_tags_gin")
+    db.executesql("CREATE INDEX info_tags_gin ON info USING GIN ({})".format(tags))
+
+    for name, table, method, cols in INDEXES:
+        db.executesql("CREATE INDEX IF NOT EXISTS {} ON {} USING {} ({})".format(name, table, method, cols))
+
+    for table in ("info", "node", "way_node", "relation",):
+        db.executesql("ANALYZE {}".format(table))
 
     db.commit()
 
@@ -249,3 +458,18 @@ def setup_functions():
         sql = pgmercantile.read()
     db.executesql(sql)
     db.commit()
+
+def setup_tile_index(zoom, table="node", column="geom"):
+    """ Indexes the names of the tiles of the given zoom containing the
+    point geometries of table (see: T_tile and T_tilename in mercantile.sql),
+    i.e. the uri of the tracked tiles they belong to.
+    Requires setup_functions.
+    """
+    db.executesql("""CREATE INDEX IF NOT EXISTS {table}_tile_{zoom:d}_idx
+        ON {table} (T_tilename(T_tile({column}, {zoom:d})))""".format(
+        table = table,
+        column = column,
+        zoom = zoom
+    ))
+    db.executesql("ANALYZE {}".format(table))
+    db.commit()
@@ -0,0 +1,6 @@
+# -*- coding: utf-8 -*-
+
+import os, sys
+
+# Modules are imported as populate.<module>, i.e. without the py4web app
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
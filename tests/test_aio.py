@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import threading
+from time import monotonic
+
+import pytest
+
+web = pytest.importorskip("aiohttp.web")
+
+from populate.optutils import aio
+
+
+@pytest.fixture(autouse=True)
+def retries(monkeypatch):
+    # As set by optutils.base, overpy defaults to no retry
+    monkeypatch.setattr(aio.AsyncOverpass, "max_retry_count", 3)
+
+@pytest.fixture
+def server():
+    """ Local stub of the Overpass interpreter, answering 429 with
+    Retry-After to the first throttled requests and 200 to the others.
+    """
+    state = dict(calls=[], throttled=0, retry_after="1")
+
+    async def interpreter(request):
+        query = await request.read()
+        state["calls"].append((monotonic(), query,))
+        if state["throttled"] > 0:
+            state["throttled"] -= 1
+            return web.Response(status=429, headers={"Retry-After": state["retry_after"]})
+        return web.Response(body=b"ok:"+query)
+
+    loop = asyncio.new_event_loop()
+    app = web.Application()
+    app.router.add_post("/api/interpreter", interpreter)
+    runner = web.AppRunner(app)
+    loop.run_until_complete(runner.setup())
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    loop.run_until_complete(site.start())
+    port = site._server.sockets[0].getsockname()[1]
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+
+    yield "http://127.0.0.1:{:d}/api/interpreter".format(port), state
+
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
+    loop.run_until_complete(runner.cleanup())
+    loop.close()
+
+def test_retry_after(server):
+    url, state = server
+    state["throttled"] = 1
+    written = {}
+    failures = aio.fetch_all({"a": "q"}, written.__setitem__, url=url, rate=100, burst=10)
+    assert failures == {}
+    assert written == {"a": b"ok:q"}
+    (first, _), (second, _) = state["calls"]
+    # The bucket is paused for the time suggested by Retry-After
+    assert second-first >= .9
+
+def test_token_bucket_pacing(server):
+    url, state = server
+    queries = {key: key for key in "abcde"}
+    written = {}
+    failures = aio.fetch_all(queries, written.__setitem__, url=url, concurrency=5, rate=10., burst=1)
+    assert failures == {}
+    assert written == {key: b"ok:"+key.encode() for key in queries}
+    starts = sorted(t for t, _ in state["calls"])
+    # One request every 1/rate seconds after the burst
+    assert starts[-1]-starts[0] >= .35
+
+def test_max_retries(server):
+    url, state = server
+    state["throttled"], state["retry_after"] = 10, "0"
+    failures = aio.fetch_all({"a": "q"}, lambda *args: None, url=url, rate=100, burst=10)
+    assert isinstance(failures["a"], aio.overpy.exception.MaxRetriesReached)
+    assert len(state["calls"]) == aio.AsyncOverpass.max_retry_count+1
+
+def test_writer_failures(server):
+    url, _ = server
+    threads, written = set(), {}
+
+    def writer(key, raw_data):
+        threads.add(threading.get_ident())
+        if key == "b":
+            raise ValueError(key)
+        written[key] = raw_data
+
+    failures = aio.fetch_all({"a": "a", "b": "b", "c": "c"}, writer, url=url, rate=100, burst=10)
+    assert set(failures) == {"b"} and isinstance(failures["b"], ValueError)
+    assert set(written) == {"a", "c"}
+    # Writes run in the calling thread, not in the event loop one
+    assert threads == {threading.get_ident()}
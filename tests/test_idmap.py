@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+
+import random
+
+import pytest
+
+from populate.idmap import IdMap
+
+
+@pytest.mark.parametrize("spill_over", [None, 10])
+def test_matches_dict(spill_over):
+    rnd = random.Random(0)
+    idmap, expected = IdMap(width=2, merge_every=7, spill_over=spill_over), {}
+    for _ in range(500):
+        key = rnd.randrange(300)
+        idmap[key] = expected[key] = (key, rnd.randrange(10),)
+        assert len(idmap) == len(expected)
+    idmap.merge()
+    assert len(idmap) == len(expected)
+    assert list(idmap.keys) == sorted(expected)
+    assert all(idmap[key] == value for key, value in expected.items())
+    assert not 300 in idmap
+    idmap.close()
+
+def test_len_with_replaced_keys():
+    idmap = IdMap(merge_every=10)
+    idmap.update((key, key,) for key in range(5))
+    # Out of order, i.e. pending, updates of existing keys
+    idmap[1] = idmap[3] = idmap[3] = 0
+    assert len(idmap) == 5
+    idmap.merge()
+    assert len(idmap) == 5 and idmap[3] == 0
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+
+from populate.pgcopy import BulkCopyer
+
+
+class FakeDB(object):
+    """ Records copied rows in a transaction committed or rolled back """
+
+    def __init__(self):
+        self.pending = []
+        self.committed = []
+        self._adapter = self
+        self.cursor = self
+        self.sequence = 0
+
+    def copy_from(self, f, table_name, null=None):
+        self.pending.extend(line for line in f.read().splitlines() if line)
+
+    def executesql(self, sql, placeholders=None):
+        n = int(sql.rsplit(",", 1)[1].split(")")[0])
+        self.sequence += n
+        return [(id,) for id in range(self.sequence-n+1, self.sequence+1)]
+
+    def commit(self):
+        self.committed.extend(self.pending)
+        self.pending = []
+
+    def rollback(self):
+        self.pending = []
+
+
+class FakeTable(object):
+
+    _tablename = "node"
+
+    def __init__(self, db):
+        self._db = db
+
+    def fields(self):
+        return ["id", "info_id", "geom"]
+
+
+def test_commit_on_exit():
+    db = FakeDB()
+    with BulkCopyer(FakeTable(db)) as copyer:
+        copyer.writerow(dict(info_id=1, geom="NULL"))
+    assert len(db.committed) == 1
+
+def test_rollback_after_flush_on_error():
+    db = FakeDB()
+    with pytest.raises(RuntimeError):
+        with BulkCopyer(FakeTable(db), max_rows=1) as copyer:
+            copyer.writerow(dict(info_id=1, geom="NULL"))
+            # Flushed over the threshold
+            assert db.pending
+            raise RuntimeError()
+    # e.g. the commit of a sibling copyer or of the request
+    db.commit()
+    assert db.committed == []
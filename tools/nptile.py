@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+
+"""
+Vectorized Web Mercator tile math with NumPy.
+
+Functions accept scalars or arrays and return arrays, with the same
+results as the corresponding mercantile functions.
+"""
+
+import numpy as np
+
+from .tile import BASE_DIM, CE, MAX_ZOOM, base_zoom
+
+# As in mercantile.tile
+EPSILON = 1e-14
+
+def ground_zoom(lat, bdim=BASE_DIM):
+    """ Like tile.base_zoom but for bdim in real (ground) meters at the given
+    latitudes, i.e. taking into account the Mercator scale factor.
+    lat @array : Latitudes;
+    bdim @float : Base tile dimension in meters.
+    """
+    scale = np.cos(np.radians(np.asarray(lat, dtype=float)))
+    zoom = np.floor(np.log2(CE*scale/bdim)).astype(int)+1
+    # Guards against rounding at exact powers of 2
+    zoom += (CE*scale/2.**zoom >= bdim)
+    return np.clip(zoom, 0, MAX_ZOOM)
+
+def tile(lon, lat, zoom):
+    """ Returns the x and y arrays of the tiles containing the given points
+    (see: mercantile.tile).
+    """
+    lon, lat = np.asarray(lon, dtype=float), np.asarray(lat, dtype=float)
+    z2 = 2.**np.asarray(zoom)
+    x = lon/360.+.5
+    sinlat = np.sin(np.radians(lat))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        y = .5-.25*np.log((1.+sinlat)/(1.-sinlat))/np.pi
+
+    def _tile(v):
+        return np.where(v <= 0, 0,
+            np.where(v >= 1, z2-1, np.floor(np.clip(v+EPSILON, 0, 1)*z2))
+        ).astype(np.int64)
+
+    return _tile(x), _tile(y)
+
+def bounds(x, y, zoom):
+    """ Returns the west, south, east and north arrays of tiles in degrees
+    (see: mercantile.bounds).
+    """
+    x, y = np.asarray(x, dtype=float), np.asarray(y, dtype=float)
+    z2 = 2.**np.asarray(zoom)
+    lng = lambda x: x/z2*360.-180.
+    lat = lambda y: np.degrees(np.arctan(np.sinh(np.pi*(1-2*y/z2))))
+    return lng(x), lat(y+1), lng(x+1), lat(y)
+
+def xy_bounds(x, y, zoom):
+    """ Returns the left, bottom, right and top arrays of tiles in EPSG:3857
+    meters (see: mercantile.xy_bounds).
+    """
+    size = CE/2.**np.asarray(zoom)
+    left = np.asarray(x)*size-CE/2
+    top = CE/2-np.asarray(y)*size
+    return left, top-size, left+size, top
+
+def quadkeys(x, y, zoom):
+    """ Returns the array of the quadkeys of tiles at the same zoom level
+    (see: mercantile.quadkey).
+    """
+    x, y = np.atleast_1d(x).astype(np.int64), np.atleast_1d(y).astype(np.int64)
+    if zoom == 0:
+        return np.full(x.shape, "", dtype="<U1")
+    masks = 1 << np.arange(zoom-1, -1, -1, dtype=np.int64)
+    digits = ((x[:,None] & masks) != 0) + 2*((y[:,None] & masks) != 0)
+    chars = (digits+ord("0")).astype(np.uint8)
+    return chars.view("S{:d}".format(zoom)).ravel().astype(str)
+
+def tile_range(west, south, east, north, zoom):
+    """ Returns the x and y arrays of all the tiles intersecting a bbox """
+    (minx, maxx), (maxy, miny) = tile([west, east], [south, north], zoom)
+    xs, ys = np.meshgrid(np.arange(minx, maxx+1), np.arange(miny, maxy+1), indexing="ij")
+    return xs.ravel(), ys.ravel()
+
+def box_tiles(dist, lon, lat, bdim=BASE_DIM, buffer=4):
+    """ Array version of tile.boxtiles.
+    Returns the x and y arrays of tiles and their zoom level.
+    """
+    zoom = base_zoom(bdim)
+    bx, by = tile(lon, lat, zoom)
+    size = CE/2.**zoom
+    # See tile.__get_box_dim
+    nn = int(np.ceil(dist/size))//2
+    offsets = np.arange(-(nn+buffer-1), nn+buffer+1)
+    xs, ys = np.meshgrid(int(bx)+offsets, int(by)+offsets, indexing="ij")
+    return xs.ravel(), ys.ravel(), zoom
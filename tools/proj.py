@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+
+"""
+Shared registry of pyproj transformers.
+
+Building a CRS is expensive so transformers are built once for each
+(source, destination) pair and kept for reuse. Transformer objects are not
+thread safe, hence each thread has its own registry.
+Coordinates are always in x, y order (i.e. longitude, latitude).
+"""
+
+import threading
+import pyproj
+
+WGS84 = "epsg:4326"
+MERCATOR = "epsg:3857"
+
+_local = threading.local()
+
+def get_transformer(src=WGS84, dst=MERCATOR):
+    """ Returns the cached transformer from src to dst CRS of this thread """
+    try:
+        registry = _local.registry
+    except AttributeError:
+        registry = _local.registry = {}
+    key = (src, dst,)
+    try:
+        return registry[key]
+    except KeyError:
+        transformer = registry[key] = pyproj.Transformer.from_crs(src, dst, always_xy=True)
+        return transformer
+
+def transform(xs, ys, src=WGS84, dst=MERCATOR):
+    """ Transforms coordinates from src to dst CRS in a single call.
+    xs @float/sequence/array : Abscissas (i.e. longitudes in EPSG:4326);
+    ys @float/sequence/array : Ordinates (i.e. latitudes in EPSG:4326);
+    src @string : Source CRS;
+    dst @string : Destination CRS.
+
+    Returns the transformed coordinates, of the same type as the given ones.
+    """
+    if src == dst:
+        return xs, ys
+    return get_transformer(src, dst).transform(xs, ys)
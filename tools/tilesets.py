@@ -2,13 +2,17 @@
 
 import mercantile as mt
 import h3
-from shapely.geometry import Point
-import pyproj
+from shapely.geometry import shape, mapping
+from math import cos, radians
+from functools import lru_cache
 
 BASE_DIM = 155 # meters
 MT_MAX_ZOOM = 30
 H3_MAX_ZOOM = 15
 
+# Width in degrees of the latitude bands of the H3 edge length table
+H3_LAT_BAND = 5
+
 def zoom2dims(zoom, lon, lat):
     tt = mt.tile(lon, lat, zoom)
     bb = mt.xy_bounds(tt)
@@ -36,27 +40,62 @@ def mt_tile_by_dim(lon, lat, bdim=BASE_DIM, asc=True, more=False):
                 break
         elif not asc:
             break
-    return tt if not more else (tt, resolution,)
-
-def h3_tile_by_dim(lon, lat, bdim=BASE_DIM, asc=True, more=False):
+    return tt if not more else (tt, zoom_level,)
 
-    osmproj = pyproj.Proj("epsg:3857")
-
-    resolutions = range(H3_MAX_ZOOM) if asc else reversed(range(H3_MAX_ZOOM))
-    for resolution in resolutions:
-        tile = h3.geo_to_h3(lat, lon, resolution)
-        polygon = h3.h3_to_geo_boundary(tile)
-
-        x1, y1 = osmproj(*polygon[0])
-        x2, y2 = osmproj(*polygon[1])
+@lru_cache(maxsize=None)
+def h3_edge_lengths(band):
+    """ Returns the average H3 edge lengths by resolution (0 to H3_MAX_ZOOM-1)
+    in EPSG:3857 meters (i.e. the units of BASE_DIM) in the given latitude band.
+    band @int : Latitude band index (see: h3_lat_band).
+    """
+    # Mercator scale factor at the band center, capped near the poles
+    lat = min(85., (band+.5)*H3_LAT_BAND)
+    scale = 1./cos(radians(lat))
+    return tuple(h3.edge_length(resolution, unit='m')*scale for resolution in range(H3_MAX_ZOOM))
 
-        dist = Point(x1, y1).distance(Point(x2, y2))
+def h3_lat_band(lat):
+    return int(abs(lat)//H3_LAT_BAND)
 
-        if (asc and dist < bdim) or (not asc and dist > bdim):
-            break
+def h3_resolution_by_dim(lat, bdim=BASE_DIM, asc=True):
+    """ Returns the first resolution with edges shorter (asc) or longer (not asc)
+    than bdim at the given latitude.
+    """
+    # Edge lengths decrease with resolution
+    lengths = h3_edge_lengths(h3_lat_band(lat))
+    if asc:
+        for resolution, length in enumerate(lengths):
+            if length < bdim:
+                return resolution
+        return H3_MAX_ZOOM-1
+    else:
+        for resolution in reversed(range(H3_MAX_ZOOM)):
+            if lengths[resolution] > bdim:
+                return resolution
+        return 0
 
+def h3_tile_by_dim(lon, lat, bdim=BASE_DIM, asc=True, more=False):
+    """ H3 version of mt_tile_by_dim """
+    resolution = h3_resolution_by_dim(lat, bdim=bdim, asc=asc)
+    tile = h3.geo_to_h3(lat, lon, resolution)
     return tile if not more else (tile, resolution,)
 
+def h3_polyfill(geom, resolution=None, bdim=BASE_DIM, compact=False):
+    """ Returns the set of H3 cells whose centers are inside a polygon.
+    geom : Shapely (multi)polygon or GeoJSON like geometry dict (lon/lat coordinates);
+    resolution @int : H3 resolution (default: the one of bdim at the polygon centroid);
+    bdim @float : Cell edge length in meters (see: h3_resolution_by_dim);
+    compact @bool : Return the compacted set (cells of mixed resolution).
+    """
+    if not hasattr(geom, "geom_type"):
+        geom = shape(geom)
+    if resolution is None:
+        resolution = h3_resolution_by_dim(geom.centroid.y, bdim=bdim)
+    polygons = getattr(geom, "geoms", [geom])
+    cells = set()
+    for polygon in polygons:
+        cells |= h3.polyfill(mapping(polygon), resolution, geo_json_conformant=True)
+    return h3.compact(cells) if compact else cells
+
 def tile_by_dim(lon, lat, bdim=BASE_DIM, asc=True, classic=False, more=False):
     if classic:
         return mt_tile_by_dim(lon, lat, bdim=bdim, asc=asc, more=more)